@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from scipy.spatial import cKDTree
+
+from PeakDetector import detect_peaks
+from PeakIDAssigner import N_pix, load_data, load_assigned_peaks, save_assigned_peaks
+from CrystalMetrics import to_pixels
+
+# Bootstrap uncertainty of the crystal positions. Each replica is the flood map Poisson-resampled
+# (every pixel drawn with the observed counts as its mean), run through detect_peaks and its peaks are
+# matched to the IDs of the calibration by nearest neighbour. The map is shared with the worker
+# processes through shared memory, so it is not pickled per replica.
+# By default the replicas use the detector that produces the calibration tables (PeakDetector main:
+# engine='gaussian', sigma=1, min_distance=5, threshold_factor=1.1, integer pixel positions), so the
+# result is the uncertainty of that estimator. On maps with high counts its peaks rarely move by a
+# whole pixel, so the replica scatter alone is often 0; the rounding to pixels is added as the variance
+# of a uniform error over one pixel (1/12 px^2 per axis). refine=True adds a sub-pixel centroid to
+# every peak and measures that estimator instead (no rounding term), which the tables do not use.
+
+STD_NAMES = ['std_x', 'std_y', 'n_replicas']
+
+_worker = {}
+
+def _init_worker(shm_name, shape, dtype, reference, options):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm  # keep the mapping open for the lifetime of the worker
+    _worker['data'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker['reference'] = reference
+    _worker['options'] = options
+
+def refine_peaks(data, peaks, radius):
+    # Background-subtracted centroid of a (2*radius+1)^2 window around every integer peak (row, col)
+    height, width = data.shape
+    offsets = np.arange(-radius, radius + 1)
+    rows = np.clip(peaks[:, 0, None, None] + offsets[None, :, None], 0, height - 1)
+    cols = np.clip(peaks[:, 1, None, None] + offsets[None, None, :], 0, width - 1)
+    windows = data[rows, cols].astype(np.float64)
+    windows -= windows.min(axis=(1, 2), keepdims=True)
+    total = windows.sum(axis=(1, 2))
+    total[total == 0] = 1
+    return np.column_stack([(windows * rows).sum(axis=(1, 2)) / total, (windows * cols).sum(axis=(1, 2)) / total])
+
+def match_to_reference(reference, peaks, gate):
+    # Position of the peak nearest to every reference point (rows, cols), nan beyond gate
+    matched = np.full(reference.shape, np.nan)
+    if len(peaks) == 0:
+        return matched
+    distance, nearest = cKDTree(peaks).query(reference, distance_upper_bound=gate)
+    found = np.isfinite(distance)
+    matched[found] = peaks[nearest[found]]
+    return matched
+
+def bootstrap_replica(seed):
+    data, reference, options = _worker['data'], _worker['reference'], _worker['options']
+    replica = np.random.default_rng(seed).poisson(data).astype(np.float32)
+    peaks = detect_peaks(replica, sigma=options['sigma'], min_distance=options['min_distance'],
+                         threshold_factor=options['threshold_factor'], engine=options['engine'])
+    peaks = np.asarray(peaks, dtype=float)
+    if options['refine']:
+        peaks = refine_peaks(replica, peaks.astype(int), options['radius'])
+    return match_to_reference(reference, peaks, options['gate'])
+
+def bootstrap_positions(map_data, peak_ids, n_replicas=100, time_budget=600, sigma=1, min_distance=5,
+                        threshold_factor=1.1, engine='gaussian', refine=False, workers=None, seed=0):
+    # Returns {'std_x', 'std_y', 'n_replicas'} as (N_pix, N_pix) arrays indexed [id_y][id_x], with the
+    # standard deviations in normalized units (including the pixel rounding unless refine). No new
+    # replica starts after time_budget seconds.
+    # The detection parameters must be the ones the calibration was detected with (see above).
+    valid = ~np.isnan(peak_ids[:, :, 0])
+    rows, cols = to_pixels(peak_ids, map_data.shape)
+    reference = np.column_stack([rows[valid], cols[valid]])
+    pitch = float(np.median(cKDTree(reference).query(reference, k=2)[0][:, 1]))
+    options = {'sigma': sigma, 'min_distance': min_distance, 'threshold_factor': threshold_factor,
+               'engine': engine, 'refine': refine, 'radius': max(2, int(round(2 * sigma))), 'gate': pitch / 2}
+
+    map_data = np.ascontiguousarray(map_data)
+    shm = shared_memory.SharedMemory(create=True, size=map_data.nbytes)
+    samples = []
+    try:
+        np.ndarray(map_data.shape, dtype=map_data.dtype, buffer=shm.buf)[:] = map_data
+        seeds = np.random.SeedSequence(seed).spawn(n_replicas)
+        workers = workers or os.cpu_count()
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(shm.name, map_data.shape, map_data.dtype, reference, options)) as pool:
+            # One replica per worker in flight, so the budget is checked before each new one starts
+            pending = {pool.submit(bootstrap_replica, seeds.pop()) for _ in range(min(workers, len(seeds)))}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                samples.extend(future.result() for future in done)
+                while seeds and len(pending) < workers and time.perf_counter() - start_time < time_budget:
+                    pending.add(pool.submit(bootstrap_replica, seeds.pop()))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    samples = np.array(samples)  # (replicas, crystals, (row, col))
+    counts = np.isfinite(samples[:, :, 0]).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation = np.nanstd(samples, axis=0, ddof=1) if len(samples) > 1 else np.full(reference.shape, np.nan)
+    if not refine:
+        deviation = np.sqrt(deviation ** 2 + 1 / 12)  # pixel quantization of the integer positions
+    deviation[counts < 2] = np.nan
+
+    result = {name: np.full((N_pix, N_pix), np.nan) for name in STD_NAMES}
+    result['std_x'][valid] = deviation[:, 1] * 2 / map_data.shape[1]
+    result['std_y'][valid] = deviation[:, 0] * 2 / map_data.shape[0]
+    result['n_replicas'][valid] = counts
+    return result
+
+def main():
+    if len(sys.argv) < 4:
+        print('Usage: python Bootstrap.py <map.npy> <ids.csv> <output.csv> [n_replicas] [time_budget_s] [workers] '
+              '[sigma] [min_distance] [threshold_factor] [refine]')
+        return
+    map_file_path, ids_file_path, output_file_path = sys.argv[1:4]
+    n_replicas = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+    time_budget = float(sys.argv[5]) if len(sys.argv) > 5 else 600
+    workers = int(sys.argv[6]) if len(sys.argv) > 6 else None
+    # Detection parameters of the calibration, by default those of PeakDetector
+    sigma = float(sys.argv[7]) if len(sys.argv) > 7 else 1
+    min_distance = int(sys.argv[8]) if len(sys.argv) > 8 else 5
+    threshold_factor = float(sys.argv[9]) if len(sys.argv) > 9 else 1.1
+    refine = len(sys.argv) > 10 and sys.argv[10] == 'refine'
+
+    map_data = load_data(map_file_path)
+    peak_ids = load_assigned_peaks(ids_file_path)
+    start_time = time.perf_counter()
+    result = bootstrap_positions(map_data, peak_ids, n_replicas, time_budget, sigma, min_distance, threshold_factor,
+                                 refine=refine, workers=workers)
+    estimator = 'refined' if refine else 'integer-pixel'
+    print(f"{estimator} detect_peaks (sigma={sigma}, min_distance={min_distance}, threshold_factor={threshold_factor}): "
+          f"{int(np.nanmax(result['n_replicas']))} replicas in {time.perf_counter() - start_time:.1f} s, "
+          f"median std {np.nanmedian(result['std_x']):.2e} (x), {np.nanmedian(result['std_y']):.2e} (y)")
+    save_assigned_peaks(peak_ids, output_file_path, result, map_data)
+    print(f"Position uncertainties saved to {output_file_path}")
+
+if __name__ == "__main__":
+    main()
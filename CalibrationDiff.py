@@ -0,0 +1,162 @@
+import os
+import sys
+import csv
+import numpy as np
+from scipy.spatial import cKDTree
+
+from PeakIDAssigner import N_pix, load_peaks, load_assigned_peaks
+
+def diff_ids(old_ids, new_ids, swap_fraction=0.5):
+    # Join two ID tables on (IDx, IDy); all outputs are indexed [id_y][id_x]
+    old_valid = ~np.isnan(old_ids[:, :, 0])
+    new_valid = ~np.isnan(new_ids[:, :, 0])
+    delta = new_ids - old_ids
+    result = {
+        'dx': delta[:, :, 0],
+        'dy': delta[:, :, 1],
+        'displacement': np.linalg.norm(delta, axis=2),
+        'new': new_valid & ~old_valid,
+        'lost': old_valid & ~new_valid,
+        'matched_id': np.full((N_pix, N_pix, 2), -1, dtype=int),
+        'swap': np.zeros((N_pix, N_pix), dtype=bool),
+    }
+    if not old_valid.any() or not new_valid.any():
+        return result
+
+    # A crystal whose new position sits on a different crystal's old position has changed ID
+    old_y, old_x = np.nonzero(old_valid)
+    tree = cKDTree(old_ids[old_y, old_x])
+    pitch = np.median(tree.query(old_ids[old_y, old_x], k=2)[0][:, 1]) if len(old_y) > 1 else np.inf
+    new_y, new_x = np.nonzero(new_valid)
+    dist, nearest = tree.query(new_ids[new_y, new_x], distance_upper_bound=swap_fraction * pitch)
+    found = np.isfinite(dist)
+    result['matched_id'][new_y[found], new_x[found]] = np.column_stack([old_x[nearest[found]], old_y[nearest[found]]])
+    result['swap'][new_y[found], new_x[found]] = (old_x[nearest[found]] != new_x[found]) | (old_y[nearest[found]] != new_y[found])
+    return result
+
+def diff_peaks(old_peaks, new_peaks, max_dist=0.01):
+    # Mutual nearest neighbours within max_dist are the same peak
+    old_tree, new_tree = cKDTree(old_peaks), cKDTree(new_peaks)
+    dist, to_new = new_tree.query(old_peaks, distance_upper_bound=max_dist)
+    _, to_old = old_tree.query(new_peaks, distance_upper_bound=max_dist)
+    found = np.isfinite(dist)
+    old_index = np.nonzero(found)[0]
+    mutual = to_old[to_new[found]] == old_index
+    old_index, new_index = old_index[mutual], to_new[found][mutual]
+    lost = np.ones(len(old_peaks), dtype=bool)
+    lost[old_index] = False
+    new = np.ones(len(new_peaks), dtype=bool)
+    new[new_index] = False
+    return old_index, new_index, lost, new
+
+def save_id_diff(result, output_file_path):
+    with open(output_file_path, "w") as f:
+        f.write("IDx,IDy,dx,dy,displacement,status,matchedIDx,matchedIDy\n")
+        for id_x in range(N_pix):
+            for id_y in range(N_pix):
+                if result['new'][id_y][id_x]:
+                    status = 'new'
+                elif result['lost'][id_y][id_x]:
+                    status = 'lost'
+                elif result['swap'][id_y][id_x]:
+                    status = 'swap'
+                else:
+                    status = ''
+                matched_x, matched_y = result['matched_id'][id_y][id_x]
+                f.write(f"{id_x},{id_y},{result['dx'][id_y][id_x]},{result['dy'][id_y][id_x]},"
+                        f"{result['displacement'][id_y][id_x]},{status},{matched_x},{matched_y}\n")
+
+def save_peak_diff(old_peaks, new_peaks, matches, output_file_path):
+    old_index, new_index, lost, new = matches
+    with open(output_file_path, "w") as f:
+        f.write("x_old,y_old,x_new,y_new,displacement,status\n")
+        for i, j in zip(old_index, new_index):
+            f.write(f"{old_peaks[i][0]},{old_peaks[i][1]},{new_peaks[j][0]},{new_peaks[j][1]},"
+                    f"{np.linalg.norm(new_peaks[j] - old_peaks[i])},\n")
+        for i in np.nonzero(lost)[0]:
+            f.write(f"{old_peaks[i][0]},{old_peaks[i][1]},nan,nan,nan,lost\n")
+        for j in np.nonzero(new)[0]:
+            f.write(f"nan,nan,{new_peaks[j][0]},{new_peaks[j][1]},nan,new\n")
+
+# History store: a directory with index.csv (one row per calibration, in time order) and
+# positions.npy of shape (N_pix, N_pix, T, 2), so one crystal's history is a contiguous read.
+
+def load_history_index(store_dir):
+    index_path = os.path.join(store_dir, 'index.csv')
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def build_history(store_dir, ids_file_paths):
+    os.makedirs(store_dir, exist_ok=True)
+    index = load_history_index(store_dir)
+    known = {row['path'] for row in index}
+    added = sorted({os.path.abspath(p) for p in ids_file_paths} - known, key=os.path.getmtime)
+    if not added:
+        return index
+
+    positions_path = os.path.join(store_dir, 'positions.npy')
+    old_count = len(index)
+    # Old and new calibrations are merged in mtime order, so a file indexed late still lands in its place
+    entries = [(float(row['mtime']), row, t) for t, row in enumerate(index)]
+    entries += [(os.path.getmtime(path), {'label': os.path.splitext(os.path.basename(path))[0], 'path': path,
+                                          'mtime': os.path.getmtime(path)}, path) for path in added]
+    entries.sort(key=lambda entry: entry[0])
+    old_positions = np.load(positions_path, mmap_mode='r') if old_count else None
+    tmp_path = os.path.join(store_dir, 'positions.tmp.npy')
+    positions = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                          shape=(N_pix, N_pix, len(entries), 2))
+    for t, (_, _, source) in enumerate(entries):
+        positions[:, :, t] = old_positions[:, :, source] if isinstance(source, int) else load_assigned_peaks(source)
+    positions.flush()
+    del positions, old_positions
+    os.replace(tmp_path, positions_path)
+    index = [row for _, row, _ in entries]
+
+    with open(os.path.join(store_dir, 'index.csv'), "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['label', 'path', 'mtime'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(index)
+    return index
+
+def crystal_drift(store_dir, id_x, id_y):
+    # Positions of one crystal across all indexed calibrations and displacement from the first one seen
+    index = load_history_index(store_dir)
+    history = np.array(np.load(os.path.join(store_dir, 'positions.npy'), mmap_mode='r')[id_y, id_x], dtype=float)
+    valid = np.nonzero(~np.isnan(history[:, 0]))[0]
+    reference = history[valid[0]] if len(valid) else np.full(2, np.nan)
+    return [row['label'] for row in index], history, np.linalg.norm(history - reference, axis=1)
+
+def main():
+    usage = ('Usage: python CalibrationDiff.py ids <old_ids.csv> <new_ids.csv> <output.csv>\n'
+             '       python CalibrationDiff.py peaks <old_peaks.csv> <new_peaks.csv> <output.csv>\n'
+             '       python CalibrationDiff.py index <store_dir> <ids.csv> [<ids.csv> ...]\n'
+             '       python CalibrationDiff.py drift <store_dir> <IDx> <IDy>')
+    if len(sys.argv) < 4:
+        print(usage)
+        return
+    mode = sys.argv[1]
+    if mode == 'ids' and len(sys.argv) > 4:
+        result = diff_ids(load_assigned_peaks(sys.argv[2]), load_assigned_peaks(sys.argv[3]))
+        save_id_diff(result, sys.argv[4])
+        print(f"New: {result['new'].sum()}, lost: {result['lost'].sum()}, swapped: {result['swap'].sum()}, "
+              f"max displacement: {np.nanmax(result['displacement']):.4g}")
+    elif mode == 'peaks' and len(sys.argv) > 4:
+        old_peaks, new_peaks = load_peaks(sys.argv[2]), load_peaks(sys.argv[3])
+        matches = diff_peaks(old_peaks, new_peaks)
+        save_peak_diff(old_peaks, new_peaks, matches, sys.argv[4])
+        print(f"Matched: {len(matches[0])}, lost: {matches[2].sum()}, new: {matches[3].sum()}")
+    elif mode == 'index':
+        index = build_history(sys.argv[2], sys.argv[3:])
+        print(f"{len(index)} calibrations indexed in {sys.argv[2]}")
+    elif mode == 'drift' and len(sys.argv) > 4:
+        labels, history, drift = crystal_drift(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        print("label,Posix,Posiy,drift")
+        for label, (x, y), d in zip(labels, history, drift):
+            print(f"{label},{x},{y},{d}")
+    else:
+        print(usage)
+
+if __name__ == "__main__":
+    main()
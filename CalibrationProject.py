@@ -0,0 +1,240 @@
+import os
+import io
+import sys
+import json
+import time
+import struct
+import zipfile
+import numpy as np
+
+# A calibration project is one uncompressed zip (.calib) holding
+#   map.npy                 the flood map as saved by dat2npy.py (load with .T like load_data)
+#   pyramid/<level>.npy     2^level block-mean downsampled copies of map.npy
+#   peaks/<version>.npy     detected / edited peaks, (n, 2) normalized x, y
+#   ids/<version>.npy       assigned IDs, (N_pix, N_pix, 2) indexed [id_y][id_x]
+#   params/<version>.json   detection / assignment parameters
+#   history/<version>.json  one entry per saved edit
+# Sections are append-only: saving a section adds a new version, the highest version is current,
+# and older versions are the edit history. Arrays are stored so they can be memory-mapped in place.
+
+PROJECT_EXTENSION = '.calib'
+SECTIONS = ['peaks', 'ids', 'params', 'metrics']
+JSON_SECTIONS = ['params', 'metrics', 'history']
+
+def is_project(file_path):
+    return str(file_path).endswith(PROJECT_EXTENSION)
+
+def downsample(data, factor=2):
+    height, width = (data.shape[0] // factor) * factor, (data.shape[1] // factor) * factor
+    blocks = np.asarray(data[:height, :width]).reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float64).astype(data.dtype, copy=False)
+
+def build_pyramid(data, levels=3, min_size=256):
+    pyramid = []
+    for _ in range(levels):
+        if min(data.shape) // 2 < min_size:
+            break
+        data = downsample(data)
+        pyramid.append(data)
+    return pyramid
+
+def _write_npy(archive, name, array):
+    with archive.open(name, 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+def _write_json(archive, name, value):
+    archive.writestr(name, json.dumps(value))
+
+def create_project(project_path, map_data, peaks=None, peak_ids=None, params=None, levels=3, tool='CalibrationProject'):
+    # map_data in file orientation, i.e. exactly what dat2npy.py saves
+    with zipfile.ZipFile(project_path, 'w', zipfile.ZIP_STORED) as archive:
+        _write_npy(archive, 'map.npy', map_data)
+        for level, data in enumerate(build_pyramid(map_data, levels), start=1):
+            _write_npy(archive, f'pyramid/{level}.npy', data)
+    project = CalibrationProject(project_path)
+    for section, value in [('peaks', peaks), ('ids', peak_ids), ('params', params)]:
+        if value is not None:
+            project.save_section(section, value, tool=tool, note='initial')
+    return project
+
+class CalibrationProject:
+    def __init__(self, project_path):
+        self.path = project_path
+        self._cache = {}
+        self._read_index()
+
+    def _read_index(self):
+        with zipfile.ZipFile(self.path) as archive:
+            self._infos = {info.filename: info for info in archive.infolist()}
+        self.mtime = os.path.getmtime(self.path)
+
+    def versions(self, section):
+        prefix = section + '/'
+        return sorted(int(os.path.splitext(name[len(prefix):])[0]) for name in self._infos if name.startswith(prefix))
+
+    def _member(self, section, version=None):
+        versions = self.versions(section)
+        if not versions:
+            return None
+        version = versions[-1] if version is None else version
+        extension = '.json' if section in JSON_SECTIONS else '.npy'
+        return f'{section}/{version:04d}{extension}'
+
+    def _load_npy(self, name):
+        # Stored members are memory-mapped straight out of the zip file
+        info = self._infos[name]
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.path) as archive:
+                return np.load(io.BytesIO(archive.read(name)))
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                         order='F' if fortran_order else 'C')
+
+    def _load_json(self, name):
+        with zipfile.ZipFile(self.path) as archive:
+            return json.loads(archive.read(name))
+
+    def _get(self, name):
+        if name not in self._cache:
+            self._cache[name] = self._load_json(name) if name.endswith('.json') else self._load_npy(name)
+        return self._cache[name]
+
+    @property
+    def map_data(self):
+        # Same orientation as load_data in PeakDetector / PeakIDAssigner
+        return self._get('map.npy').T
+
+    def pyramid(self, level):
+        if level == 0:
+            return self.map_data
+        return self._get(f'pyramid/{level}.npy').T
+
+    def pyramid_levels(self):
+        return [0] + self.versions('pyramid')
+
+    def section(self, section, version=None):
+        name = self._member(section, version)
+        return None if name is None else self._get(name)
+
+    def require(self, section):
+        # Latest version of a section the caller cannot do without, e.g. the peaks a tool is asked to load
+        value = self.section(section)
+        if value is None:
+            raise ValueError(f"project has no '{section}' section")
+        return value
+
+    @property
+    def peaks(self):
+        return self.section('peaks')
+
+    @property
+    def peak_ids(self):
+        return self.section('ids')
+
+    @property
+    def params(self):
+        return self.section('params') or {}
+
+    @property
+    def metrics(self):
+        # {name: (N_pix, N_pix) array} saved with the ids, e.g. by CrystalMetrics or Bootstrap
+        return {name: np.array(values, dtype=float) for name, values in (self.section('metrics') or {}).items()}
+
+    def history(self):
+        return [self._get(self._member('history', version)) for version in self.versions('history')]
+
+    def save_section(self, section, value, tool='', note=''):
+        if section not in SECTIONS:
+            raise ValueError(f"Unknown project section: {section}")
+        version = (self.versions(section) or [0])[-1] + 1
+        history_version = (self.versions('history') or [0])[-1] + 1
+        name = f'{section}/{version:04d}' + ('.json' if section in JSON_SECTIONS else '.npy')
+        # Appending keeps earlier members (and any open memmaps of them) untouched
+        with zipfile.ZipFile(self.path, 'a', zipfile.ZIP_STORED) as archive:
+            if section == 'metrics':
+                # NaN is written as the JSON extension NaN, which json.loads reads back
+                _write_json(archive, name, {key: np.asarray(values, dtype=float).tolist() for key, values in value.items()})
+            elif section == 'params':
+                _write_json(archive, name, value)
+            else:
+                _write_npy(archive, name, np.asarray(value, dtype=float))
+            _write_json(archive, f'history/{history_version:04d}.json',
+                        {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'tool': tool,
+                         'section': section, 'version': version, 'note': note})
+        self._read_index()
+        return version
+
+def ids_table(peak_ids):
+    # Columns of the save_assigned_peaks table, ready for pd.DataFrame
+    id_x, id_y = np.meshgrid(np.arange(len(peak_ids)), np.arange(len(peak_ids)), indexing='ij')
+    positions = np.asarray(peak_ids)[id_y, id_x]
+    missing = np.isnan(positions).any(axis=2)
+    return {'IDx': id_x.ravel(), 'IDy': id_y.ravel(),
+            'Posix': positions[:, :, 0].ravel(), 'Posiy': positions[:, :, 1].ravel(),
+            'accuracy': np.where(missing, 'miss', '').ravel()}
+
+def ids_from_table(table, n_pix):
+    # Inverse of ids_table for an edited table (e.g. a DataFrame); 'miss'/'hole' rows stay NaN
+    id_x = np.asarray(table['IDx'], dtype=float)
+    id_y = np.asarray(table['IDy'], dtype=float)
+    positions = np.column_stack([np.asarray(table['Posix'], dtype=float), np.asarray(table['Posiy'], dtype=float)])
+    accuracy = np.asarray(table['accuracy'], dtype=object) if 'accuracy' in table else np.full(len(id_x), '')
+    keep = (~np.isnan(positions).any(axis=1) & ~np.isin(accuracy, ['miss', 'hole'])
+            & (id_x >= 0) & (id_x < n_pix) & (id_y >= 0) & (id_y < n_pix))
+    peak_ids = np.full((n_pix, n_pix, 2), np.nan)
+    peak_ids[id_y[keep].astype(int), id_x[keep].astype(int)] = positions[keep]
+    return peak_ids
+
+_open_projects = {}
+
+def open_project(project_path, map_data=None, tool='CalibrationProject'):
+    # Tools share one CalibrationProject per file so sections are loaded only once per process.
+    # A missing project is created from map_data (load_data orientation, rows = y) when a saving tool
+    # has a map to put in it.
+    project_path = os.path.abspath(project_path)
+    if not os.path.exists(project_path):
+        if map_data is None:
+            raise FileNotFoundError(f"{project_path} does not exist. Create it with "
+                                    f"'python CalibrationProject.py {project_path} <map.npy>' or save from a tool with a map loaded")
+        _open_projects[project_path] = create_project(project_path, np.asarray(map_data).T, tool=tool)
+    project = _open_projects.get(project_path)
+    if project is None or os.path.getmtime(project_path) != project.mtime:
+        project = CalibrationProject(project_path)
+        _open_projects[project_path] = project
+    return project
+
+def main():
+    if len(sys.argv) < 3:
+        print('Usage: python CalibrationProject.py <project.calib> <map.npy> [peaks.csv] [ids.csv]')
+        print('       python CalibrationProject.py <project.calib> --info')
+        return
+    project_path = sys.argv[1]
+    if sys.argv[2] == '--info':
+        project = open_project(project_path)
+        print(f"Map: {project.map_data.shape} {project.map_data.dtype}, pyramid levels: {project.pyramid_levels()}")
+        for section in SECTIONS:
+            print(f"{section}: versions {project.versions(section)}")
+        for entry in project.history():
+            print(f"{entry['time']} {entry['tool']} {entry['section']} v{entry['version']} {entry['note']}")
+        return
+
+    from PeakIDAssigner import load_peaks, load_assigned_peaks
+    map_data = np.load(sys.argv[2], mmap_mode='r')
+    peaks = load_peaks(sys.argv[3]) if len(sys.argv) > 3 else None
+    peak_ids = load_assigned_peaks(sys.argv[4]) if len(sys.argv) > 4 else None
+    create_project(project_path, map_data, peaks, peak_ids)
+    print(f"Project saved to {project_path}")
+
+if __name__ == "__main__":
+    main()
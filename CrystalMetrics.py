@@ -0,0 +1,113 @@
+import sys
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from PeakIDAssigner import N_pix, load_data, load_assigned_peaks, save_assigned_peaks
+
+# pv_xm/pv_xp are toward IDx-1/IDx+1, pv_ym/pv_yp toward IDy-1/IDy+1
+METRIC_NAMES = ['height', 'fwhm_x', 'fwhm_y', 'pv_xm', 'pv_xp', 'pv_ym', 'pv_yp', 'pv_min', 'spacing']
+
+NEIGHBOURS = {'xm': (0, -1), 'xp': (0, 1), 'ym': (-1, 0), 'yp': (1, 0)}  # (d_id_y, d_id_x)
+
+def to_pixels(peak_ids, shape):
+    height, width = shape
+    return (peak_ids[..., 1] + 1) / 2 * height, (peak_ids[..., 0] + 1) / 2 * width  # rows, cols
+
+def peak_heights(map_data, rows, cols, window=2):
+    # Maximum of a (2*window+1)^2 patch around every peak, gathered in one fancy-indexing pass
+    height, width = map_data.shape
+    offsets = np.arange(-window, window + 1)
+    r = np.clip(np.rint(rows).astype(int)[:, None, None] + offsets[None, :, None], 0, height - 1)
+    c = np.clip(np.rint(cols).astype(int)[:, None, None] + offsets[None, None, :], 0, width - 1)
+    return map_data[r, c].max(axis=(1, 2))
+
+def half_width(profiles, half_max, step):
+    # Distance from the centre sample to the first crossing below half_max, linearly interpolated
+    below = profiles < half_max[:, None]
+    first = np.argmax(below, axis=1)
+    found = below[np.arange(len(profiles)), first] & (first > 0)
+    first = np.maximum(first, 1)
+    inner = profiles[np.arange(len(profiles)), first - 1]
+    outer = profiles[np.arange(len(profiles)), first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = (inner - half_max) / (inner - outer)
+    return np.where(found, (first - 1 + frac) * step, np.nan)
+
+def fwhm(map_data, rows, cols, heights, radii, n_samples=32):
+    # radii: profile length along columns (x) and rows (y) in pixels
+    half_max = heights / 2
+    result = []
+    for (d_row, d_col), radius in zip([(0, 1), (1, 0)], radii):
+        t = np.linspace(0, radius, n_samples)
+        step = t[1] - t[0]
+        widths = 0
+        for sign in (1, -1):
+            r = rows[:, None] + sign * d_row * t[None, :]
+            c = cols[:, None] + sign * d_col * t[None, :]
+            profiles = map_coordinates(map_data, [r.ravel(), c.ravel()], order=1, mode='nearest').reshape(r.shape)
+            widths = widths + half_width(profiles, half_max, step)
+        result.append(widths)
+    return result  # fwhm along columns (x), rows (y) in pixels
+
+def valleys(map_data, rows_a, cols_a, rows_b, cols_b, n_samples=32):
+    t = np.linspace(0, 1, n_samples)[None, :]
+    r = rows_a[:, None] + (rows_b - rows_a)[:, None] * t
+    c = cols_a[:, None] + (cols_b - cols_a)[:, None] * t
+    profiles = map_coordinates(map_data, [r.ravel(), c.ravel()], order=1, mode='nearest').reshape(r.shape)
+    return profiles.min(axis=1)
+
+def crystal_metrics(map_data, peak_ids, window=2, n_samples=32):
+    shape = map_data.shape
+    valid = ~np.isnan(peak_ids[:, :, 0])
+    metrics = {name: np.full((N_pix, N_pix), np.nan) for name in METRIC_NAMES}
+    if not valid.any():
+        return metrics
+
+    rows, cols = to_pixels(peak_ids, shape)
+    heights = np.full((N_pix, N_pix), np.nan)
+    heights[valid] = peak_heights(map_data, rows[valid], cols[valid], window)
+    metrics['height'] = heights
+
+    # Peak-to-valley and spacing toward each lattice neighbour, one batch per direction
+    spacings = []
+    for name, (d_id_y, d_id_x) in NEIGHBOURS.items():
+        shifted = np.full((N_pix, N_pix, 2), np.nan)
+        dst = (slice(max(0, -d_id_y), N_pix - max(0, d_id_y)), slice(max(0, -d_id_x), N_pix - max(0, d_id_x)))
+        src = (slice(max(0, d_id_y), N_pix - max(0, -d_id_y)), slice(max(0, d_id_x), N_pix - max(0, -d_id_x)))
+        shifted[dst] = peak_ids[src]
+        pair = valid & ~np.isnan(shifted[:, :, 0])
+        n_rows, n_cols = to_pixels(shifted, shape)
+        neighbour_heights = np.full((N_pix, N_pix), np.nan)
+        neighbour_heights[dst] = heights[src]
+
+        valley = valleys(map_data, rows[pair], cols[pair], n_rows[pair], n_cols[pair], n_samples)
+        pv = np.full((N_pix, N_pix), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pv[pair] = (heights[pair] + neighbour_heights[pair]) / 2 / valley
+        metrics[f'pv_{name}'] = pv
+        spacings.append(np.linalg.norm(shifted - peak_ids, axis=2))
+
+    metrics['pv_min'] = np.fmin.reduce([metrics[f'pv_{name}'] for name in NEIGHBOURS])
+    metrics['spacing'] = np.fmin.reduce(spacings)
+
+    # FWHM profiles reach out to half the typical spacing, expressed in normalized units
+    pitch = np.nanmedian(metrics['spacing']) if np.isfinite(metrics['spacing']).any() else 2 / N_pix
+    radii = (pitch / 2 * shape[1] / 2, pitch / 2 * shape[0] / 2)
+    fwhm_x, fwhm_y = fwhm(map_data, rows[valid], cols[valid], heights[valid], radii, n_samples)
+    metrics['fwhm_x'][valid] = fwhm_x * 2 / shape[1]
+    metrics['fwhm_y'][valid] = fwhm_y * 2 / shape[0]
+    return metrics  # each metric[id_y][id_x]
+
+def main():
+    if len(sys.argv) < 4:
+        print('Usage: python CrystalMetrics.py <map.npy> <ids.csv> <output.csv>')
+        return
+    map_file_path, ids_file_path, output_file_path = sys.argv[1:4]
+    map_data = load_data(map_file_path)
+    peak_ids = load_assigned_peaks(ids_file_path)
+    metrics = crystal_metrics(map_data, peak_ids)
+    save_assigned_peaks(peak_ids, output_file_path, metrics, map_data)
+    print(f"Crystal metrics saved to {output_file_path}")
+
+if __name__ == "__main__":
+    main()
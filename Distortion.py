@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import map_coordinates
+
+from PeakIDAssigner import N_pix, load_data, load_assigned_peaks
+from EventMapper import open_events
+
+# The ID table samples the detector distortion: crystal (IDx, IDy) should sit at the centre of
+# its cell on a regular grid (ideal_positions) but is seen at (Posix, Posiy). fit_field fits a smooth
+# map between the two, field_grid tabulates it once on a coarse grid, and every map pixel or event
+# is then corrected by bilinear lookups in that grid instead of evaluating the fit itself.
+#   forward grid: rectified (ideal) position -> measured position, used to resample flood maps
+#   inverse grid: measured position -> rectified position, used for events
+# All positions are normalized (x, y) in [-1, 1] as in the peak and ID files.
+
+def ideal_positions(n_pix=N_pix):
+    # [id_y][id_x] -> (x, y); IDy grows with decreasing y as in PeakIDAssigner
+    centres = (np.arange(n_pix) + 0.5) * 2 / n_pix - 1
+    ideal_x, ideal_y = np.meshgrid(centres, -centres)
+    return np.stack([ideal_x, ideal_y], axis=2)
+
+def fit_field(source, target, method='polynomial', degree=5, smoothing=0.0):
+    # Smooth map source -> target from matching (n, 2) point sets; returns a function of (m, 2) points
+    if method == 'polynomial':
+        vander = np.polynomial.polynomial.polyvander2d(source[:, 0], source[:, 1], [degree, degree])
+        exponents = np.add.outer(np.arange(degree + 1), np.arange(degree + 1)).ravel()
+        vander = vander[:, exponents <= degree]  # total degree <= degree
+        coefficients, *_ = np.linalg.lstsq(vander, target, rcond=None)
+
+        def field(points):
+            terms = np.polynomial.polynomial.polyvander2d(points[:, 0], points[:, 1], [degree, degree])
+            return terms[:, exponents <= degree] @ coefficients
+        return field
+    if method == 'tps':
+        from scipy.interpolate import RBFInterpolator
+        return RBFInterpolator(source, target, kernel='thin_plate_spline', smoothing=smoothing)
+    raise ValueError(f"Unknown distortion model: {method}")
+
+def fit_distortion(peak_ids, method='polynomial', degree=5, smoothing=0.0):
+    valid = ~np.isnan(peak_ids[:, :, 0])
+    ideal, measured = ideal_positions(len(peak_ids))[valid], peak_ids[valid]
+    forward = fit_field(ideal, measured, method, degree, smoothing)
+    inverse = fit_field(measured, ideal, method, degree, smoothing)
+    residual = np.sqrt(np.mean(np.sum((forward(ideal) - measured) ** 2, axis=1)))
+    return forward, inverse, residual
+
+def field_grid(field, grid_size=257):
+    # field tabulated on grid_size x grid_size nodes spanning [-1, 1]^2, grid[row = y][col = x] -> (x, y)
+    nodes = np.linspace(-1, 1, grid_size)
+    grid_x, grid_y = np.meshgrid(nodes, nodes)
+    values = field(np.column_stack([grid_x.ravel(), grid_y.ravel()]))
+    return values.reshape(grid_size, grid_size, 2).astype(np.float32)
+
+def sample_grid(grid, x, y):
+    # Bilinear lookup of every component of a (size, size, k) grid at normalized coordinates x, y
+    scale = (len(grid) - 1) / 2
+    coordinates = [(np.ravel(y) + 1) * scale, (np.ravel(x) + 1) * scale]
+    return tuple(map_coordinates(grid[:, :, k], coordinates, order=1, mode='nearest').reshape(np.shape(x))
+                 for k in range(grid.shape[2]))
+
+def jacobian_grid(grid):
+    # |det| of the field's Jacobian at every grid node, i.e. measured area per rectified area
+    step = 2 / (len(grid) - 1)
+    dx_dy, dx_dx = np.gradient(grid[:, :, 0], step)
+    dy_dy, dy_dx = np.gradient(grid[:, :, 1], step)
+    return np.abs(dx_dx * dy_dy - dx_dy * dy_dx).astype(np.float32)[:, :, None]
+
+def rectify_map(map_data, forward_grid, output_shape=None, order=1, preserve_counts=True,
+                block_rows=256, n_threads=None):
+    # map_data and the result are in load_data orientation (rows = y). Each output pixel samples the
+    # map where the forward field puts it; with preserve_counts the value is scaled by the local
+    # Jacobian so the total number of counts in a region is kept.
+    height, width = output_shape or map_data.shape
+    source_height, source_width = map_data.shape
+    output = np.empty((height, width), dtype=np.float32)
+    jacobian = jacobian_grid(forward_grid) if preserve_counts else None
+    area = (source_width * source_height) / (width * height)
+    cols = 2 * np.arange(width) / width - 1
+
+    def work(start):
+        rows = 2 * np.arange(start, min(start + block_rows, height)) / height - 1
+        grid_x, grid_y = np.meshgrid(cols, rows)
+        x, y = sample_grid(forward_grid, grid_x, grid_y)
+        block = map_coordinates(map_data, [(y + 1) / 2 * source_height, (x + 1) / 2 * source_width],
+                                order=order, mode='constant', cval=0.0, output=np.float32)
+        if jacobian is not None:
+            block *= sample_grid(jacobian, grid_x, grid_y)[0] * area
+        output[start:start + len(rows)] = block
+
+    with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+        list(pool.map(work, range(0, height, block_rows)))
+    return output
+
+def rectify_events(inverse_grid, events):
+    # Rectified (x, y) of (n, 2+) normalized events; crystal cells are then a regular N_pix grid
+    x, y = sample_grid(inverse_grid, events[:, 0], events[:, 1])
+    return np.column_stack([x, y])
+
+def rectify_event_file(inverse_grid, events, output_file_path, chunk_size=1 << 22, n_threads=None):
+    n_events = len(events)
+    rectified = np.lib.format.open_memmap(output_file_path, mode='w+', dtype=np.float32, shape=(n_events, 2))
+
+    def work(start):
+        rectified[start:start + chunk_size] = rectify_events(inverse_grid, np.asarray(events[start:start + chunk_size, :2]))
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+        list(pool.map(work, range(0, n_events, chunk_size)))
+    elapsed = time.perf_counter() - start_time
+    rectified.flush()
+    rate = n_events / elapsed if elapsed > 0 else float('inf')
+    print(f'Rectified {n_events} events in {elapsed:.2f} s ({rate:.3g} events/s)')
+    return rectified
+
+def main():
+    usage = ('Usage: python Distortion.py fit <ids.csv> <output_dir> [polynomial | tps]\n'
+             '       python Distortion.py map <grid_dir> <map.npy> <output.npy>\n'
+             '       python Distortion.py events <grid_dir> <events.npy | events.bin> <output.npy>')
+    if len(sys.argv) < 4:
+        print(usage)
+        return
+    mode = sys.argv[1]
+    if mode == 'fit':
+        method = sys.argv[4] if len(sys.argv) > 4 else 'polynomial'
+        forward, inverse, residual = fit_distortion(load_assigned_peaks(sys.argv[2]), method)
+        os.makedirs(sys.argv[3], exist_ok=True)
+        np.save(os.path.join(sys.argv[3], 'forward_grid.npy'), field_grid(forward))
+        np.save(os.path.join(sys.argv[3], 'inverse_grid.npy'), field_grid(inverse))
+        print(f"RMS fit residual: {residual:.4g} (normalized units). Grids saved to {sys.argv[3]}")
+    elif mode == 'map' and len(sys.argv) > 4:
+        forward_grid = np.load(os.path.join(sys.argv[2], 'forward_grid.npy'))
+        rectified = rectify_map(load_data(sys.argv[3]), forward_grid)
+        np.save(sys.argv[4], rectified.T)  # file orientation, like dat2npy.py
+        print(f"Rectified map saved to {sys.argv[4]}")
+    elif mode == 'events' and len(sys.argv) > 4:
+        inverse_grid = np.load(os.path.join(sys.argv[2], 'inverse_grid.npy'))
+        rectify_event_file(inverse_grid, open_events(sys.argv[3]), sys.argv[4])
+        print(f"Rectified events saved to {sys.argv[4]}")
+    else:
+        print(usage)
+
+if __name__ == "__main__":
+    main()
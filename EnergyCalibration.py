@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from PeakIDAssigner import N_pix
+from EventMapper import load_lut, open_events, map_events
+
+# Per-crystal energy calibration from list-mode (x, y, energy) events: every event is mapped to its
+# crystal through the position LUT (EventMapper), all N_pix^2 spectra are filled in one bincount over
+# crystal * n_bins + energy bin, and the photopeaks of all crystals are fitted together.
+
+FIT_NAMES = ['photopeak', 'fwhm', 'resolution', 'gain', 'counts']
+
+def default_energy_range(events, sample_size=1 << 20, quantile=99.5, margin=1.25):
+    return float(np.percentile(np.asarray(events[:sample_size, 2]), quantile)) * margin
+
+def energy_histograms(lut, events, n_bins=256, e_max=None, chunk_size=1 << 22, n_threads=None):
+    # spectra[id_y][id_x][bin] for energies in [0, e_max)
+    e_max = e_max or default_energy_range(events)
+    n_threads = n_threads or os.cpu_count()
+    size = N_pix * N_pix * n_bins
+
+    def work(start):
+        chunk = np.asarray(events[start:start + chunk_size])
+        crystal = map_events(lut, chunk[:, :2]).astype(np.intp)
+        energy_bin = np.floor(chunk[:, 2] * (n_bins / e_max)).astype(np.intp)
+        keep = (crystal >= 0) & (energy_bin >= 0) & (energy_bin < n_bins)
+        return np.bincount(crystal[keep] * n_bins + energy_bin[keep], minlength=size)
+
+    spectra = np.zeros(size, dtype=np.int64)
+    start_time = time.perf_counter()
+    # Keep at most two chunks per thread in flight so memory stays bounded
+    with ThreadPoolExecutor(n_threads) as pool:
+        in_flight = []
+        for start in range(0, len(events), chunk_size):
+            in_flight.append(pool.submit(work, start))
+            if len(in_flight) >= 2 * n_threads:
+                spectra += in_flight.pop(0).result()
+        for future in in_flight:
+            spectra += future.result()
+    elapsed = time.perf_counter() - start_time
+    rate = len(events) / elapsed if elapsed > 0 else float('inf')
+    print(f'Histogrammed {len(events)} events in {elapsed:.2f} s ({rate:.3g} events/s)')
+    return spectra.reshape(N_pix, N_pix, n_bins), e_max
+
+def fit_photopeaks(spectra, low_cut=0.2, resolution=0.12, n_iterations=3, min_counts=100):
+    # Gaussian photopeak of every spectrum at once (Caruana's method): log counts around the peak are
+    # fitted with a parabola by weighted least squares, weights = counts, as one batch of 3x3 systems.
+    # Peaks are searched above low_cut * n_bins; the fit window is +-1 sigma for the given resolution
+    # (FWHM / position) and is re-centred on the fitted mean each iteration. Results are in bins.
+    shape = spectra.shape[:-1]
+    spectra = spectra.reshape(-1, spectra.shape[-1]).astype(np.float64)
+    n_spectra, n_bins = spectra.shape
+    bins = np.arange(n_bins)
+    first = int(low_cut * n_bins)
+    centre = (first + np.argmax(spectra[:, first:], axis=1)).astype(np.float64)
+    counts = spectra.sum(axis=1)
+    mean = sigma = amplitude = np.full(n_spectra, np.nan)
+    for _ in range(n_iterations):
+        half_width = np.maximum(2, resolution * centre / 2.355)
+        offsets = bins[None, :] - centre[:, None]
+        weights = np.where((np.abs(offsets) <= half_width[:, None]) & (spectra > 0), spectra, 0)
+        log_counts = np.log(np.maximum(spectra, 1))
+        powers = offsets[:, :, None] ** np.arange(5)[None, None, :]
+        moments = np.einsum('sb,sbk->sk', weights, powers)
+        rhs = np.einsum('sb,sbk->sk', weights * log_counts, powers[:, :, :3])
+        normal = moments[:, np.array([[0, 1, 2], [1, 2, 3], [2, 3, 4]])]
+        solvable = np.abs(np.linalg.det(normal)) > 1e-12 * np.maximum(moments[:, 0], 1) ** 3
+        coefficients = np.full((n_spectra, 3), np.nan)
+        coefficients[solvable] = np.linalg.solve(normal[solvable], rhs[solvable][:, :, None])[:, :, 0]
+        a, b, c = coefficients.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            good = solvable & (c < 0)
+            mean = np.where(good, centre - b / (2 * c), np.nan)
+            sigma = np.where(good, np.sqrt(-1 / (2 * c)), np.nan)
+            amplitude = np.where(good, np.exp(a - b * b / (4 * c)), np.nan)
+        inside = good & (mean > first) & (mean < n_bins - 1)
+        centre = np.where(inside, mean, centre)
+    bad = ~np.isfinite(mean) | (mean <= first) | (mean >= n_bins - 1) | (counts < min_counts)
+    mean, sigma, amplitude = [np.where(bad, np.nan, v).reshape(shape) for v in (mean, sigma, amplitude)]
+    return mean, sigma, amplitude
+
+def calibrate(spectra, e_max, reference_energy=511.0, **fit_options):
+    # Per-crystal results indexed [id_y][id_x]; photopeak and fwhm in input energy units,
+    # resolution as FWHM / photopeak, gain converts input units to reference_energy units
+    mean, sigma, _ = fit_photopeaks(spectra, **fit_options)
+    bin_width = e_max / spectra.shape[-1]
+    photopeak = (mean + 0.5) * bin_width
+    fwhm = 2.355 * sigma * bin_width
+    return {'photopeak': photopeak, 'fwhm': fwhm, 'resolution': fwhm / photopeak,
+            'gain': reference_energy / photopeak, 'counts': spectra.sum(axis=-1)}
+
+def save_calibration(results, output_file_path):
+    with open(output_file_path, "w") as f:
+        f.write(",".join(["IDx,IDy"] + FIT_NAMES) + "\n")
+        for id_x in range(N_pix):
+            for id_y in range(N_pix):
+                f.write(f"{id_x},{id_y}" + "".join(f",{results[name][id_y][id_x]}" for name in FIT_NAMES) + "\n")
+
+def main():
+    if len(sys.argv) < 4:
+        print('Usage: python EnergyCalibration.py <lut.npy | ids.csv> <events.npy | events.bin> <output_dir> [reference_energy]')
+        return
+    lut_file_path, events_file_path, output_dir = sys.argv[1:4]
+    reference_energy = float(sys.argv[4]) if len(sys.argv) > 4 else 511.0
+    os.makedirs(output_dir, exist_ok=True)
+
+    lut = load_lut(lut_file_path)
+    events = open_events(events_file_path, n_columns=3)
+    spectra, e_max = energy_histograms(lut, events)
+    np.save(os.path.join(output_dir, 'spectra.npy'), spectra)
+
+    start_time = time.perf_counter()
+    results = calibrate(spectra, e_max, reference_energy)
+    print(f"Fitted {np.count_nonzero(np.isfinite(results['photopeak']))} photopeaks in {time.perf_counter() - start_time:.2f} s, "
+          f"median resolution {np.nanmedian(results['resolution']) * 100:.1f} %")
+    save_calibration(results, os.path.join(output_dir, 'energy.csv'))
+    print(f"Energy calibration saved to {os.path.join(output_dir, 'energy.csv')}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+
+from PeakIDAssigner import N_pix, load_assigned_peaks
+
+def build_lut(peak_ids, lut_size=1024, max_dist=np.inf):
+    # Each LUT cell gets the crystal whose peak is nearest to the cell centre
+    ids_y, ids_x = np.nonzero(~np.isnan(peak_ids[:, :, 0]))
+    tree = cKDTree(peak_ids[ids_y, ids_x])
+    centers = (np.arange(lut_size) + 0.5) * 2 / lut_size - 1
+    grid_x, grid_y = np.meshgrid(centers, centers)
+    dist, nearest = tree.query(np.column_stack([grid_x.ravel(), grid_y.ravel()]),
+                               distance_upper_bound=max_dist)
+    found = np.isfinite(dist)
+    lut = np.full(lut_size * lut_size, -1, dtype=np.int16)
+    lut[found] = (ids_y * N_pix + ids_x)[nearest[found]]
+    return lut.reshape(lut_size, lut_size)  # lut[iy][ix]
+
+def load_lut(lut_file_path, lut_size=1024):
+    if lut_file_path.endswith('.csv'):
+        return build_lut(load_assigned_peaks(lut_file_path), lut_size)
+    return np.load(lut_file_path)
+
+def open_events(events_file_path, n_columns=2, dtype=np.float32):
+    # .npy files are memory-mapped as saved, raw list-mode dumps as n_columns of dtype
+    if events_file_path.endswith('.npy'):
+        return np.load(events_file_path, mmap_mode='r')
+    return np.memmap(events_file_path, dtype=dtype, mode='r').reshape(-1, n_columns)
+
+def map_events(lut, events):
+    # events[:, 0], events[:, 1] are normalized (x, y) in [-1, 1]; -1 marks events outside the LUT
+    lut_size = lut.shape[0]
+    scale = lut_size / 2
+    ix = np.floor((events[:, 0] + 1) * scale).astype(np.intp)
+    iy = np.floor((events[:, 1] + 1) * scale).astype(np.intp)
+    inside = (ix >= 0) & (ix < lut_size) & (iy >= 0) & (iy < lut_size)
+    crystal = lut.ravel()[np.clip(iy, 0, lut_size - 1) * lut_size + np.clip(ix, 0, lut_size - 1)]
+    crystal[~inside] = -1
+    return crystal
+
+def map_event_file(lut, events, output_file_path=None, chunk_size=1 << 22, n_threads=None):
+    n_threads = n_threads or os.cpu_count()
+    n_events = len(events)
+    mapped = None
+    if output_file_path is not None:
+        mapped = np.lib.format.open_memmap(output_file_path, mode='w+', dtype=lut.dtype, shape=(n_events,))
+
+    def work(start):
+        crystal = map_events(lut, events[start:start + chunk_size, :2])
+        if mapped is not None:
+            mapped[start:start + len(crystal)] = crystal
+        return np.bincount(crystal[crystal >= 0], minlength=N_pix * N_pix)
+
+    counts = np.zeros(N_pix * N_pix, dtype=np.int64)
+    starts = range(0, n_events, chunk_size)
+    start_time = time.perf_counter()
+    # Keep at most two chunks per thread in flight so memory stays bounded
+    with ThreadPoolExecutor(n_threads) as pool:
+        in_flight = []
+        for start in starts:
+            in_flight.append(pool.submit(work, start))
+            if len(in_flight) >= 2 * n_threads:
+                counts += in_flight.pop(0).result()
+        for future in in_flight:
+            counts += future.result()
+    elapsed = time.perf_counter() - start_time
+
+    if mapped is not None:
+        mapped.flush()
+    rate = n_events / elapsed if elapsed > 0 else float('inf')
+    print(f'Mapped {n_events} events in {elapsed:.2f} s ({rate:.3g} events/s)')
+    return counts.reshape(N_pix, N_pix)  # counts[id_y][id_x]
+
+def save_counts(counts, output_file_path):
+    with open(output_file_path, "w") as f:
+        f.write("IDx,IDy,counts\n")
+        for id_x in range(N_pix):
+            for id_y in range(N_pix):
+                f.write(f'{id_x},{id_y},{counts[id_y][id_x]}\n')
+
+def main():
+    if len(sys.argv) < 4:
+        print('Usage: python EventMapper.py <lut.npy | ids.csv> <events.npy | events.bin> <output_dir> [n_threads]')
+        return
+    lut_file_path, events_file_path, output_dir = sys.argv[1:4]
+    n_threads = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    os.makedirs(output_dir, exist_ok=True)
+
+    lut = load_lut(lut_file_path)
+    if lut_file_path.endswith('.csv'):
+        np.save(os.path.join(output_dir, 'lut'), lut)
+
+    events = open_events(events_file_path)
+    counts = map_event_file(lut, events, os.path.join(output_dir, 'crystal_ids.npy'), n_threads=n_threads)
+    save_counts(counts, os.path.join(output_dir, 'counts.csv'))
+    print(f"Crystal counts saved to {os.path.join(output_dir, 'counts.csv')}")
+
+if __name__ == "__main__":
+    main()
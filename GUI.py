@@ -7,6 +7,11 @@ from tkinter import ttk, filedialog, messagebox
 import pandas as pd
 import os
 
+from PeakIDAssigner import N_pix
+from CalibrationProject import is_project, open_project, ids_table, ids_from_table
+from TiledMap import is_tiled, load_map
+from background import BackgroundRunner
+
 class PeakPositionAdjuster:
     def __init__(self, master):
         self.master = master
@@ -58,6 +63,9 @@ class PeakPositionAdjuster:
         
         self.save_btn = ttk.Button(control_panel, text="Save", command=self.save_positions)
         self.save_btn.pack(side=tk.LEFT, padx=5)
+
+        # Loading and saving run in the background with progress and cancel
+        self.runner = BackgroundRunner(self.master)
         
         # Initialize plot elements
         self.colorbar = None
@@ -88,32 +96,51 @@ class PeakPositionAdjuster:
     def load_map_data(self):
         file_path = filedialog.askopenfilename(
             title="Open Map Data",
-            filetypes=[("DAT files", "*.dat"), ("All files", "*.*")],
+            filetypes=[("DAT files", "*.dat"), ("Tiled maps", "*.tmap"), ("Calibration projects", "*.calib"), ("All files", "*.*")],
             initialdir=os.getcwd()
         )
         
         if file_path:
-            try:
-                self.data = self.load_dat_image(file_path)
-                self.initial_plot = True
-                self.plot_data()
-                self.master.title(f"Peak Position Adjuster - {os.path.basename(file_path)}")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load map data: {str(e)}")
+            self.runner.submit('map', self.read_map_data, file_path, label="Loading map data",
+                               on_done=lambda data: self.on_map_data_read(data, file_path),
+                               on_error=lambda e: messagebox.showerror("Error", f"Failed to load map data: {str(e)}"))
+
+    def read_map_data(self, file_path):
+        # Runs on the worker thread
+        if is_project(file_path):
+            return open_project(file_path).map_data
+        if is_tiled(file_path):
+            return load_map(file_path).T
+        return self.load_dat_image(file_path)
+
+    def on_map_data_read(self, data, file_path):
+        self.data = data
+        self.initial_plot = True
+        self.plot_data()
+        self.master.title(f"Peak Position Adjuster - {os.path.basename(file_path)}")
 
     def load_peak_data(self):
         file_path = filedialog.askopenfilename(
             title="Open Peak Data",
-            filetypes=[("CSV files", "*.csv"), ("All files", "*.*")],
+            filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib"), ("All files", "*.*")],
             initialdir=os.getcwd()
         )
         
         if file_path:
-            try:
-                self.peak_positions = pd.read_csv(file_path)
-                self.plot_data()
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load peak data: {str(e)}")
+            self.runner.submit('peaks', self.read_peak_data, file_path, label="Loading peak data",
+                               on_done=self.on_peak_data_read,
+                               on_error=lambda e: messagebox.showerror("Error", f"Failed to load peak data: {str(e)}"))
+
+    @staticmethod
+    def read_peak_data(file_path):
+        # Runs on the worker thread
+        if is_project(file_path):
+            return pd.DataFrame(ids_table(open_project(file_path).require('ids')))
+        return pd.read_csv(file_path)
+
+    def on_peak_data_read(self, peak_positions):
+        self.peak_positions = peak_positions
+        self.plot_data()
         
     def load_dat_image(self, dat_path):
         try:
@@ -240,18 +267,25 @@ class PeakPositionAdjuster:
             file_path = filedialog.asksaveasfilename(
                 title="Save Peak Positions",
                 defaultextension=".csv",
-                filetypes=[("CSV files", "*.csv"), ("All files", "*.*")],
+                filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib"), ("All files", "*.*")],
                 initialdir=os.getcwd()
             )
             if file_path:
-                try:
-                    self.peak_positions.to_csv(file_path, index=False)
-                    messagebox.showinfo("Success", f"Peak positions saved to {file_path}")
-                except Exception as e:
-                    messagebox.showerror("Error", f"Failed to save peak positions: {str(e)}")
+                self.runner.submit('save', self.write_positions, self.peak_positions.copy(), file_path, self.data,
+                                   label="Saving peak positions",
+                                   on_done=lambda _: messagebox.showinfo("Success", f"Peak positions saved to {file_path}"),
+                                   on_error=lambda e: messagebox.showerror("Error", f"Failed to save peak positions: {str(e)}"))
         else:
             messagebox.showwarning("Warning", "No peak data to save")
 
+    @staticmethod
+    def write_positions(peak_positions, file_path, map_data=None):
+        # Runs on the worker thread; map_data starts a new project if file_path does not exist
+        if is_project(file_path):
+            open_project(file_path, map_data, tool='PeakPositionAdjuster').save_section('ids', ids_from_table(peak_positions, N_pix), tool='PeakPositionAdjuster')
+        else:
+            peak_positions.to_csv(file_path, index=False)
+
 def main():
     root = tk.Tk()
     app = PeakPositionAdjuster(root)
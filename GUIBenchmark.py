@@ -0,0 +1,226 @@
+import sys
+import time
+import numpy as np
+import tkinter as tk
+import matplotlib
+matplotlib.use('Agg')  # pyplot figures stay off screen; the editors put them on their own Tk canvases
+import matplotlib.pyplot as plt
+import pandas as pd
+from matplotlib.backend_bases import MouseEvent, KeyEvent
+
+from PeakIDAssigner import N_pix
+from CalibrationProject import ids_table
+from benchmark import synthetic_map
+
+# Redraw latency of the editors, driven without user input; the benchmark calls the same handlers Tk
+# events would.
+# With a display, each editor is built through its own __init__ on a withdrawn Tk window, and every
+# timed step ends with update(), so the time includes the idle draw and the blit into the Tk canvas.
+# Without a display (no X server, e.g. CI), Tk cannot start, so each editor is created without its
+# Tk __init__ (object.__new__). It gets a bare Agg figure, stand-ins for the toolbar, runner and Tk
+# variables, and the state __init__ sets. Agg draws synchronously, so the time is the figure work
+# without the blit.
+#     python GUIBenchmark.py [1000 | 4000 | all] [repeat]
+#
+# p50 on one core without a display (headless, i.e. without the Tk blit), 1000x1000 map repeat 3 /
+# 4000x4000 map repeat 1:
+#     editor                operation        1000      4000
+#     PeakEditor            load             0.7 s     8.2 s
+#     PeakEditor            zoom / click     0.4 s     3.9-5.1 s
+#     PeakIDEditor          load ids         3.5 s     9.4 s
+#     PeakIDEditor          zoom             2.2 s     5.8 s
+#     PeakPositionAdjuster  load ids         4.8 s    14.9 s
+#     PeakPositionAdjuster  drag move        2.3 s    10.4 s  (per motion event)
+#     PeakPositionAdjuster  zoom             2.2 s     6.7 s
+# Every interaction redraws the full-resolution pcolormesh and, in the ID editors, ~2000 text labels.
+
+class Toolbar:
+    mode = ''
+
+class Master:
+    def title(self, *args):
+        pass
+
+    def update(self):
+        pass
+
+class Variable:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+class SyncRunner:
+    # BackgroundRunner stand-in: runs the job at once and calls on_done in the same thread
+    def submit(self, key, func, *args, on_done=None, on_error=None, label='', with_progress=False):
+        result = func(*args)
+        if on_done is not None:
+            on_done(result)
+
+    def shutdown(self):
+        pass
+
+# State each editor's __init__ sets besides the Tk widgets, for the headless stand-ins
+HEADLESS_STATE = {
+    'PeakEditor': lambda: dict(map_data=None, peaks=None, scatter=None, colorbar=None, pcolormesh=None,
+                               rectangle_selector=None, lasso_selector=None, undo_stack=[],
+                               region_operation=Variable('off'), region_shape=Variable('rectangle')),
+    'PeakIDEditor': lambda: dict(map_data=None, peaks=None, peak_ids=None, scatter=None, colorbar=None,
+                                 pcolormesh=None, texts=[], show_ids=True),
+    'PeakPositionAdjuster': lambda: dict(data=None, peak_positions=None, texts=[], markers=[], dragging=None,
+                                         current_scale=1.0, initial_plot=True, image_width=1000, image_height=1000,
+                                         colorbar=None, scatter=None, pcolormesh=None, text_visible=True,
+                                         cursor_label={}),
+}
+
+def make_editor(root, cls):
+    # The editor's own __init__ on a hidden top-level window of root, or a headless one if root is None
+    if root is not None:
+        master = tk.Toplevel(root)
+        master.withdraw()
+        return cls(master)
+    editor = object.__new__(cls)
+    editor.master = Master()
+    editor.fig, editor.ax = plt.subplots(figsize=(10, 8), dpi=100)
+    editor.canvas = editor.fig.canvas
+    editor.toolbar = Toolbar()
+    editor.runner = SyncRunner()
+    for name, value in HEADLESS_STATE[cls.__name__]().items():
+        setattr(editor, name, value)
+    return editor
+
+def mouse_event(editor, name, x, y, button=1, key=None):
+    # Event at normalized data coordinates (x, y), as the canvas would deliver it
+    px, py = editor.ax.transData.transform((x, y))
+    return MouseEvent(name, editor.canvas, px, py, button=button, key=key)
+
+def key_event(editor, key):
+    return KeyEvent('key_press_event', editor.canvas, key)
+
+def synthetic_tables(n_pix=N_pix, seed=0):
+    # 2025-peak table and matching ID table on a slightly jittered lattice
+    rng = np.random.default_rng(seed)
+    centres = (np.arange(n_pix) + 1.5) * 2 / (n_pix + 2) - 1
+    grid_x, grid_y = np.meshgrid(centres, -centres)
+    peak_ids = np.stack([grid_x, grid_y], axis=2) + rng.normal(0, 0.002, (n_pix, n_pix, 2))
+    peaks = pd.DataFrame(peak_ids.reshape(-1, 2), columns=['x', 'y'])
+    return peaks, pd.DataFrame(ids_table(peak_ids))
+
+def zoom(editor, step):
+    # Alternate between a 4x zoom around the centre and the full view
+    limits = (-0.25, 0.25) if step % 2 == 0 else (-1, 1)
+    editor.ax.set_xlim(limits)
+    editor.ax.set_ylim(limits)
+    editor.canvas.draw()
+
+def timed(results, name, editor, func, *args):
+    # update() runs the idle draws the handler scheduled, so they count toward its time
+    start = time.perf_counter()
+    func(*args)
+    editor.master.update()
+    results.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+def close(editor):
+    editor.runner.shutdown()
+    plt.close(editor.fig)
+    if not isinstance(editor.master, Master):
+        editor.master.destroy()
+
+def bench_peak_editor(root, map_data, peaks, peak_ids, repeat):
+    from PeakEditor import PeakEditor
+    results = {}
+    for step in range(repeat):
+        editor = make_editor(root, PeakEditor)
+        editor.region_operation.set('delete')
+        timed(results, 'load', editor, editor.on_files_read, (map_data, peaks.copy()))
+        timed(results, 'zoom', editor, zoom, editor, step)
+        timed(results, 'colorbar', editor, editor.update_colorbar)
+        timed(results, 'add click', editor, editor.on_click, mouse_event(editor, 'button_press_event', 0.01, 0.02, 1, 'control'))
+        timed(results, 'remove click', editor, editor.on_click, mouse_event(editor, 'button_press_event', 0.01, 0.02, 3, 'control'))
+        timed(results, 'region delete', editor, editor.apply_region, [(-0.5, -0.5), (0, -0.5), (0, 0), (-0.5, 0)])
+        timed(results, 'undo', editor, editor.on_key_press, key_event(editor, 'z'))
+        close(editor)
+    return results
+
+def bench_peak_id_editor(root, map_data, peaks, peak_ids, repeat):
+    from PeakIDEditor import PeakIDEditor
+    results = {}
+    for step in range(repeat):
+        editor = make_editor(root, PeakIDEditor)
+        timed(results, 'load map', editor, editor.on_map_read, map_data)
+        timed(results, 'load peaks', editor, editor.on_peaks_read, peaks.copy())
+        timed(results, 'load ids', editor, editor.on_peak_ids_read, peak_ids.copy())
+        timed(results, 'zoom', editor, zoom, editor, step)
+        timed(results, 'toggle labels', editor, editor.on_key_press, key_event(editor, 'T'))
+        timed(results, 'colorbar', editor, editor.on_key_press, key_event(editor, 'u'))
+        close(editor)
+    return results
+
+def bench_position_adjuster(root, map_data, peaks, peak_ids, repeat, drag_steps=5):
+    from GUI import PeakPositionAdjuster
+    results = {}
+    for step in range(repeat):
+        editor = make_editor(root, PeakPositionAdjuster)
+        timed(results, 'load map', editor, editor.on_map_data_read, map_data, 'synthetic')
+        timed(results, 'load ids', editor, editor.on_peak_data_read, peak_ids.copy())
+        timed(results, 'zoom', editor, zoom, editor, step)
+        timed(results, 'toggle labels', editor, editor.on_key_press, key_event(editor, 't'))
+        timed(results, 'colorbar', editor, editor.on_key_press, key_event(editor, 'u'))
+        x, y = peak_ids.loc[0, 'Posix'], peak_ids.loc[0, 'Posiy']
+        editor.ax.set_xlim(-1, 1)
+        editor.ax.set_ylim(-1, 1)
+        timed(results, 'drag press', editor, editor.on_press, mouse_event(editor, 'button_press_event', x, y))
+        for i in range(drag_steps):
+            timed(results, 'drag move', editor, editor.on_motion, mouse_event(editor, 'motion_notify_event', x + 0.002 * i, y))
+        timed(results, 'drag release', editor, editor.on_release, mouse_event(editor, 'button_release_event', x, y))
+        close(editor)
+    return results
+
+EDITORS = {
+    'PeakEditor': bench_peak_editor,
+    'PeakIDEditor': bench_peak_id_editor,
+    'PeakPositionAdjuster': bench_position_adjuster,
+}
+
+def report(editor_name, size, results):
+    for name, times in results.items():
+        p50, p90, p99 = np.percentile(times, [50, 90, 99])
+        print(f"{editor_name:<22}{size:>6}  {name:<16}{len(times):>5}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{max(times):>10.1f}")
+
+def open_display():
+    # Hidden Tk root, or None when there is no display to open one on
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"No display ({e}); running headless on Agg figures, without the Tk blit")
+        return None
+    root.withdraw()
+    return root
+
+def run(sizes=(1000, 4000), repeat=5):
+    root = open_display()
+    peaks, peak_ids = synthetic_tables()
+    print(f"{'editor':<22}{'map':>6}  {'operation':<16}{'n':>5}{'p50 [ms]':>10}{'p90 [ms]':>10}{'p99 [ms]':>10}{'max [ms]':>10}")
+    try:
+        for size in sizes:
+            map_data = synthetic_map(size).T
+            for editor_name, bench in EDITORS.items():
+                report(editor_name, size, bench(root, map_data, peaks, peak_ids, repeat))
+    finally:
+        plt.close('all')
+        if root is not None:
+            root.destroy()
+
+def main():
+    sizes = {'1000': (1000,), '4000': (4000,), 'all': (1000, 4000)}
+    if len(sys.argv) > 1 and sys.argv[1] not in sizes:
+        print('Usage: python GUIBenchmark.py [1000 | 4000 | all] [repeat]')
+        return
+    run(sizes[sys.argv[1] if len(sys.argv) > 1 else 'all'], int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from CalibrationProject import is_project, open_project
+from dat2npy import dat_shape, iter_dat_chunks
+from TiledMap import is_tiled, open_tiled
+
+# Sums or averages flood maps (.npy as saved by dat2npy.py, .tmap, .calib projects, or raw .dat dumps) without
+# loading them whole: the output is split into stripes of rows, and each worker thread adds every input's
+# part of its stripe, read in chunks, into a float64 stripe buffer that it then writes straight into the
+# output. Memory is one float64 output in stripes plus a chunk per thread, however many maps are summed.
+# The output is saved in file orientation like dat2npy.py, so load_data / detect_peaks read it directly.
+
+def open_map(map_file_path):
+    # Flat read-only view of a map in file orientation; .dat files are streamed instead
+    if is_project(map_file_path):
+        return open_project(map_file_path).map_data.T
+    return np.load(map_file_path, mmap_mode='r')
+
+def map_shape(map_file_path):
+    if is_tiled(map_file_path):
+        return open_tiled(map_file_path).shape
+    return dat_shape(map_file_path) if map_file_path.endswith('.dat') else open_map(map_file_path).shape
+
+def iter_map_chunks(map_file_path, chunk_size=1 << 22):
+    # (offset, flat float64 values) chunks of any supported map
+    if map_file_path.endswith('.dat'):
+        yield from iter_dat_chunks(map_file_path, chunk_size)
+        return
+    if is_tiled(map_file_path):
+        # One band of tile rows at a time; a full-width band is contiguous in the flat map
+        tiled = open_tiled(map_file_path)
+        for row in range(0, tiled.shape[0], tiled.tile_size):
+            yield row * tiled.shape[1], tiled.read(row, row + tiled.tile_size, cache=False).reshape(-1).astype(np.float64)
+        return
+    data = open_map(map_file_path).reshape(-1)
+    for offset in range(0, len(data), chunk_size):
+        yield offset, np.asarray(data[offset:offset + chunk_size], dtype=np.float64)
+
+def iter_stripe_chunks(map_file_path, start, stop, chunk_size=1 << 22):
+    # (offset, flat float64 values) chunks of the flat range [start, stop) of a map. A .tmap decompresses
+    # only the bands of tile rows the range covers; a .dat dump has no index, so it is parsed up to stop.
+    if is_tiled(map_file_path):
+        tiled = open_tiled(map_file_path)
+        width, size = tiled.shape[1], tiled.tile_size
+        for row in range(start // width // size * size, -(-stop // width), size):
+            values = tiled.read(row, row + size, cache=False).reshape(-1)
+            first, last = max(start - row * width, 0), min(stop - row * width, len(values))
+            yield row * width + first, values[first:last].astype(np.float64)
+        return
+    if not map_file_path.endswith('.dat'):
+        data = open_map(map_file_path).reshape(-1)
+        for offset in range(start, stop, chunk_size):
+            yield offset, np.asarray(data[offset:min(offset + chunk_size, stop)], dtype=np.float64)
+        return
+    count = 0
+    for offset, values in iter_dat_chunks(map_file_path, chunk_size):
+        count = offset + len(values)
+        if count > start:
+            first, last = max(start - offset, 0), min(stop - offset, len(values))
+            yield offset + first, values[first:last]
+        if count >= stop:
+            return
+    if count < stop:
+        raise ValueError(f"{map_file_path} has {count} values, expected at least {stop}")
+
+def map_total(map_file_path, chunk_size=1 << 22):
+    return sum(values.sum() for _, values in iter_map_chunks(map_file_path, chunk_size))
+
+def sum_maps(map_file_paths, output_file_path=None, average=False, normalize=False, dtype=None,
+             chunk_size=1 << 22, n_threads=None):
+    # normalize: scale every map to the mean total counts of the inputs before adding
+    # (needs one extra streaming pass to get the totals)
+    # dtype: output type; uint32 for plain sums of integer maps, float32 otherwise
+    shapes = {map_shape(path) for path in map_file_paths}
+    if len(shapes) != 1:
+        raise ValueError(f"Maps have different shapes: {sorted(shapes)}")
+    shape = shapes.pop()
+    n_threads = max(1, min(n_threads or os.cpu_count() or 1, shape[0]))
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        scales = np.ones(len(map_file_paths))
+        if normalize:
+            totals = np.array(list(pool.map(lambda path: map_total(path, chunk_size), map_file_paths)))
+            if (totals <= 0).any():
+                raise ValueError("Cannot normalize a map with no counts")
+            scales = totals.mean() / totals
+        if average:
+            scales = scales / len(map_file_paths)
+
+        if dtype is None:
+            integer_inputs = all(not path.endswith('.dat') and np.issubdtype(
+                open_tiled(path).dtype if is_tiled(path) else open_map(path).dtype, np.integer) for path in map_file_paths)
+            dtype = np.uint32 if integer_inputs and not (average or normalize) else np.float32
+        if output_file_path is None:
+            output = np.empty(shape, dtype=dtype)
+        else:
+            output = np.lib.format.open_memmap(output_file_path, mode='w+', dtype=dtype, shape=shape)
+        flat_output = output.reshape(-1)
+
+        def add_stripe(row_start, row_stop):
+            # One worker's rows of the output; the stripes do not overlap, so no locking
+            start, stop = row_start * shape[1], row_stop * shape[1]
+            stripe = np.zeros(stop - start, dtype=np.float64)
+            for path, scale in zip(map_file_paths, scales):
+                for offset, values in iter_stripe_chunks(path, start, stop, chunk_size):
+                    if scale != 1:
+                        values = values * scale
+                    stripe[offset - start:offset - start + len(values)] += values
+            flat_output[start:stop] = stripe
+
+        bounds = np.linspace(0, shape[0], n_threads + 1).astype(int)
+        for future in [pool.submit(add_stripe, row_start, row_stop) for row_start, row_stop in zip(bounds[:-1], bounds[1:])]:
+            future.result()
+
+    if output_file_path is not None:
+        output.flush()
+    return output
+
+def main():
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) < 2 or any(flag not in ('--mean', '--normalize') for flag in flags):
+        print('Usage: python MapSum.py <output.npy> <map.npy | map.tmap | map.dat | project.calib> [...] [--mean] [--normalize]')
+        return
+    output_file_path, map_file_paths = args[0], args[1:]
+    result = sum_maps(map_file_paths, output_file_path, average='--mean' in flags, normalize='--normalize' in flags)
+    print(f"{'Averaged' if '--mean' in flags else 'Summed'} {len(map_file_paths)} maps "
+          f"({result.dtype}, total {result.sum(dtype=np.float64):.6g}) into {output_file_path}")
+
+if __name__ == "__main__":
+    main()
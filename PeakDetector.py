@@ -1,18 +1,30 @@
+import time
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter
-from skimage.feature import peak_local_max
-import tkinter as tk
-from tkinter import filedialog
-from matplotlib.widgets import RectangleSelector
+from collections import OrderedDict
+from scipy.ndimage import gaussian_filter, uniform_filter, maximum_filter
+from scipy.spatial import cKDTree
+
+# matplotlib, tkinter and skimage are imported on first use so detection can run headless
+
+from CalibrationProject import is_project, open_project
+from TiledMap import open_map_view
 
 class MapSelector:
-    def __init__(self, data):
+    def __init__(self, data, live=False, sigma=1, threshold_factor=1.1, min_distance=5):
+        # live: re-detect on every region or slider change and show the peaks over the map
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import RectangleSelector, Slider
         self.data = data
         self.fig, self.ax = plt.subplots(figsize=(10, 8))
-        self.im = self.ax.imshow(self.data, cmap='viridis', origin='lower', aspect='auto')
+        # A tiled map (TiledMap.MapView) is shown as a block-mean preview in full-resolution pixel coordinates
+        image = data.preview()[0] if hasattr(data, 'preview') else data
+        self.im = self.ax.imshow(image, cmap='viridis', origin='lower', aspect='auto',
+                                 extent=(-0.5, data.shape[1] - 0.5, -0.5, data.shape[0] - 0.5))
         self.ax.set_title('Select region for peak detection')
         self.selected_region = None
+        self.sigma = sigma
+        self.threshold_factor = threshold_factor
         
         self.rs = RectangleSelector(self.ax, self.line_select_callback,
                                     useblit=True,
@@ -22,27 +34,429 @@ class MapSelector:
                                     interactive=True)
         
         plt.colorbar(self.im, label='Intensity')
+
+        self.live = live
+        if live:
+            self.detector = LiveDetector(data, min_distance=min_distance)
+            self.scatter = self.ax.scatter([], [], c='r', s=5)
+            self.fig.subplots_adjust(bottom=0.2)
+            self.sigma_slider = Slider(self.fig.add_axes([0.15, 0.08, 0.6, 0.03]), 'sigma', 0.5, 5.0,
+                                       valinit=sigma, valstep=0.25)
+            self.threshold_slider = Slider(self.fig.add_axes([0.15, 0.03, 0.6, 0.03]), 'threshold', 1.0, 3.0,
+                                           valinit=threshold_factor, valstep=0.05)
+            self.sigma_slider.on_changed(self.on_parameter_changed)
+            self.threshold_slider.on_changed(self.on_parameter_changed)
+            # A new region or sigma is smoothed on a worker thread (Tk backends); threshold changes are instant
+            self.runner = None
+            self.pending = None
+            window = getattr(self.fig.canvas.manager, 'window', None)
+            if hasattr(window, 'after'):
+                from background import BackgroundRunner
+                self.runner = BackgroundRunner(window)
+            self.update_peaks()
         plt.show()
 
     def line_select_callback(self, eclick, erelease):
         x1, y1 = int(eclick.xdata), int(eclick.ydata)
         x2, y2 = int(erelease.xdata), int(erelease.ydata)
         self.selected_region = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        if self.live:
+            self.update_peaks()
+
+    def on_parameter_changed(self, _):
+        self.sigma = self.sigma_slider.val
+        self.threshold_factor = self.threshold_slider.val
+        self.update_peaks()
+
+    def update_peaks(self):
+        # Threshold changes and regions over cached tiles are filtered at once; new tiles are smoothed on
+        # a worker thread (Tk backends), and a request already in flight is not submitted again
+        key = (self.selected_region, self.sigma)
+        if self.runner is None or self.detector.is_ready(self.selected_region, self.sigma, self.threshold_factor):
+            self.show_peaks()
+            return
+        if key == self.pending:
+            return
+        self.pending = key
+        self.ax.set_title(f'Detecting peaks (sigma {self.sigma:g})...')
+        self.fig.canvas.draw_idle()
+        self.runner.submit('detect', self.detector.detect, self.selected_region, self.sigma, self.threshold_factor,
+                           label="Detecting peaks", on_done=lambda _: self.on_detected(key))
+
+    def on_detected(self, key):
+        # The sliders may have moved while the worker ran; show the peaks for the current values
+        if key == self.pending:
+            self.pending = None
+        self.update_peaks()
+
+    def show_peaks(self):
+        # Only the scatter overlay is redrawn; the map image is left alone
+        start = time.perf_counter()
+        self.peaks = self.detector.detect(self.selected_region, self.sigma, self.threshold_factor)
+        self.scatter.set_offsets(self.peaks[:, ::-1] if len(self.peaks) else np.empty((0, 2)))
+        elapsed = (time.perf_counter() - start) * 1000
+        self.ax.set_title(f'{len(self.peaks)} peaks (sigma {self.sigma:g}, threshold {self.threshold_factor:g}, {elapsed:.0f} ms)')
+        self.fig.canvas.draw_idle()
+
+    def get_peaks(self):
+        # The live peaks for the final region and parameters; only smoothed here if the last update had
+        # not finished when the window was closed
+        return self.detector.detect(self.selected_region, self.sigma, self.threshold_factor)
 
     def get_selected_region(self):
         return self.selected_region
 
-def load_data(input_file_path):
-    return np.load(input_file_path).T
+    def get_parameters(self):
+        return {'sigma': self.sigma, 'threshold_factor': self.threshold_factor}
+
+class LiveDetector:
+    # Incremental version of detect_peaks(engine='gaussian', threshold_mode='global') for interactive use.
+    # The map is split into tiles; for each (tile, sigma) the tile plus a halo is smoothed once and its
+    # local maxima above a floor (the map median) are kept with their smoothed values. A new threshold
+    # only filters the cached candidates, a moved region only computes the tiles not seen before, and the
+    # smoothed region mean for the threshold comes from a summed-area table (see region_mean).
+    # The peaks are those of detect_peaks on the region up to the smoothing within 4 sigma of the region
+    # border (detect_peaks reflects the region there, the tiles see the real neighbours).
+    def __init__(self, data, min_distance=5, tile_size=512, max_tiles=1024):
+        self.data = data
+        self.min_distance = min_distance
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.candidates = OrderedDict()  # (tile_row, tile_col, sigma) -> (peaks, values, floor), least recently used first
+        self.lock = threading.Lock()  # the cache is filled on worker threads and read on the Tk thread
+        self.sat = None
+        self.floor = None
+
+    def clip_region(self, region):
+        height, width = self.data.shape
+        x1, y1, x2, y2 = region or (0, 0, width, height)
+        return max(0, x1), max(0, y1), min(width, x2), min(height, y2)
+
+    def prepare(self):
+        # Summed-area table and candidate floor, built once from the whole map
+        if self.sat is None:
+            data = np.asarray(self.data)
+            self.floor = float(np.median(data[::4, ::4]))
+            sat = np.zeros((data.shape[0] + 1, data.shape[1] + 1))
+            np.cumsum(np.cumsum(data, axis=0, dtype=np.float64), axis=1, out=sat[1:, 1:])
+            self.sat = sat
+
+    def box_sums(self, r1, r2, c1, c2):
+        # Sums of the boxes [r1, r2) x [c1, c2), broadcast over array arguments
+        sat = self.sat
+        return sat[r2, c2] - sat[r1, c2] - sat[r2, c1] + sat[r1, c1]
+
+    def region_mean(self, region, sigma):
+        # np.mean(gaussian_filter(region, sigma)) as detect_peaks computes it: the region sum, corrected by
+        # the smoothing weights, which differ from 1 only in the border rows and columns (smoothed_mean)
+        self.prepare()
+        x1, y1, x2, y2 = region
+        row_weight = smoothing_weights(y2 - y1, sigma) - 1
+        col_weight = smoothing_weights(x2 - x1, sigma) - 1
+        rows, cols = self.border(y2 - y1, sigma) + y1, self.border(x2 - x1, sigma) + x1
+        total = (self.box_sums(y1, y2, x1, x2)
+                 + row_weight[rows - y1] @ self.box_sums(rows, rows + 1, x1, x2)
+                 + col_weight[cols - x1] @ self.box_sums(y1, y2, cols, cols + 1)
+                 + row_weight[rows - y1] @ self.box_sums(rows[:, None], rows[:, None] + 1, cols[None, :], cols[None, :] + 1)
+                 @ col_weight[cols - x1])
+        return total / ((y2 - y1) * (x2 - x1))
+
+    @staticmethod
+    def border(size, sigma):
+        # Positions within the kernel radius of either end, the only ones whose weight is not 1
+        # (the interior weights are 1 up to rounding, which is not worth a full row/column pass)
+        radius = gaussian_kernel(sigma)[1]
+        return np.union1d(np.arange(min(radius, size)), np.arange(max(size - radius, 0), size))
+
+    def tiles(self, region):
+        x1, y1, x2, y2 = region
+        return [(row, col) for row in range(y1 // self.tile_size, (y2 - 1) // self.tile_size + 1)
+                for col in range(x1 // self.tile_size, (x2 - 1) // self.tile_size + 1)]
+
+    def cached(self, tile_row, tile_col, sigma, threshold):
+        # Cached candidates of a tile if they reach down to threshold, else None
+        with self.lock:
+            entry = self.candidates.get((tile_row, tile_col, sigma))
+            if entry is None or entry[2] > threshold:
+                return None
+            self.candidates.move_to_end((tile_row, tile_col, sigma))
+            return entry
+
+    def tile_candidates(self, tile_row, tile_col, sigma, threshold):
+        from skimage.feature import peak_local_max
+        entry = self.cached(tile_row, tile_col, sigma, threshold)
+        if entry is not None:
+            return entry
+        height, width = self.data.shape
+        halo = int(np.ceil(4 * sigma)) + self.min_distance + 1
+        r1, c1 = tile_row * self.tile_size, tile_col * self.tile_size
+        r2, c2 = min(r1 + self.tile_size, height), min(c1 + self.tile_size, width)
+        pr1, pc1 = max(0, r1 - halo), max(0, c1 - halo)
+        pr2, pc2 = min(height, r2 + halo), min(width, c2 + halo)
+        data = np.asarray(self.data[pr1:pr2, pc1:pc2])
+        smoothed = gaussian_filter(data, sigma=sigma, output=working_dtype(data))
+        # Candidates only above the floor (map median) unless the threshold asks for lower ones
+        floor = min(self.floor, threshold)
+        peaks = peak_local_max(smoothed, min_distance=self.min_distance, threshold_abs=floor, exclude_border=False)
+        values = smoothed[peaks[:, 0], peaks[:, 1]].astype(np.float64)
+        peaks = peaks + [pr1, pc1]
+        core = (peaks[:, 0] >= r1) & (peaks[:, 0] < r2) & (peaks[:, 1] >= c1) & (peaks[:, 1] < c2)
+        entry = peaks[core], values[core], floor
+        with self.lock:
+            self.candidates[(tile_row, tile_col, sigma)] = entry
+            while len(self.candidates) > self.max_tiles:
+                self.candidates.popitem(last=False)
+        return entry
+
+    def is_ready(self, region, sigma, threshold_factor):
+        # True when detect needs no smoothing, i.e. can run on the Tk thread
+        region = self.clip_region(region)
+        if self.sat is None or region[2] <= region[0] or region[3] <= region[1]:
+            return self.sat is not None
+        threshold = self.region_mean(region, sigma) * threshold_factor
+        return all(self.cached(row, col, sigma, threshold) is not None for row, col in self.tiles(region))
+
+    def detect(self, region=None, sigma=1, threshold_factor=1.1):
+        self.prepare()
+        x1, y1, x2, y2 = self.clip_region(region)
+        if x2 <= x1 or y2 <= y1:
+            return np.empty((0, 2), dtype=np.intp)
+        threshold = self.region_mean((x1, y1, x2, y2), sigma) * threshold_factor
+        tiles = [self.tile_candidates(row, col, sigma, threshold) for row, col in self.tiles((x1, y1, x2, y2))]
+        peaks = np.concatenate([peaks for peaks, _, _ in tiles])
+        values = np.concatenate([values for _, values, _ in tiles])
+        # peak_local_max in detect_peaks excludes min_distance at the region border
+        d = self.min_distance
+        inside = ((peaks[:, 0] >= y1 + d) & (peaks[:, 0] < y2 - d) & (peaks[:, 1] >= x1 + d) & (peaks[:, 1] < x2 - d)
+                  & (values > threshold))
+        order = np.argsort(-values[inside], kind='stable')
+        return peaks[inside][order]
+
+def load_data(input_file_path, dtype=None):
+    # dtype=None keeps the stored precision (uint16 / float32 maps stay compact). A .tmap file gives a
+    # lazy TiledMap.MapView, so detect_peaks on a region decompresses only that region.
+    if is_project(input_file_path):
+        data = open_project(input_file_path).map_data
+    else:
+        data = open_map_view(input_file_path)
+    return data if dtype is None else np.asarray(data).astype(dtype, copy=False)
+
+def working_dtype(data):
+    # Smoothing precision for a map: float32 for float32 and small-integer counts, float64 otherwise
+    data_type = np.asarray(data).dtype
+    if data_type == np.float32 or (np.issubdtype(data_type, np.integer) and data_type.itemsize <= 2):
+        return np.float32
+    return np.float64
 
-def detect_peaks(data, region=None, sigma=1, min_distance=5, threshold_factor=1.1):
+def local_statistics(data, window):
+    # Mean and standard deviation over a window x window neighbourhood of every pixel.
+    # uniform_filter is a separable running box sum, so the cost per pixel does not depend on window.
+    data = np.asarray(data, dtype=np.float64)
+    mean = uniform_filter(data, size=window, mode='reflect')
+    mean_sq = uniform_filter(data * data, size=window, mode='reflect')
+    return mean, np.sqrt(np.maximum(mean_sq - mean * mean, 0))
+
+def suppress_close_peaks(peaks, strength, min_distance, p=2):
+    # Greedy non-maximum suppression: strongest first, drop anything within min_distance of a kept peak
+    # (p-norm distance; p=np.inf matches peak_local_max). Resolved in rounds over all close pairs at
+    # once: a peak with no stronger surviving neighbour is kept, and its weaker neighbours are dropped.
+    order = np.argsort(-strength, kind='stable')
+    peaks = peaks[order]
+    pairs = cKDTree(peaks).query_pairs(min_distance, p=p, output_type='ndarray')  # (stronger, weaker)
+    state = np.zeros(len(peaks), dtype=np.int8)  # 0 undecided, 1 kept, -1 dropped
+    while (state == 0).any():
+        pairs = pairs[(state[pairs[:, 0]] != -1) & (state[pairs[:, 1]] != -1)]
+        blocked = np.zeros(len(peaks), dtype=bool)
+        blocked[pairs[:, 1]] = True
+        state[(state == 0) & ~blocked] = 1
+        state[pairs[:, 1][(state[pairs[:, 0]] == 1) & (state[pairs[:, 1]] == 0)]] = -1
+    return peaks[state == 1]
+
+DOG_LEVELS_BELOW = 2  # extra levels below sigma in the first octave of dog_pyramid
+
+def dog_pyramid(data, sigma=1, n_octaves=3, scales_per_octave=3, dtype=None):
+    # Gaussian scale space built incrementally: each level smooths the previous one by the missing
+    # sigma only, and each octave starts from the 2x-decimated level of twice the base sigma.
+    # Returns [(step, gaussians, dogs)] with dogs[i] = gaussians[i] - gaussians[i + 1] (bright blobs > 0).
+    # A blob of sigma peaks on one of the two DoG levels next to the sigma level, so the first octave
+    # starts DOG_LEVELS_BELOW levels below sigma and both have a finer neighbour; its sigma level is
+    # gaussians[DOG_LEVELS_BELOW].
+    dtype = dtype or working_dtype(data)
+    k = 2 ** (1 / scales_per_octave)
+    base = gaussian_filter(data, sigma=sigma / k ** DOG_LEVELS_BELOW, output=dtype)
+    octaves = []
+    for octave in range(n_octaves):
+        below = DOG_LEVELS_BELOW if octave == 0 else 0
+        base_sigma = sigma / k ** below
+        gaussians = [base]
+        for i in range(1, below + scales_per_octave + 3):
+            increment = base_sigma * np.sqrt(k ** (2 * i) - k ** (2 * (i - 1)))
+            gaussians.append(gaussian_filter(gaussians[-1], sigma=increment))
+        gaussians = np.stack(gaussians)
+        octaves.append((2 ** octave, gaussians, gaussians[:-1] - gaussians[1:]))
+        base = gaussians[below + scales_per_octave][::2, ::2]
+        if min(base.shape) < 16:
+            break
+    return octaves
+
+def detect_peaks_dog(data, sigma=1, min_distance=5, threshold_factor=1.1, n_octaves=3, scales_per_octave=3, dtype=None):
+    # Blobs are maxima of the DoG over space and scale at once (3 x footprint x footprint neighbourhood),
+    # and their snapped fine-scale value must exceed the map mean * threshold_factor, as in the
+    # single-sigma engine. Detected blob sigmas run from about sigma up to sigma * 2^n_octaves.
+    octaves = dog_pyramid(data, sigma, n_octaves, scales_per_octave, dtype)
+    fine = octaves[0][1][DOG_LEVELS_BELOW]  # smoothed with sigma itself
+    threshold = np.mean(fine, dtype=np.float64) * threshold_factor
+    candidates, strengths = [], []
+    for step, gaussians, dogs in octaves:
+        distance = max(1, min_distance // step)
+        local_max = dogs == maximum_filter(dogs, size=(3, 2 * distance + 1, 2 * distance + 1), mode='nearest')
+        local_max[[0, -1]] = False  # only scales with a neighbour on both sides
+        scale, rows, cols = np.nonzero(local_max & (dogs > 0))
+        candidates.append(np.column_stack([rows, cols]) * step)
+        strengths.append(dogs[scale, rows, cols].astype(np.float64))
+    candidates = np.concatenate(candidates)
+    strengths = np.concatenate(strengths)
+    if len(candidates) == 0:
+        return np.empty((0, 2), dtype=np.intp)
+
+    # Snap decimated-octave positions to the brightest fine-scale pixel nearby, then merge scales
+    reach = 2 ** (len(octaves) - 1)
+    offsets = np.arange(-reach, reach + 1)
+    rows = np.clip(candidates[:, 0, None, None] + offsets[None, :, None], 0, fine.shape[0] - 1)
+    cols = np.clip(candidates[:, 1, None, None] + offsets[None, None, :], 0, fine.shape[1] - 1)
+    rows, cols = np.broadcast_arrays(rows, cols)
+    best = fine[rows, cols].reshape(len(candidates), -1).argmax(axis=1)
+    candidates = np.column_stack([rows.reshape(len(candidates), -1)[np.arange(len(candidates)), best],
+                                  cols.reshape(len(candidates), -1)[np.arange(len(candidates)), best]])
+    bright = fine[candidates[:, 0], candidates[:, 1]] > threshold
+    return suppress_close_peaks(candidates[bright], strengths[bright], min_distance)
+
+def detect_peaks_gaussian(data, sigma=1, min_distance=5, threshold_factor=1.1,
+                          threshold_mode='global', window=None, k_std=0.0, dtype=None):
+    from skimage.feature import peak_local_max
+    smoothed_data = gaussian_filter(data, sigma=sigma, output=dtype or working_dtype(data))
+    if threshold_mode == 'adaptive':
+        window = window or 10 * min_distance + 1
+        local_mean, local_std = local_statistics(smoothed_data, window)
+        peaks = peak_local_max(smoothed_data, min_distance=min_distance, threshold_abs=np.min(smoothed_data))
+        values = smoothed_data[peaks[:, 0], peaks[:, 1]]
+        local_threshold = local_mean[peaks[:, 0], peaks[:, 1]] * threshold_factor + k_std * local_std[peaks[:, 0], peaks[:, 1]]
+        return peaks[values > local_threshold]
+    threshold = np.mean(smoothed_data, dtype=np.float64) * threshold_factor
+    return peak_local_max(smoothed_data, min_distance=min_distance, threshold_abs=threshold)
+
+def gaussian_kernel(sigma, truncate=4.0):
+    # The 1-D kernel gaussian_filter uses for this sigma
+    radius = int(truncate * sigma + 0.5)
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    return kernel / kernel.sum(), radius
+
+def reflect_index(index, size):
+    # Index into an axis of length size as gaussian_filter's mode='reflect' extends it
+    index = np.where(index < 0, -index - 1, index)
+    return np.where(index >= size, 2 * size - index - 1, index)
+
+def smoothed_mean(data, sigma):
+    # np.mean(gaussian_filter(data, sigma)) without smoothing the map: every output pixel sums the
+    # kernel over its (reflected) neighbours, so each input pixel enters with the total weight it gets
+    # along each axis, which is 1 except within the kernel radius of the edges
+    weights = [smoothing_weights(size, sigma) for size in data.shape]
+    return float(weights[0] @ np.asarray(data, dtype=np.float64) @ weights[1]) / data.size
+
+def smoothing_weights(size, sigma):
+    # Total weight each of size input pixels gets in gaussian_filter's output along one axis
+    kernel, radius = gaussian_kernel(sigma)
+    weight = np.zeros(size)
+    taps = reflect_index(np.arange(size)[:, None] + np.arange(-radius, radius + 1)[None, :], size)
+    np.add.at(weight, taps, np.broadcast_to(kernel, taps.shape))
+    return weight
+
+def smoothed_windows(data, centres, half, sigma, dtype):
+    # gaussian_filter(data, sigma) on (2 * half + 1)^2 windows around each centre only, as a
+    # (n, 2 * half + 1, 2 * half + 1) stack: gather raw patches with the kernel radius as halo (mirrored
+    # at the map edge like mode='reflect') and apply the separable kernel to all patches at once.
+    from numpy.lib.stride_tricks import sliding_window_view
+    kernel, radius = gaussian_kernel(sigma)
+    kernel = kernel.astype(dtype)
+    offsets = np.arange(-half - radius, half + radius + 1)
+    rows = reflect_index(centres[:, 0, None] + offsets[None, :], data.shape[0])
+    cols = reflect_index(centres[:, 1, None] + offsets[None, :], data.shape[1])
+    patches = np.asarray(data[rows[:, :, None], cols[:, None, :]], dtype=dtype)
+    patches = sliding_window_view(patches, len(kernel), axis=1) @ kernel
+    return sliding_window_view(patches, len(kernel), axis=2) @ kernel
+
+def detect_peaks_coarse(data, sigma=1, min_distance=5, threshold_factor=1.1, factor=4, dtype=None, batch_size=256):
+    # Coarse-to-fine version of detect_peaks_gaussian (global threshold): local maxima of the
+    # factor x factor block-mean map are only candidates; each is refined on exactly smoothed
+    # full-resolution windows, re-centred while the maximum sits on the window edge, and then given the
+    # full-resolution threshold, border exclusion and min_distance rules of peak_local_max.
+    from skimage.feature import peak_local_max
+    dtype = dtype or working_dtype(data)
+    # Block means; the last row and column of blocks are partial where the shape is not a multiple of
+    # factor, so crystals at the bottom and right edges still get candidates
+    starts = [np.arange(0, size, factor) for size in data.shape]
+    coarse = np.add.reduceat(np.add.reduceat(data, starts[0], axis=0, dtype=np.float32), starts[1], axis=1)
+    coarse /= np.outer(np.diff(starts[0], append=data.shape[0]), np.diff(starts[1], append=data.shape[1]))
+    coarse = gaussian_filter(coarse, sigma=max(sigma / factor, 0.5))
+    # Candidates only need to beat the mean; the real threshold is applied at full resolution
+    candidates = peak_local_max(coarse, min_distance=max(1, min_distance // factor),
+                                threshold_abs=np.mean(coarse, dtype=np.float64) * min(threshold_factor, 1.0),
+                                exclude_border=False)
+    centres = np.minimum(candidates * factor + factor // 2, np.array(data.shape) - 1)
+    threshold = smoothed_mean(data, sigma) * threshold_factor  # as detect_peaks_gaussian
+
+    half = factor
+    peaks, values = [], []
+    for _ in range(3):
+        if len(centres) == 0:
+            break
+        moved = []
+        for start in range(0, len(centres), batch_size):
+            batch = centres[start:start + batch_size]
+            windows = smoothed_windows(data, batch, half, sigma, dtype).reshape(len(batch), -1)
+            best = windows.argmax(axis=1)
+            row, col = np.divmod(best, 2 * half + 1)
+            position = batch - half + np.column_stack([row, col])
+            edge = (row == 0) | (row == 2 * half) | (col == 0) | (col == 2 * half)
+            peaks.append(position[~edge])
+            values.append(windows[np.arange(len(batch)), best][~edge].astype(np.float64))
+            moved.append(position[edge])
+        centres = np.concatenate(moved)
+    peaks, values = np.concatenate(peaks), np.concatenate(values)
+    if len(peaks) == 0:
+        return np.empty((0, 2), dtype=np.intp)
+    peaks, index = np.unique(peaks, axis=0, return_index=True)
+    values = values[index]
+    keep = ((values > threshold) & (peaks[:, 0] >= min_distance) & (peaks[:, 0] < data.shape[0] - min_distance)
+            & (peaks[:, 1] >= min_distance) & (peaks[:, 1] < data.shape[1] - min_distance))
+    return suppress_close_peaks(peaks[keep], values[keep], min_distance, p=np.inf)
+
+def detect_peaks(data, region=None, sigma=1, min_distance=5, threshold_factor=1.1,
+                 threshold_mode='global', window=None, k_std=0.0, dtype=None,
+                 engine='gaussian', n_octaves=3, scales_per_octave=3, coarse_factor=4):
+    # engine='gaussian': one sigma, then peak_local_max with the threshold_mode below
+    # engine='dog': difference-of-Gaussians scale space from sigma over n_octaves (see detect_peaks_dog);
+    #     only the global threshold applies
+    # engine='coarse': candidates from a coarse_factor-downsampled map, refined at full resolution
+    #     (see detect_peaks_coarse); only the global threshold applies
+    # threshold_mode='global': one threshold, mean of the smoothed map * threshold_factor
+    # threshold_mode='adaptive': each peak must exceed local mean * threshold_factor + k_std * local std,
+    #     taken over a window x window neighbourhood (default 10 * min_distance + 1)
+    # dtype: smoothing precision, by default working_dtype(data); thresholds are always computed in float64
+    # data may be a TiledMap.MapView; only the region is read from it
     if region is not None:
         x1, y1, x2, y2 = region
         data = data[y1:y2, x1:x2]
+    data = np.asarray(data)
     
-    smoothed_data = gaussian_filter(data, sigma=sigma)
-    threshold = np.mean(smoothed_data) * threshold_factor
-    peaks = peak_local_max(smoothed_data, min_distance=min_distance, threshold_abs=threshold)
+    if engine == 'coarse':
+        peaks = detect_peaks_coarse(data, sigma, min_distance, threshold_factor, coarse_factor, dtype)
+    elif engine == 'dog':
+        peaks = detect_peaks_dog(data, sigma, min_distance, threshold_factor, n_octaves, scales_per_octave, dtype)
+    elif engine == 'gaussian':
+        peaks = detect_peaks_gaussian(data, sigma, min_distance, threshold_factor, threshold_mode, window, k_std, dtype)
+    else:
+        raise ValueError(f"Unknown detection engine: {engine}")
     
     if region is not None:
         peaks[:, 0] += y1
@@ -50,22 +464,14 @@ def detect_peaks(data, region=None, sigma=1, min_distance=5, threshold_factor=1.
     
     return peaks
 
-def plot_peaks(data, peaks, title, region=None):
-    plt.figure(figsize=(10, 8))
-    plt.imshow(data, cmap='viridis', origin='lower', aspect='auto')
-    for peak in peaks:
-        y, x = peak
-        plt.plot(x, y, 'r.', markersize=5)
-    
-    if region is not None:
-        x1, y1, x2, y2 = region
-        plt.gca().add_patch(plt.Rectangle((x1, y1), x2-x1, y2-y1, fill=False, edgecolor='white'))
-    
-    plt.title(title)
-    plt.colorbar(label='Intensity')
-    plt.show()
-
-def save_peaks(peaks, output_file_path, map_size):
+def save_peaks(peaks, output_file_path, map_size, map_data=None):
+    # map_data: puts the map into a new project when output_file_path does not exist yet
+    if is_project(output_file_path):
+        norm_x = (2 * peaks[:, 1] / map_size[1]) - 1
+        norm_y = (2 * peaks[:, 0] / map_size[0]) - 1
+        project = open_project(output_file_path, map_data, tool='PeakDetector')
+        project.save_section('peaks', np.column_stack([norm_x, norm_y]), tool='PeakDetector')
+        return
     with open(output_file_path, "w") as f:
         f.write("x,y\n")
         for peak in peaks:
@@ -75,18 +481,22 @@ def save_peaks(peaks, output_file_path, map_size):
             f.write(f"{norm_x},{norm_y}\n")
 
 def select_input_file():
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()  # Hide the main window
     file_path = filedialog.askopenfilename(title="Select input .npy file",
-                                           filetypes=[("NumPy files", "*.npy")])
+                                           filetypes=[("NumPy files", "*.npy"), ("Tiled maps", "*.tmap"), ("Calibration projects", "*.calib")])
     return file_path
 
 def select_output_file():
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()  # Hide the main window
     file_path = filedialog.asksaveasfilename(title="Save detected peaks as",
                                              defaultextension=".csv",
-                                             filetypes=[("CSV files", "*.csv")])
+                                             filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
     return file_path
 
 def main():
@@ -96,20 +506,25 @@ def main():
         print("No input file selected. Exiting.")
         return
 
+    from background import run_with_progress
+
     # データを読み込む
-    map_data = load_data(input_file_path)
+    map_data = run_with_progress("Loading map", load_data, input_file_path)
+    if map_data is None:
+        print("Loading cancelled. Exiting.")
+        return
     map_size = map_data.shape
     print(f'Number of lines of input file : {map_size[1]}')
 
-    # マップを表示し、領域を選択
-    selector = MapSelector(map_data)
-    selected_region = selector.get_selected_region()
-
-    # ピークを検出
-    peaks = detect_peaks(map_data, region=selected_region)
+    # マップを表示し、領域とパラメータを選択 (ピークはライブで表示)
+    selector = MapSelector(map_data, live=True)
+    print(f"Region {selector.get_selected_region()}, parameters {selector.get_parameters()}")
 
-    # ピークを表示
-    plot_peaks(map_data, peaks, 'Detected Peaks', region=selected_region)
+    # ピークを検出 (ライブ表示と同じピーク; 計算済みのタイルは再利用)
+    peaks = run_with_progress("Detecting peaks", selector.get_peaks)
+    if peaks is None:
+        print("Detection cancelled. Exiting.")
+        return
 
     # Select output file
     output_file_path = select_output_file()
@@ -118,7 +533,7 @@ def main():
         return
 
     # ピークを保存
-    save_peaks(peaks, output_file_path, map_size)
+    save_peaks(peaks, output_file_path, map_size, map_data)
     print(f"Detected {len(peaks)} peaks. Saved to {output_file_path}")
 
 if __name__ == "__main__":
@@ -1,10 +1,21 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.widgets import RectangleSelector, LassoSelector
+from matplotlib.path import Path
+from scipy.spatial import cKDTree
 import tkinter as tk
 from tkinter import filedialog, messagebox, Menu
 import pandas as pd
 
+from CalibrationProject import is_project, open_project
+from TiledMap import load_map
+from background import BackgroundRunner
+from PeakDetector import detect_peaks
+
+REGION_OPERATIONS = ['off', 'delete', 'keep', 'detect']
+MAX_UNDO = 20
+
 class PeakEditor:
     def __init__(self, master):
         self.master = master
@@ -25,6 +36,8 @@ class PeakEditor:
         
         self.update_colorbar_button = tk.Button(master, text="Update Colorbar (U)", command=self.update_colorbar)
         self.update_colorbar_button.pack()
+
+        self.runner = BackgroundRunner(self.master)
         
         self.canvas.mpl_connect('button_press_event', self.on_click)
         self.fig.canvas.mpl_connect('key_press_event', self.on_key_press)
@@ -32,6 +45,9 @@ class PeakEditor:
         self.scatter = None
         self.colorbar = None
         self.pcolormesh = None
+        self.rectangle_selector = None
+        self.lasso_selector = None
+        self.undo_stack = []
 
     def create_menu(self):
         menubar = Menu(self.master)
@@ -44,23 +60,47 @@ class PeakEditor:
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.master.quit)
 
+        # Region operations apply to every peak inside a rectangle or lasso in one batch
+        self.region_operation = tk.StringVar(value='off')
+        self.region_shape = tk.StringVar(value='rectangle')
+        edit_menu = Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Edit", menu=edit_menu)
+        edit_menu.add_command(label="Undo (Z)", command=self.undo)
+        edit_menu.add_separator()
+        for label, value in [("Click Editing Only", 'off'), ("Delete Inside Region", 'delete'),
+                             ("Keep Only Inside Region", 'keep'), ("Add Detected Peaks Inside Region", 'detect')]:
+            edit_menu.add_radiobutton(label=label, variable=self.region_operation, value=value, command=self.update_selectors)
+        edit_menu.add_separator()
+        for label, value in [("Rectangle Region", 'rectangle'), ("Lasso Region", 'lasso')]:
+            edit_menu.add_radiobutton(label=label, variable=self.region_shape, value=value, command=self.update_selectors)
+
     def load_data(self):
-        map_file = filedialog.askopenfilename(title="Select Map File", filetypes=[("NumPy files", "*.npy")])
-        if map_file:
-            self.map_data = np.load(map_file).T
-        else:
+        map_file = filedialog.askopenfilename(title="Select Map File", filetypes=[("NumPy files", "*.npy"), ("Tiled maps", "*.tmap"), ("Calibration projects", "*.calib")])
+        if not map_file:
             messagebox.showwarning("Warning", "No map file selected. Please load a map file to continue.")
             return
 
-        peaks_file = filedialog.askopenfilename(title="Select Peaks File", filetypes=[("CSV files", "*.csv")])
-        if peaks_file:
-            self.peaks = pd.read_csv(peaks_file)
-        else:
+        peaks_file = filedialog.askopenfilename(title="Select Peaks File", filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
+        if not peaks_file:
             messagebox.showwarning("Warning", "No peaks file selected. Please load a peaks file to continue.")
             return
 
-        if self.map_data is not None and self.peaks is not None:
-            self.plot_data()
+        self.runner.submit('load', self.read_files, map_file, peaks_file, on_done=self.on_files_read, label="Loading data")
+
+    @staticmethod
+    def read_files(map_file, peaks_file):
+        # Runs on the worker thread
+        map_data = open_project(map_file).map_data if is_project(map_file) else load_map(map_file).T
+        if is_project(peaks_file):
+            peaks = pd.DataFrame(np.array(open_project(peaks_file).require('peaks')), columns=['x', 'y'])
+        else:
+            peaks = pd.read_csv(peaks_file)
+        return map_data, peaks
+
+    def on_files_read(self, result):
+        self.map_data, self.peaks = result
+        self.undo_stack = []
+        self.plot_data()
 
     def plot_data(self):
         self.ax.clear()
@@ -76,6 +116,11 @@ class PeakEditor:
         
         # Plot the peaks
         self.scatter = self.ax.scatter(self.peaks['x'], self.peaks['y'], c='r', s=5)
+
+        # Region selectors for the bulk operations; only the one for the current shape is active
+        self.rectangle_selector = RectangleSelector(self.ax, self.on_rectangle_select, useblit=True)
+        self.lasso_selector = LassoSelector(self.ax, self.on_lasso_select, useblit=True)
+        self.update_selectors()
         
         self.ax.set_xlim(-1, 1)
         self.ax.set_ylim(-1, 1)
@@ -99,23 +144,86 @@ class PeakEditor:
         if event.key == 'u':
             self.update_colorbar()
             return  # Prevent the event from propagating
+        if event.key == 'z':
+            self.undo()
 
     def add_peak(self, x, y):
         new_peak = pd.DataFrame({'x': [x], 'y': [y]})
-        self.peaks = pd.concat([self.peaks, new_peak], ignore_index=True)
-        self.update_plot()
+        self.set_peaks(pd.concat([self.peaks, new_peak], ignore_index=True))
 
     def remove_peak(self, x, y):
         distances = np.sqrt((self.peaks['x'] - x)**2 + (self.peaks['y'] - y)**2)
         closest_peak = distances.idxmin()
-        self.peaks = self.peaks.drop(closest_peak).reset_index(drop=True)
+        self.set_peaks(self.peaks.drop(closest_peak).reset_index(drop=True))
+
+    def set_peaks(self, peaks):
+        # Every edit, single or bulk, goes through here: one undo entry and one redraw
+        self.undo_stack = (self.undo_stack + [self.peaks])[-MAX_UNDO:]
+        self.peaks = peaks
         self.update_plot()
 
+    def undo(self):
+        if self.undo_stack:
+            self.peaks = self.undo_stack.pop()
+            self.update_plot()
+
+    def update_selectors(self):
+        if self.rectangle_selector is None:
+            return
+        operation = self.region_operation.get()
+        self.rectangle_selector.set_active(operation != 'off' and self.region_shape.get() == 'rectangle')
+        self.lasso_selector.set_active(operation != 'off' and self.region_shape.get() == 'lasso')
+
+    def on_rectangle_select(self, eclick, erelease):
+        x1, x2 = sorted([eclick.xdata, erelease.xdata])
+        y1, y2 = sorted([eclick.ydata, erelease.ydata])
+        self.apply_region([(x1, y1), (x2, y1), (x2, y2), (x1, y2)])
+
+    def on_lasso_select(self, vertices):
+        if len(vertices) > 2:
+            self.apply_region(vertices)
+
+    def apply_region(self, vertices):
+        if self.peaks is None or self.toolbar.mode != '':
+            return
+        region = Path(vertices)
+        operation = self.region_operation.get()
+        if operation == 'detect':
+            self.runner.submit('detect', self.detect_in_region, self.map_data, region, label="Detecting peaks",
+                               on_done=self.add_detected_peaks)
+            return
+        inside = region.contains_points(self.peaks[['x', 'y']].to_numpy())
+        if operation == 'delete' and inside.any():
+            self.set_peaks(self.peaks[~inside].reset_index(drop=True))
+        elif operation == 'keep' and not inside.all():
+            self.set_peaks(self.peaks[inside].reset_index(drop=True))
+
+    @staticmethod
+    def detect_in_region(map_data, region, min_distance=5):
+        # Runs on the worker thread: detect_peaks on the region's bounding box, kept if inside the region
+        height, width = map_data.shape
+        (x_min, y_min), (x_max, y_max) = region.get_extents().get_points()
+        box = (max(0, int((x_min + 1) / 2 * width)), max(0, int((y_min + 1) / 2 * height)),
+               min(width, int(np.ceil((x_max + 1) / 2 * width)) + 1), min(height, int(np.ceil((y_max + 1) / 2 * height)) + 1))
+        if box[2] - box[0] < 3 or box[3] - box[1] < 3:
+            return np.empty((0, 2)), 2 * min_distance / width
+        peaks = detect_peaks(map_data, region=box, min_distance=min_distance)
+        points = np.column_stack([2 * peaks[:, 1] / width - 1, 2 * peaks[:, 0] / height - 1])
+        return points[region.contains_points(points)], 2 * min_distance / width
+
+    def add_detected_peaks(self, result):
+        # Detections that duplicate an existing peak are skipped
+        points, min_distance = result
+        if len(self.peaks) and len(points):
+            distances, _ = cKDTree(self.peaks[['x', 'y']].to_numpy()).query(points)
+            points = points[distances >= min_distance]
+        if len(points):
+            self.set_peaks(pd.concat([self.peaks, pd.DataFrame(points, columns=['x', 'y'])], ignore_index=True))
+
     def update_plot(self):
-        if self.scatter is not None:
-            self.scatter.remove()
-        self.scatter = self.ax.scatter(self.peaks['x'], self.peaks['y'], c='r', s=3)
-        self.canvas.draw()
+        # Move the existing scatter instead of rebuilding it
+        self.scatter.set_offsets(self.peaks[['x', 'y']].to_numpy())
+        self.canvas.draw_idle()
 
     def update_colorbar(self):
         if self.map_data is not None and self.pcolormesh is not None:
@@ -142,13 +250,21 @@ class PeakEditor:
 
     def save_peaks(self):
         if self.peaks is not None:
-            save_file = filedialog.asksaveasfilename(title="Save Peaks", defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+            save_file = filedialog.asksaveasfilename(title="Save Peaks", defaultextension=".csv", filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
             if save_file:
-                self.peaks.to_csv(save_file, index=False)
-                messagebox.showinfo("Info", f"Peaks saved to {save_file}")
+                self.runner.submit('save', self.write_peaks, self.peaks.copy(), save_file, self.map_data, label="Saving peaks",
+                                   on_done=lambda _: messagebox.showinfo("Info", f"Peaks saved to {save_file}"))
         else:
             messagebox.showwarning("Warning", "No peaks data to save. Please load data first.")
 
+    @staticmethod
+    def write_peaks(peaks, save_file, map_data=None):
+        # Runs on the worker thread; map_data starts a new project if save_file does not exist
+        if is_project(save_file):
+            open_project(save_file, map_data, tool='PeakEditor').save_section('peaks', peaks[['x', 'y']].to_numpy(), tool='PeakEditor')
+        else:
+            peaks.to_csv(save_file, index=False)
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = PeakEditor(root)
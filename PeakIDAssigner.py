@@ -1,17 +1,27 @@
+import os
+import sys
 import numpy as np
-import math
-import matplotlib.pyplot as plt
-import pandas as pd
-import tkinter as tk
-from tkinter import filedialog, simpledialog, ttk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+import csv
+import heapq
+from scipy.spatial import cKDTree, Delaunay
+
+# matplotlib and tkinter are imported on first use so assignment can run headless
+
+from CalibrationProject import is_project, open_project
+from TiledMap import load_map
 
 N_pix = 45
 
-def load_data(input_file_path):
-    return np.load(input_file_path).T
+def load_data(input_file_path, dtype=None):
+    if is_project(input_file_path):
+        data = open_project(input_file_path).map_data
+    else:
+        data = load_map(input_file_path).T
+    return data if dtype is None else data.astype(dtype, copy=False)
 
 def load_peaks(csv_file_path):
+    if is_project(csv_file_path):
+        return np.array(open_project(csv_file_path).require('peaks'))
     return np.loadtxt(csv_file_path, delimiter=',', skiprows=1)
 
 def normalize_coordinates(x, y, width, height):
@@ -20,91 +30,200 @@ def normalize_coordinates(x, y, width, height):
 def denormalize_coordinates(norm_x, norm_y, width, height):
     return int(((norm_x + 1) / 2) * width), int(((norm_y + 1) / 2) * height)
 
-def assign_id_in_direction(peaks, start_id, start_peak, direction, max_dist=0.003, max_count=50, search_range=0.01, offset=0.0001):
+def unique_peaks(peaks):
+    # Duplicate peaks (e.g. the same crystal in two merged peak files) would be each other's nearest
+    # neighbour at distance 0 and collapse the pitch
+    return np.unique(np.asarray(peaks, dtype=float).reshape(-1, 2), axis=0)
+
+def estimate_pitch(peaks):
+    # Median nearest-neighbour distance between distinct peaks
+    peaks = unique_peaks(peaks)
+    distances, _ = cKDTree(peaks).query(peaks, k=2)
+    return np.median(distances[:, 1])
+
+def estimate_lattice(peaks):
+    # Pitch and rotation of the lattice. Nearest-neighbour directions of a square lattice repeat
+    # every 90 degrees, so their angles are averaged as 4 * theta on the unit circle.
+    peaks = unique_peaks(peaks)
+    distances, neighbours = cKDTree(peaks).query(peaks, k=5)
+    vectors = peaks[neighbours[:, 1:]] - peaks[:, None, :]
+    pitch = np.median(distances[:, 1])
+    near = distances[:, 1:] < 1.5 * pitch
+    theta = np.arctan2(vectors[..., 1], vectors[..., 0])[near]
+    angle = np.angle(np.exp(4j * theta).sum()) / 4
+    return pitch, angle
+
+def find_lattice_centre(peaks, hole_threshold=0.85, search_radius=3):
+    # Largest empty circle near the middle of the peak cloud. A hole of k x k missing crystals
+    # leaves an empty radius of about (k + 1) / 2 pitches; a full lattice only about 0.7.
+    tree = cKDTree(peaks)
+    pitch = estimate_pitch(peaks)
+    middle = np.median(peaks, axis=0)
+    steps = np.arange(-search_radius * pitch, search_radius * pitch, pitch / 8)
+    grid_x, grid_y = np.meshgrid(middle[0] + steps, middle[1] + steps)
+    candidates = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+    empty, _ = tree.query(candidates)
+    best = np.argmax(empty)
+    if empty[best] < hole_threshold * pitch:
+        # No central hole: the lattice centre is the peak nearest the middle
+        _, nearest = tree.query(middle)
+        return peaks[nearest], pitch, 0
+    hole_size = max(1, 2 * int(round(empty[best] / pitch)) - 1)
+    return candidates[best], pitch, hole_size
+
+def infer_id(peak, centre, pitch, angle=0.0):
+    # IDx grows with x and IDy grows with decreasing y, as in assign_id_in_direction
+    dx, dy = peak[0] - centre[0], peak[1] - centre[1]
+    dx, dy = dx * np.cos(angle) + dy * np.sin(angle), dy * np.cos(angle) - dx * np.sin(angle)
+    id_x = N_pix // 2 + int(round(dx / pitch))
+    id_y = N_pix // 2 - int(round(dy / pitch))
+    return [min(max(id_x, 0), N_pix - 1), min(max(id_y, 0), N_pix - 1)]
+
+def find_seed(peaks):
+    # Seed with the peak just right of the central hole (cf. utils.Search 'rc'), or the centre peak
+    centre, pitch, hole_size = find_lattice_centre(peaks)
+    _, angle = estimate_lattice(peaks)
+    target = centre + (hole_size + 1) // 2 * pitch * np.array([np.cos(angle), np.sin(angle)])
+    _, nearest = cKDTree(peaks).query(target)
+    start_peak = peaks[nearest]
+    return start_peak, infer_id(start_peak, centre, pitch, angle)
+
+# Search tolerances as fractions of the local pitch, used instead of the fixed defaults of
+# assign_id_in_direction (tuned for a pitch of about 0.035). The band half-width stays well below
+# the distance to the diagonal neighbours (one pitch off the line), and max_dist allows for the
+# scatter of real crystal positions.
+TOLERANCE_RATIOS = {'max_dist': 0.3, 'search_range': 0.45, 'offset': 0.3}
+
+def local_lattice(peaks, k=9):
+    # Pitch and orientation around every peak from its k nearest neighbours (4-theta averaging as in
+    # estimate_lattice), then median-smoothed over the same neighbourhood. Returns lookup(point).
+    peaks = unique_peaks(peaks)
+    tree = cKDTree(peaks)
+    distances, neighbours = tree.query(peaks, k=k)
+    vectors = peaks[neighbours[:, 1:]] - peaks[:, None, :]
+    nearest = distances[:, 1:2]
+    near = distances[:, 1:] < 1.2 * nearest  # the 4 edge neighbours of a square lattice, not the diagonals (x1.41)
+    pitch = np.sum(np.where(near, distances[:, 1:], 0), axis=1) / np.maximum(near.sum(axis=1), 1)
+    phase = np.sum(np.where(near, np.exp(4j * np.arctan2(vectors[..., 1], vectors[..., 0])), 0), axis=1)
+    pitch = np.median(pitch[neighbours], axis=1)
+    phase = np.sum(phase[neighbours], axis=1)
+    angle = np.angle(phase) / 4
+
+    def lookup(point):
+        _, index = tree.query(point)
+        return pitch[index], angle[index]
+    return lookup
+
+def assign_id_in_direction(peaks, start_id, start_peak, direction, max_dist=0.003, max_count=50, search_range=0.01, offset=0.0001, lattice=None, peak_ids=None, max_step=4):
+    # lattice: optional local_lattice lookup; tolerances then follow the local pitch, the search
+    # bands are taken in the local lattice frame instead of along x and y, and a step across missing
+    # crystals (e.g. the central hole) advances the ID by the number of pitches it spans, up to max_step.
+    # peak_ids: optional ID array; the walk stops at an ID that is already assigned instead of overwriting it
     current_id = list(start_id)
     current_peak = start_peak
     assigned_peaks = []
+    remaining = np.asarray(peaks, dtype=float).reshape(-1, 2)
+    alive = np.ones(len(remaining), dtype=bool)
 
     while True:
         x, y = current_peak
         id_x, id_y = current_id
 
+        dx, dy = remaining[:, 0] - x, remaining[:, 1] - y
+        if lattice is not None:
+            pitch, angle = lattice(current_peak)
+            max_dist, search_range, offset = (TOLERANCE_RATIOS[name] * pitch for name in ('max_dist', 'search_range', 'offset'))
+            dx, dy = dx * np.cos(angle) + dy * np.sin(angle), dy * np.cos(angle) - dx * np.sin(angle)
+
         if direction == 'left':
-            next_peaks = [peak for peak in peaks if peak[0] < x - offset and abs(peak[1] - y) < search_range]
+            candidates = (dx < -offset) & (np.abs(dy) < search_range)
         elif direction == 'right':
-            next_peaks = [peak for peak in peaks if peak[0] > x + offset and abs(peak[1] - y) < search_range]
+            candidates = (dx > offset) & (np.abs(dy) < search_range)
         elif direction == 'up':
-            next_peaks = [peak for peak in peaks if peak[1] < y - offset and abs(peak[0] - x) < search_range]
+            candidates = (dy < -offset) & (np.abs(dx) < search_range)
         elif direction == 'down':
-            next_peaks = [peak for peak in peaks if peak[1] > y + offset and abs(peak[0] - x) < search_range]
+            candidates = (dy > offset) & (np.abs(dx) < search_range)
+        candidates = np.nonzero(candidates & alive)[0]
 
-        if direction in ['left', 'right']:
-            next_peaks = sorted(next_peaks, key=lambda p: abs(p[0] - x))[:max_count]
-        else:
-            next_peaks = sorted(next_peaks, key=lambda p: abs(p[1] - y))[:max_count]
-
-        if not next_peaks:
+        if len(candidates) == 0:
             break
 
-        next_peaks = sorted(next_peaks, key=lambda p: math.sqrt((p[0] - x)**2 + (p[1] - y)**2))
-
-        next_peak = next_peaks[0]
+        # The max_count nearest along the direction, then the nearest of those
+        along = np.abs(dx if direction in ['left', 'right'] else dy)[candidates]
+        candidates = candidates[np.argsort(along, kind='stable')[:max_count]]
+        best = candidates[np.argmin(np.hypot(dx[candidates], dy[candidates]))]
+        next_peak = remaining[best]
 
         if direction in ['left', 'right']:
-            if abs(next_peak[1] - y) > max_dist:
+            if abs(dy[best]) > max_dist:
                 break
         else:
-            if abs(next_peak[0] - x) > max_dist:
+            if abs(dx[best]) > max_dist:
                 break
 
+        step = 1
+        if lattice is not None:
+            step = max(1, int(np.rint(abs(dx[best] if direction in ['left', 'right'] else dy[best]) / pitch)))
+            if step > max_step:
+                break
         if direction == 'left':
-            new_id = [id_x - 1, id_y]
+            new_id = [id_x - step, id_y]
         elif direction == 'right':
-            new_id = [id_x + 1, id_y]
+            new_id = [id_x + step, id_y]
         elif direction == 'up':
-            new_id = [id_x, id_y + 1]
+            new_id = [id_x, id_y + step]
         elif direction == 'down':
-            new_id = [id_x, id_y - 1]
+            new_id = [id_x, id_y - step]
 
         if not (0 <= new_id[0] < N_pix and 0 <= new_id[1] < N_pix):
             break
+        if peak_ids is not None and not np.isnan(peak_ids[new_id[1]][new_id[0]][0]):
+            break
 
         assigned_peaks.append((new_id, next_peak))
         current_id = new_id
         current_peak = next_peak
 
-        peaks = [p for p in peaks if not np.array_equal(p, next_peak)]
+        alive &= ~np.all(remaining == next_peak, axis=1)
 
-    return assigned_peaks, peaks
+    return assigned_peaks, remaining[alive]
 
-def assign_ids(peaks, start_peak, start_id):
+def assign_ids(peaks, start_peak, start_id, progress=None, auto_tune=False):
+    # progress: optional callback taking the completed fraction (see background.BackgroundRunner)
+    # auto_tune: derive the search tolerances and directions from the local lattice (local_lattice)
     peak_ids = np.full((N_pix, N_pix, 2), np.nan)
     peak_ids[start_id[1]][start_id[0]] = start_peak  # Correct order: [id_y][id_x]
 
-    remaining_peaks = peaks.copy()
-    remaining_peaks = [p for p in remaining_peaks if not np.array_equal(p, start_peak)]
+    peaks = np.asarray(peaks, dtype=float)
+    lattice = local_lattice(peaks) if auto_tune else None
+    taken = peak_ids if auto_tune else None  # tuned walks stop at assigned IDs rather than overwrite them
+    remaining_peaks = peaks[~np.all(peaks == start_peak, axis=1)]
 
     # Assign IDs in all four directions from the start peak
     for direction in ['left', 'right', 'up', 'down']:
-        assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, start_id, start_peak, direction)
+        assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, start_id, start_peak, direction, lattice=lattice, peak_ids=taken)
         for (id_x, id_y), peak in assigned:
             peak_ids[id_y][id_x] = peak  # Correct order: [id_y][id_x]
 
     # Assign IDs in up and down directions for each column
-    for direction in ['up', 'down']:
+    for k, direction in enumerate(['up', 'down']):
         for i in range(N_pix):
+            if progress is not None:
+                progress((k * N_pix + i) / (4 * N_pix))
             for j in range(N_pix):
                 if not np.isnan(peak_ids[j][i][0]):
                     current_id = [i, j]
                     current_peak = peak_ids[j][i]
-                    assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, current_id, current_peak, direction)
+                    assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, current_id, current_peak, direction, lattice=lattice, peak_ids=taken)
                     for (id_x, id_y), peak in assigned:
                         peak_ids[id_y][id_x] = peak  # Correct order: [id_y][id_x]
 
     # Assign IDs in left and right directions for remaining peaks
-    for direction in ['left', 'right']:
+    for k, direction in enumerate(['left', 'right']):
         N_pix_half = N_pix // 2
         for i in range(N_pix_half - 1):
+            if progress is not None:
+                progress(0.5 + (k * (N_pix_half - 1) + i) / (4 * (N_pix_half - 1)))
             for j in range(N_pix):
                 if direction == 'left':
                     if j == N_pix_half or not np.isnan(peak_ids[j][N_pix_half - (i + 1)][0]):
@@ -118,14 +237,165 @@ def assign_ids(peaks, start_peak, start_id):
                     current_peak = peak_ids[j][N_pix_half + i]
                 
                 if not np.isnan(current_peak[0]):
-                    assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, current_id, current_peak, direction)
+                    assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, current_id, current_peak, direction, lattice=lattice, peak_ids=taken)
                     for (id_x, id_y), peak in assigned:
                         peak_ids[id_y][id_x] = peak  # Correct order: [id_y][id_x]
 
+    # Tuned walks never overwrite, so they can safely start again from every assigned peak; this fills
+    # the columns and rows the fixed order above cannot reach (e.g. those through the central hole)
+    while auto_tune and len(remaining_peaks):
+        count = len(remaining_peaks)
+        for id_y, id_x in np.argwhere(~np.isnan(peak_ids[:, :, 0])):
+            for direction in ['left', 'right', 'up', 'down']:
+                assigned, remaining_peaks = assign_id_in_direction(remaining_peaks, [id_x, id_y], peak_ids[id_y][id_x], direction, lattice=lattice, peak_ids=taken)
+                for (new_x, new_y), peak in assigned:
+                    peak_ids[new_y][new_x] = peak
+        if len(remaining_peaks) == count:
+            break
+
     return peak_ids
 
+def lattice_edges(peaks):
+    # Delaunay neighbour graph as (i, j) pairs with i < j, each edge once
+    simplices = Delaunay(peaks).simplices
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+    return np.unique(np.sort(edges, axis=1), axis=0)
+
+def assign_ids_graph(peaks, start_peak, start_id, progress=None, tolerance=0.3, max_step=4):
+    # Alternative to assign_ids: propagate IDs over the Delaunay graph from the seed. Each assigned
+    # peak carries local axis vectors (the steps to IDx + 1 and IDy + 1, so y_axis points to smaller y),
+    # which follow the lattice as it bends. An edge gives an ID step (a, b) when it matches
+    # a * x_axis + b * y_axis within tolerance * pitch; the shortest pending steps are taken first, so
+    # edges spanning several pitches (e.g. across the central hole) are only used where nothing else reaches.
+    peaks = np.asarray(peaks, dtype=float)
+    peak_ids = np.full((N_pix, N_pix, 2), np.nan)
+    if len(peaks) < 3:
+        return peak_ids
+    pitch, angle = estimate_lattice(peaks)
+    x_axis = pitch * np.array([np.cos(angle), np.sin(angle)])
+    y_axis = pitch * np.array([np.sin(angle), -np.cos(angle)])  # angle is within +-45 degrees
+
+    edges = lattice_edges(peaks)
+    neighbours = np.concatenate([edges[:, 1], edges[:, 0]])
+    sources = np.concatenate([edges[:, 0], edges[:, 1]])
+    order = np.argsort(sources, kind='stable')
+    neighbours, bounds = neighbours[order], np.searchsorted(sources[order], np.arange(len(peaks) + 1))
+
+    ids = np.full((len(peaks), 2), -1)
+    axes = np.zeros((len(peaks), 2, 2))
+    taken = np.zeros((N_pix, N_pix), dtype=bool)
+    _, seed = cKDTree(peaks).query(start_peak)
+    ids[seed] = start_id
+    axes[seed] = x_axis, y_axis
+    taken[start_id[1], start_id[0]] = True
+    peak_ids[start_id[1]][start_id[0]] = peaks[seed]
+    heap, counter, assigned = [], 0, 1
+
+    def push(i):
+        nonlocal counter
+        basis = axes[i].T  # columns x_axis, y_axis
+        for j in neighbours[bounds[i]:bounds[i + 1]]:
+            if ids[j, 0] >= 0:
+                continue
+            vector = peaks[j] - peaks[i]
+            step = np.rint(np.linalg.solve(basis, vector))
+            error = np.linalg.norm(vector - basis @ step) / np.linalg.norm(axes[i][0])
+            if error < tolerance and 0 < np.abs(step).sum() <= max_step:
+                heapq.heappush(heap, (step @ step, error, counter, i, j, int(step[0]), int(step[1])))
+                counter += 1
+
+    push(seed)
+    while heap:
+        _, _, _, i, j, a, b = heapq.heappop(heap)
+        if ids[j, 0] >= 0:
+            continue
+        id_x, id_y = ids[i, 0] + a, ids[i, 1] + b
+        if not (0 <= id_x < N_pix and 0 <= id_y < N_pix) or taken[id_y, id_x]:
+            continue
+        ids[j] = id_x, id_y
+        taken[id_y, id_x] = True
+        peak_ids[id_y][id_x] = peaks[j]  # Correct order: [id_y][id_x]
+        # Unit steps update the matching axis; everything else inherits the parent's axes
+        axes[j] = axes[i]
+        vector = peaks[j] - peaks[i]
+        if abs(a) + abs(b) == 1:
+            axes[j][0 if a else 1] = vector * (a or b)
+        push(j)
+        assigned += 1
+        if progress is not None and assigned % 256 == 0:
+            progress(assigned / len(peaks))
+    return peak_ids
+
+def assign_ids_tuned(peaks, start_peak, start_id, progress=None):
+    return assign_ids(peaks, start_peak, start_id, progress, auto_tune=True)
+
+ASSIGNERS = {'directional': assign_ids, 'tuned': assign_ids_tuned, 'graph': assign_ids_graph}
+
+REGISTRATION_STAGES = ['translation', 'rigid', 'affine']
+
+def fit_transform(source, target, mode='affine'):
+    # Least-squares A, t with target ~ source @ A.T + t; 'rigid' is rotation and translation only (Kabsch)
+    if mode == 'translation':
+        return np.eye(2), np.median(target - source, axis=0)
+    if mode == 'rigid':
+        source_mean, target_mean = source.mean(axis=0), target.mean(axis=0)
+        u, _, vt = np.linalg.svd((source - source_mean).T @ (target - target_mean))
+        flip = np.sign(np.linalg.det(u @ vt))
+        A = (u @ np.diag([1, flip]) @ vt).T
+        return A, target_mean - source_mean @ A.T
+    coefficients, *_ = np.linalg.lstsq(np.column_stack([source, np.ones(len(source))]), target, rcond=None)
+    return coefficients[:2].T, coefficients[2]
+
+def register_template(template, peaks, mode='affine', gate=0.5, max_iter=50, tol=1e-9):
+    # ICP: pair every template point with the nearest peak within gate * pitch, refit, repeat.
+    # A lattice matches itself shifted by whole pitches, so the transform is freed in stages
+    # (translation, then rigid, then affine) and each stage starts from the previous one. Starts from
+    # the identity, so the drift between calibrations should stay below about half a pitch.
+    tree = cKDTree(peaks)
+    pitch = estimate_pitch(template)
+    A, t = np.eye(2), np.zeros(2)
+    for stage in REGISTRATION_STAGES[:REGISTRATION_STAGES.index(mode) + 1]:
+        for _ in range(max_iter):
+            distance, nearest = tree.query(template @ A.T + t, distance_upper_bound=gate * pitch)
+            matched = np.isfinite(distance)
+            if matched.sum() < 3:
+                raise ValueError("Template does not overlap the peaks")
+            new_A, new_t = fit_transform(template[matched], peaks[nearest[matched]], stage)
+            converged = np.abs(new_A - A).max() < tol and np.abs(new_t - t).max() < tol
+            A, t = new_A, new_t
+            if converged:
+                break
+    return A, t
+
+def assign_ids_template(peaks, template_ids, mode='affine', gate=0.35):
+    # Seedless alternative to ASSIGNERS: register a previous ID table (load_assigned_peaks) to the new
+    # peaks and give each ID the peak that is its mutual nearest neighbour within gate * pitch.
+    # Returns the IDs, the match distance in pitches per ID (nan if unmatched) and the unmatched peaks.
+    peaks = np.asarray(peaks, dtype=float)
+    valid = ~np.isnan(template_ids[:, :, 0])
+    A, t = register_template(template_ids[valid], peaks, mode)
+    moved = template_ids[valid] @ A.T + t
+    pitch = estimate_pitch(moved)
+    distance, nearest = cKDTree(peaks).query(moved)
+    _, back = cKDTree(moved).query(peaks)
+    accepted = (back[nearest] == np.arange(len(moved))) & (distance < gate * pitch)
+
+    matches = np.full((len(moved), 2), np.nan)
+    matches[accepted] = peaks[nearest[accepted]]
+    peak_ids = np.full((N_pix, N_pix, 2), np.nan)
+    peak_ids[valid] = matches  # valid is indexed [id_y][id_x] like the result
+    match_distance = np.full((N_pix, N_pix), np.nan)
+    match_distance[valid] = np.where(accepted, distance / pitch, np.nan)
+    used = np.zeros(len(peaks), dtype=bool)
+    used[nearest[accepted]] = True
+    return peak_ids, match_distance, peaks[~used]
+
 class PeakSelector:
     def __init__(self, map_data, peaks):
+        import matplotlib.pyplot as plt
+        import tkinter as tk
+        from tkinter import ttk
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
         self.map_data = map_data
         self.peaks = peaks
         self.selected_peak = None
@@ -170,6 +440,7 @@ class PeakSelector:
         return self.selected_peak
     
 def plot_assigned_peaks(peak_ids, map_data):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(12, 12))
     plt.imshow(map_data, cmap='viridis', origin='lower', extent=[-1, 1, -1, 1])
     
@@ -184,32 +455,98 @@ def plot_assigned_peaks(peak_ids, map_data):
     plt.colorbar(label='Intensity')
     plt.show()
 
-def save_assigned_peaks(peak_ids, output_file_path):
+def save_assigned_peaks(peak_ids, output_file_path, metrics=None, map_data=None):
+    # metrics: optional {column name: (N_pix, N_pix) array indexed [id_y][id_x]} appended after accuracy
+    # (a project stores them in its 'metrics' section, saved with the ids)
+    # map_data: puts the map into a new project when output_file_path does not exist yet
+    metrics = metrics or {}
+    if is_project(output_file_path):
+        project = open_project(output_file_path, map_data, tool='PeakIDAssigner')
+        project.save_section('ids', peak_ids, tool='PeakIDAssigner')
+        if metrics:
+            project.save_section('metrics', metrics, tool='PeakIDAssigner')
+        return
     with open(output_file_path, "w") as f:
-        f.write("IDx,IDy,Posix,Posiy,accuracy\n")
+        f.write(",".join(["IDx,IDy,Posix,Posiy,accuracy"] + list(metrics)) + "\n")
         for id_x in range(N_pix):
             for id_y in range(N_pix):
                 x, y = peak_ids[id_y][id_x]  # Correct order: [id_y][id_x]
+                extra = "".join(f",{values[id_y][id_x]}" for values in metrics.values())
                 if np.isnan(x) or np.isnan(y):
-                    f.write(f'{id_x},{id_y},nan,nan,miss\n')
+                    f.write(f'{id_x},{id_y},nan,nan,miss{extra}\n')
                 else:
-                    f.write(f'{id_x},{id_y},{x},{y},\n')
+                    f.write(f'{id_x},{id_y},{x},{y},{extra}\n')
 
+def load_assigned_peaks(csv_file_path):
+    if is_project(csv_file_path):
+        return np.array(open_project(csv_file_path).require('ids'))
+    peak_ids = np.full((N_pix, N_pix, 2), np.nan)
+    with open(csv_file_path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('accuracy') in ('miss', 'hole'):
+                continue
+            id_x, id_y = int(float(row['IDx'])), int(float(row['IDy']))
+            if 0 <= id_x < N_pix and 0 <= id_y < N_pix:
+                peak_ids[id_y][id_x] = float(row['Posix']), float(row['Posiy'])  # Correct order: [id_y][id_x]
+    return peak_ids
 
 def select_file(title, filetypes):
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()
     return filedialog.askopenfilename(title=title, filetypes=filetypes)
 
+def assign_unattended(peaks_file_path, output_file_path, method='directional'):
+    peaks = load_peaks(peaks_file_path)
+    start_peak, start_id = find_seed(peaks)
+    print(f"Seed peak {start_peak} with ID {start_id}")
+    peak_ids = ASSIGNERS[method](peaks, start_peak, start_id)
+    save_assigned_peaks(peak_ids, output_file_path)
+    print(f"Assigned {np.count_nonzero(~np.isnan(peak_ids[:, :, 0]))} IDs. Saved to {output_file_path}")
+    return peak_ids
+
+def assign_from_template(peaks_file_path, template_file_path, output_file_path, mode='affine'):
+    peaks = load_peaks(peaks_file_path)
+    peak_ids, match_distance, unmatched = assign_ids_template(peaks, load_assigned_peaks(template_file_path), mode)
+    save_assigned_peaks(peak_ids, output_file_path, {'match_distance': match_distance})
+    print(f"Assigned {np.count_nonzero(~np.isnan(peak_ids[:, :, 0]))} IDs from {template_file_path}. Saved to {output_file_path}")
+    if len(unmatched):
+        unmatched_file_path = os.path.splitext(output_file_path)[0] + '_unmatched.csv'
+        with open(unmatched_file_path, "w") as f:
+            f.write("x,y\n")
+            for x, y in unmatched:
+                f.write(f"{x},{y}\n")
+        print(f"{len(unmatched)} peaks matched no template ID. Saved to {unmatched_file_path}")
+    return peak_ids
+
 def main():
+    # Unattended: python PeakIDAssigner.py <peaks.csv> <output.csv> [directional | tuned | graph]
+    #             python PeakIDAssigner.py <peaks.csv> <output.csv> template <previous_ids.csv> [affine | rigid]
+    if len(sys.argv) > 3 and sys.argv[3] == 'template':
+        if len(sys.argv) < 5 or (len(sys.argv) > 5 and sys.argv[5] not in ('affine', 'rigid')):
+            print('Usage: python PeakIDAssigner.py <peaks.csv> <output.csv> template <previous_ids.csv> [affine | rigid]')
+            return
+        assign_from_template(sys.argv[1], sys.argv[4], sys.argv[2], sys.argv[5] if len(sys.argv) > 5 else 'affine')
+        return
+    if len(sys.argv) > 2:
+        method = sys.argv[3] if len(sys.argv) > 3 else 'directional'
+        if method not in ASSIGNERS:
+            print('Usage: python PeakIDAssigner.py <peaks.csv> <output.csv> [' + ' | '.join(ASSIGNERS) + ']')
+            return
+        assign_unattended(sys.argv[1], sys.argv[2], method)
+        return
+
+    from tkinter import filedialog, simpledialog
+
     # Select input map file
-    map_file_path = select_file("Select input map NPY file", [("NumPy files", "*.npy")])
+    map_file_path = select_file("Select input map NPY file", [("NumPy files", "*.npy"), ("Tiled maps", "*.tmap"), ("Calibration projects", "*.calib")])
     if not map_file_path:
         print("No input map file selected. Exiting.")
         return
 
     # Select input peaks CSV file
-    peaks_file_path = select_file("Select input peaks CSV file", [("CSV files", "*.csv")])
+    peaks_file_path = select_file("Select input peaks CSV file", [("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
     if not peaks_file_path:
         print("No input peaks file selected. Exiting.")
         return
@@ -226,16 +563,22 @@ def main():
         print("No peak selected. Exiting.")
         return
 
-    # Get ID for selected peak
-    id_x = simpledialog.askinteger("Input", "Enter the X ID for the selected peak:", minvalue=0, maxvalue=N_pix-1)
-    id_y = simpledialog.askinteger("Input", "Enter the Y ID for the selected peak:", minvalue=0, maxvalue=N_pix-1)
+    # Get ID for selected peak, pre-filled from the detected lattice centre
+    centre, pitch, _ = find_lattice_centre(peaks)
+    guess_x, guess_y = infer_id(selected_peak, centre, pitch)
+    id_x = simpledialog.askinteger("Input", "Enter the X ID for the selected peak:", minvalue=0, maxvalue=N_pix-1, initialvalue=guess_x)
+    id_y = simpledialog.askinteger("Input", "Enter the Y ID for the selected peak:", minvalue=0, maxvalue=N_pix-1, initialvalue=guess_y)
 
     if id_x is None or id_y is None:
         print("Invalid ID entered. Exiting.")
         return
 
-    # Assign IDs
-    peak_ids = assign_ids(peaks, selected_peak, [id_x, id_y])
+    # Assign IDs in the background so the progress window stays responsive
+    from background import run_with_progress
+    peak_ids = run_with_progress("Assigning IDs", assign_ids, peaks, selected_peak, [id_x, id_y], with_progress=True)
+    if peak_ids is None:
+        print("ID assignment cancelled. Exiting.")
+        return
 
     # Plot assigned peaks
     plot_assigned_peaks(peak_ids, map_data)
@@ -243,9 +586,9 @@ def main():
     # Save assigned peaks
     output_file_path = filedialog.asksaveasfilename(title="Save assigned peaks as",
                                                     defaultextension=".csv",
-                                                    filetypes=[("CSV files", "*.csv")])
+                                                    filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
     if output_file_path:
-        save_assigned_peaks(peak_ids, output_file_path)
+        save_assigned_peaks(peak_ids, output_file_path, map_data=map_data)
         print(f"Assigned IDs saved to {output_file_path}")
     else:
         print("No output file selected. Results not saved.")
@@ -5,6 +5,12 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, Menu, simpledialog
 import pandas as pd
 
+from PeakIDAssigner import N_pix
+from CrystalMetrics import METRIC_NAMES, crystal_metrics
+from CalibrationProject import is_project, open_project, ids_table, ids_from_table
+from TiledMap import load_map
+from background import BackgroundRunner
+
 class PeakIDEditor:
     def __init__(self, master):
         self.master = master
@@ -31,6 +37,8 @@ class PeakIDEditor:
         shortcuts_text = "Shortcuts: T - Toggle ID labels, U - Update colorbar, Ctrl+Click - Select peak"
         self.shortcuts_label = tk.Label(master, text=shortcuts_text)
         self.shortcuts_label.pack()
+
+        self.runner = BackgroundRunner(self.master)
         
         self.canvas.mpl_connect('button_press_event', self.on_click)
         self.fig.canvas.mpl_connect('key_press_event', self.on_key_press)
@@ -54,30 +62,65 @@ class PeakIDEditor:
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.master.quit)
 
+        quality_menu = Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Quality", menu=quality_menu)
+        quality_menu.add_command(label="Compute Metrics", command=self.compute_metrics)
+        heat_map_menu = Menu(quality_menu, tearoff=0)
+        quality_menu.add_cascade(label="Heat Map", menu=heat_map_menu)
+        for name in METRIC_NAMES:
+            heat_map_menu.add_command(label=name, command=lambda name=name: self.show_heat_map(name))
+
     def load_map_data(self):
-        map_file = filedialog.askopenfilename(title="Select Map File", filetypes=[("NumPy files", "*.npy")])
+        map_file = filedialog.askopenfilename(title="Select Map File", filetypes=[("NumPy files", "*.npy"), ("Tiled maps", "*.tmap"), ("Calibration projects", "*.calib")])
         if map_file:
-            self.map_data = np.load(map_file).T
-            self.plot_data()
+            self.runner.submit('map', self.read_map, map_file, on_done=self.on_map_read, label="Loading map")
         else:
             messagebox.showwarning("Warning", "No map file selected.")
 
     def load_peaks(self):
-        peaks_file = filedialog.askopenfilename(title="Select Peaks File", filetypes=[("CSV files", "*.csv")])
+        peaks_file = filedialog.askopenfilename(title="Select Peaks File", filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
         if peaks_file:
-            self.peaks = pd.read_csv(peaks_file)
-            self.plot_data()
+            self.runner.submit('peaks', self.read_peaks, peaks_file, on_done=self.on_peaks_read, label="Loading peaks")
         else:
             messagebox.showwarning("Warning", "No peaks file selected.")
 
     def load_peak_ids(self):
-        peak_ids_file = filedialog.askopenfilename(title="Select Peak IDs File", filetypes=[("CSV files", "*.csv")])
+        peak_ids_file = filedialog.askopenfilename(title="Select Peak IDs File", filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
         if peak_ids_file:
-            self.peak_ids = pd.read_csv(peak_ids_file)
-            self.plot_data()
+            self.runner.submit('ids', self.read_peak_ids, peak_ids_file, on_done=self.on_peak_ids_read, label="Loading peak IDs")
         else:
             messagebox.showwarning("Warning", "No peak IDs file selected.")
 
+    # read_* run on the worker thread, on_* back on the Tk main thread
+
+    @staticmethod
+    def read_map(map_file):
+        return open_project(map_file).map_data if is_project(map_file) else load_map(map_file).T
+
+    def on_map_read(self, map_data):
+        self.map_data = map_data
+        self.plot_data()
+
+    @staticmethod
+    def read_peaks(peaks_file):
+        if is_project(peaks_file):
+            return pd.DataFrame(np.array(open_project(peaks_file).require('peaks')), columns=['x', 'y'])
+        return pd.read_csv(peaks_file)
+
+    def on_peaks_read(self, peaks):
+        self.peaks = peaks
+        self.plot_data()
+
+    @staticmethod
+    def read_peak_ids(peak_ids_file):
+        if is_project(peak_ids_file):
+            return pd.DataFrame(ids_table(open_project(peak_ids_file).require('ids')))
+        return pd.read_csv(peak_ids_file)
+
+    def on_peak_ids_read(self, peak_ids):
+        self.peak_ids = peak_ids
+        self.plot_data()
+
     def plot_data(self):
         # Store current view limits if they exist and if this is not the first plot
         if hasattr(self, 'pcolormesh') and self.pcolormesh is not None:
@@ -206,16 +249,71 @@ class PeakIDEditor:
                 self.colorbar.update_normal(self.pcolormesh)
                 self.canvas.draw_idle()
 
+    def table_to_array(self, column=None):
+        # Rows of the ID table scattered into [id_y][id_x]; positions when column is None
+        if column is None:
+            return ids_from_table(self.peak_ids, N_pix)
+        valid = self.peak_ids['Posix'].notna() & ~self.peak_ids['accuracy'].isin(['miss', 'hole'])
+        rows = self.peak_ids[valid]
+        id_x = rows['IDx'].to_numpy(dtype=int)
+        id_y = rows['IDy'].to_numpy(dtype=int)
+        inside = (id_x >= 0) & (id_x < N_pix) & (id_y >= 0) & (id_y < N_pix)
+        array = np.full((N_pix, N_pix), np.nan)
+        array[id_y[inside], id_x[inside]] = rows[column].to_numpy(dtype=float)[inside]
+        return array
+
+    def compute_metrics(self):
+        if self.map_data is None or self.peak_ids is None:
+            messagebox.showwarning("Warning", "Load map data and peak IDs first.")
+            return
+        self.runner.submit('metrics', crystal_metrics, self.map_data, self.table_to_array(),
+                           on_done=self.on_metrics_computed, label="Computing metrics")
+
+    def on_metrics_computed(self, metrics):
+        # Rows whose IDs lie outside the lattice get no metrics (nan) rather than an edge crystal's
+        id_x = self.peak_ids['IDx'].to_numpy(dtype=int)
+        id_y = self.peak_ids['IDy'].to_numpy(dtype=int)
+        inside = (id_x >= 0) & (id_x < N_pix) & (id_y >= 0) & (id_y < N_pix)
+        for name, values in metrics.items():
+            column = np.full(len(id_x), np.nan)
+            column[inside] = values[id_y[inside], id_x[inside]]
+            self.peak_ids[name] = column
+        messagebox.showinfo("Info", "Crystal metrics computed. They are written with Save Peak IDs.")
+
+    def show_heat_map(self, name):
+        if self.peak_ids is None or name not in self.peak_ids:
+            messagebox.showwarning("Warning", f"No '{name}' column. Run Quality > Compute Metrics first.")
+            return
+        window = tk.Toplevel(self.master)
+        window.title(f"Crystal {name}")
+        fig, ax = plt.subplots(figsize=(6, 5))
+        canvas = FigureCanvasTkAgg(fig, master=window)
+        image = ax.imshow(self.table_to_array(name), cmap='viridis', origin='lower', interpolation='nearest')
+        ax.set(xlabel='IDx', ylabel='IDy', title=name)
+        fig.colorbar(image, ax=ax)
+        canvas.draw()
+        canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        window.protocol("WM_DELETE_WINDOW", lambda: (plt.close(fig), window.destroy()))
+
     def save_peak_ids(self):
         if self.peak_ids is not None:
             save_file = filedialog.asksaveasfilename(title="Save Peak IDs", defaultextension=".csv", 
-                                                    filetypes=[("CSV files", "*.csv")])
+                                                    filetypes=[("CSV files", "*.csv"), ("Calibration projects", "*.calib")])
             if save_file:
-                self.peak_ids.to_csv(save_file, index=False)
-                messagebox.showinfo("Info", f"Peak IDs saved to {save_file}")
+                table = self.table_to_array() if is_project(save_file) else self.peak_ids.copy()
+                self.runner.submit('save', self.write_peak_ids, table, save_file, self.map_data, label="Saving peak IDs",
+                                   on_done=lambda _: messagebox.showinfo("Info", f"Peak IDs saved to {save_file}"))
         else:
             messagebox.showwarning("Warning", "No peak ID data to save.")
 
+    @staticmethod
+    def write_peak_ids(table, save_file, map_data=None):
+        # Runs on the worker thread; map_data starts a new project if save_file does not exist
+        if is_project(save_file):
+            open_project(save_file, map_data, tool='PeakIDEditor').save_section('ids', table, tool='PeakIDEditor')
+        else:
+            table.to_csv(save_file, index=False)
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = PeakIDEditor(root)
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import math
+import threading
+import urllib.parse
+import numpy as np
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils import Colormap, ColorIndex, PngBytes
+from TiledMap import is_tiled, open_tiled
+from CalibrationProject import is_project, open_project, downsample
+from PeakIDAssigner import N_pix, load_assigned_peaks
+
+# Browser review of maps and calibrations without Tk or an X display:
+#     python TileServer.py <map> [ids.csv] [<map> [ids.csv] ...] [port]
+# then open http://localhost:<port>/. Maps are .npy, .tmap or .calib files; an ID table given after a
+# map is drawn over it (a .calib project brings its own). Every map is cut into a pyramid of
+# TILE_SIZE PNG tiles, level 0 being the whole map in one tile. Tiles are rendered on first request
+# and kept in an LRU cache; the coarse levels are block means built once per map. A map is named by
+# its path relative to the common directory of all maps (e.g. module03/map), since dat2npy.py writes
+# every module to the same file name.
+
+TILE_SIZE = 256
+DEFAULT_PORT = 8000
+
+def map_names(paths):
+    # Unique names: the paths relative to their common directory, without extension
+    paths = [os.path.abspath(path) for path in paths]
+    if len(set(paths)) != len(paths):
+        raise ValueError("The same map is given more than once")
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, '/') for path in paths]
+
+class MapSource:
+    def __init__(self, path, ids_path=None, name=None):
+        self.path = path
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        if is_tiled(path):
+            self.tiled = open_tiled(path)
+            self.full = None
+            self.shape = self.tiled.shape[::-1]
+        else:
+            self.tiled = None
+            # load_data orientation (rows = y); a .npy map stays memory-mapped
+            self.full = open_project(path).map_data if is_project(path) else np.load(path, mmap_mode='r').T
+            self.shape = self.full.shape
+        if ids_path is not None:
+            self.peak_ids = load_assigned_peaks(ids_path)
+        elif is_project(path):
+            # None when the project has no ids yet; np.array(None) would pass for a table
+            peak_ids = open_project(path).peak_ids
+            self.peak_ids = None if peak_ids is None else np.array(peak_ids)
+        else:
+            self.peak_ids = None
+        self.n_levels = 1 + max(0, math.ceil(math.log2(max(self.shape) / TILE_SIZE)))
+        self._levels = {}
+        self._lock = threading.RLock()  # level_data recurses into the finer levels
+        self._range = None
+
+    def factor(self, level):
+        return 2 ** (self.n_levels - 1 - level)
+
+    def level_shape(self, level):
+        factor = self.factor(level)
+        return self.shape[0] // factor, self.shape[1] // factor
+
+    def level_data(self, factor):
+        # Block-mean map at 1 / factor resolution, each level built from the next finer one
+        if factor == 1:
+            return self.full if self.tiled is None else self.tiled.read().T
+        with self._lock:
+            if factor not in self._levels:
+                finer = self._levels.get(factor // 2)
+                self._levels[factor] = downsample(self.level_data(factor // 2) if finer is None else finer)
+            return self._levels[factor]
+
+    def read(self, level, y1, y2, x1, x2):
+        factor = self.factor(level)
+        if factor > 1:
+            return np.asarray(self.level_data(factor)[y1:y2, x1:x2])
+        if self.tiled is not None:
+            return self.tiled.read_region((x1, y1, x2, y2))
+        return np.asarray(self.full[y1:y2, x1:x2])
+
+    def value_range(self):
+        # Colour scale of all tiles, from the coarsest level so it is the same at every zoom
+        if self._range is None:
+            coarsest = self.read(0, 0, self.shape[0], 0, self.shape[1]).astype(np.float64)
+            self._range = float(np.nanmin(coarsest)), float(np.nanmax(coarsest))
+        return self._range
+
+    def render_tile(self, level, tile_x, tile_y, cmap='jet'):
+        # Tile rows run from the top of the map (largest y) down, as in the editors (origin='lower')
+        height, width = self.level_shape(level)
+        x1, y2 = tile_x * TILE_SIZE, height - tile_y * TILE_SIZE
+        x2, y1 = min(x1 + TILE_SIZE, width), max(y2 - TILE_SIZE, 0)
+        rgb = np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+        if x1 < x2 and y1 < y2:
+            vmin, vmax = self.value_range()
+            pic = self.read(level, y1, y2, x1, x2)[::-1]
+            rgb[:y2 - y1, :x2 - x1] = Colormap(cmap)[ColorIndex(pic, vmin, vmax)]
+        return PngBytes(rgb)
+
+    def ids_json(self):
+        # [id_x, id_y, x, y] of every assigned crystal, normalized coordinates; KeyError (404) without ids
+        if self.peak_ids is None:
+            raise KeyError(self.name)
+        id_y, id_x = np.nonzero(~np.isnan(self.peak_ids[:, :, 0]))
+        positions = self.peak_ids[id_y, id_x]
+        return [[int(a), int(b), float(x), float(y)] for a, b, (x, y) in zip(id_x, id_y, positions)]
+
+    def info(self):
+        return {'name': self.name, 'width': self.shape[1], 'height': self.shape[0], 'levels': self.n_levels,
+                'tile_size': TILE_SIZE, 'n_pix': N_pix, 'ids': self.peak_ids is not None}
+
+class TileCache:
+    def __init__(self, sources, max_tiles=4096):
+        self.sources = {source.name: source for source in sources}
+        if len(self.sources) != len(sources):
+            raise ValueError("Map names are not unique: " + ', '.join(sorted(source.name for source in sources)))
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()  # (name, level, x, y) -> PNG bytes, least recently used first
+        self._lock = threading.Lock()
+
+    def tile(self, name, level, tile_x, tile_y):
+        key = (name, level, tile_x, tile_y)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        png = self.sources[name].render_tile(level, tile_x, tile_y)
+        with self._lock:
+            self._tiles[key] = png
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return png
+
+VIEWER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Calibration review</title>
+<style>body{margin:0;font:13px sans-serif;background:#222;color:#ddd}#bar{padding:4px}canvas{display:block}</style>
+</head><body>
+<div id="bar"><select id="module"></select> drag: pan, wheel: zoom, o: overlay on/off, l: ID labels on/off <span id="cursor"></span></div>
+<canvas id="view"></canvas>
+<script>
+const canvas = document.getElementById('view'), ctx = canvas.getContext('2d'), select = document.getElementById('module');
+let modules = [], map = null, ids = [], images = {}, overlay = true, labels = true;
+let scale = 1, originX = 0, originY = 0, drag = null;  // screen = origin + full-resolution pixel * scale
+function resize() { canvas.width = innerWidth; canvas.height = innerHeight - 30; draw(); }
+function load(index) {
+  map = modules[index]; images = {}; ids = [];
+  scale = Math.min(canvas.width / map.width, canvas.height / map.height); originX = 0; originY = 0;
+  if (map.ids) fetch('ids/' + encodeURIComponent(map.name) + '.json').then(r => r.json()).then(d => { ids = d; draw(); });
+  draw();
+}
+function tileImage(level, x, y) {
+  const key = encodeURIComponent(map.name) + '/' + level + '/' + x + '/' + y;
+  if (!images[key]) { const img = new Image(); img.onload = draw; img.src = 'tile/' + key + '.png'; images[key] = img; }
+  return images[key];
+}
+function draw() {
+  if (!map) return;
+  ctx.fillStyle = '#000'; ctx.fillRect(0, 0, canvas.width, canvas.height);
+  const level = Math.max(0, Math.min(map.levels - 1, map.levels - 1 + Math.ceil(Math.log2(scale))));
+  const factor = Math.pow(2, map.levels - 1 - level), size = map.tile_size * factor * scale;
+  const top = map.height - Math.floor(map.height / factor) * factor;  // rows the coarse level drops
+  for (let y = 0; y * map.tile_size * factor < map.height; y++)
+    for (let x = 0; x * map.tile_size * factor < map.width; x++) {
+      const sx = originX + x * size, sy = originY + (top + y * map.tile_size * factor) * scale;
+      if (sx > canvas.width || sy > canvas.height || sx + size < 0 || sy + size < 0) continue;
+      const img = tileImage(level, x, y);
+      if (img.complete && img.naturalWidth) ctx.drawImage(img, sx, sy, size, size);
+    }
+  if (!overlay) return;
+  ctx.strokeStyle = '#fff'; ctx.fillStyle = '#fff'; ctx.font = '10px sans-serif';
+  const pitch = map.width / (map.n_pix + 2) * scale;  // crystal pitch on screen
+  for (const [idX, idY, x, y] of ids) {
+    const sx = originX + (x + 1) / 2 * map.width * scale, sy = originY + (1 - y) / 2 * map.height * scale;
+    if (sx < 0 || sy < 0 || sx > canvas.width || sy > canvas.height) continue;
+    ctx.beginPath(); ctx.arc(sx, sy, 3, 0, 2 * Math.PI); ctx.stroke();
+    if (labels && pitch > 40) ctx.fillText(idX + ',' + idY, sx + 4, sy - 4);
+  }
+}
+canvas.onmousedown = e => { drag = [e.clientX - originX, e.clientY - originY]; };
+onmouseup = () => { drag = null; };
+canvas.onmousemove = e => {
+  if (drag) { originX = e.clientX - drag[0]; originY = e.clientY - drag[1]; draw(); }
+  if (map) {
+    const r = canvas.getBoundingClientRect(), px = (e.clientX - r.left - originX) / scale, py = (e.clientY - r.top - originY) / scale;
+    document.getElementById('cursor').textContent = 'x ' + (2 * px / map.width - 1).toFixed(4) + '  y ' + (1 - 2 * py / map.height).toFixed(4);
+  }
+};
+canvas.onwheel = e => {
+  e.preventDefault();
+  const r = canvas.getBoundingClientRect(), mx = e.clientX - r.left, my = e.clientY - r.top, k = e.deltaY < 0 ? 1.25 : 0.8;
+  originX = mx - (mx - originX) * k; originY = my - (my - originY) * k; scale *= k; draw();
+};
+onkeydown = e => { if (e.key === 'o') overlay = !overlay; if (e.key === 'l') labels = !labels; draw(); };
+select.onchange = () => load(select.value);
+onresize = resize;
+fetch('modules.json').then(r => r.json()).then(d => {
+  modules = d; d.forEach((m, i) => select.add(new Option(m.name, i))); resize(); load(0);
+});
+</script></body></html>
+"""
+
+class TileHandler(BaseHTTPRequestHandler):
+    def send(self, body, content_type, cache=True):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cache:
+            self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        cache = self.server.cache
+        # Names may contain '/', which the viewer sends encoded as %2F within one path segment
+        parts = [urllib.parse.unquote(part) for part in self.path.split('?')[0].strip('/').split('/')]
+        try:
+            if parts == ['']:
+                self.send(VIEWER.encode(), 'text/html; charset=utf-8', cache=False)
+            elif parts == ['modules.json']:
+                body = json.dumps([source.info() for source in cache.sources.values()])
+                self.send(body.encode(), 'application/json', cache=False)
+            elif len(parts) == 2 and parts[0] == 'ids' and parts[1].endswith('.json'):
+                self.send(json.dumps(cache.sources[parts[1][:-5]].ids_json()).encode(), 'application/json', cache=False)
+            elif len(parts) == 5 and parts[0] == 'tile' and parts[4].endswith('.png'):
+                name, level, tile_x, tile_y = parts[1], int(parts[2]), int(parts[3]), int(parts[4][:-4])
+                if not 0 <= level < cache.sources[name].n_levels:
+                    raise KeyError(level)
+                self.send(cache.tile(name, level, tile_x, tile_y), 'image/png')
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError):
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass  # one line per tile would flood the console
+
+def serve(sources, port=DEFAULT_PORT, max_tiles=4096):
+    server = ThreadingHTTPServer(('localhost', port), TileHandler)
+    server.cache = TileCache(sources, max_tiles)
+    print(f"Serving {len(sources)} map(s) at http://localhost:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    args = sys.argv[1:]
+    port = int(args.pop()) if args and args[-1].isdigit() else DEFAULT_PORT
+    if not args or args[0].endswith('.csv'):
+        print('Usage: python TileServer.py <map.npy | map.tmap | project.calib> [ids.csv] [<map> [ids.csv] ...] [port]')
+        return
+    maps = []  # [map path, ids path or None]
+    for arg in args:
+        if arg.endswith('.csv'):
+            maps[-1][1] = arg
+        else:
+            maps.append([arg, None])
+    try:
+        names = map_names([path for path, _ in maps])
+    except ValueError as e:
+        print(e)
+        return
+    serve([MapSource(path, ids_path, name) for (path, ids_path), name in zip(maps, names)], port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import zlib
+import lzma
+import struct
+import threading
+import weakref
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Tiled map file (.tmap): the array dat2npy.py would save as .npy (file orientation), cut into
+# tile_size x tile_size tiles that are compressed independently, so a viewer, a selected region or a
+# tiled detector decompresses only the tiles it touches.
+#   b'TMAP' | uint32 header length | JSON header {shape, dtype, tile_size, codec, shuffle}
+#   | int64 index (n_tile_rows * n_tile_cols, 2) of (offset, length) | compressed tiles
+# With shuffle the bytes of each tile are grouped by significance before compression (as in blosc),
+# which compresses smooth count maps much better than the raw little-endian layout.
+
+TILED_EXTENSION = '.tmap'
+MAGIC = b'TMAP'
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+def is_tiled(file_path):
+    return str(file_path).endswith(TILED_EXTENSION)
+
+def shuffle_bytes(tile):
+    return np.ascontiguousarray(tile).view(np.uint8).reshape(-1, tile.dtype.itemsize).T.tobytes()
+
+def unshuffle_bytes(data, dtype, shape):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+def save_tiled(file_path, data, tile_size=256, codec='zlib', level=1, shuffle=True, n_threads=None):
+    # data in file orientation, i.e. exactly what dat2npy.py saves
+    data = np.asarray(data)
+    compress = CODECS[codec][0]
+    n_rows, n_cols = -(-data.shape[0] // tile_size), -(-data.shape[1] // tile_size)
+    header = json.dumps({'shape': list(data.shape), 'dtype': data.dtype.str, 'tile_size': tile_size,
+                         'codec': codec, 'shuffle': shuffle}).encode()
+
+    def encode(index):
+        row, col = divmod(index, n_cols)
+        tile = data[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+        return compress(shuffle_bytes(tile) if shuffle else np.ascontiguousarray(tile).tobytes(), level)
+
+    index = np.zeros((n_rows * n_cols, 2), dtype=np.int64)
+    with open(file_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        index_offset = f.tell()
+        f.write(index.tobytes())
+        # zlib and lzma release the GIL, so tiles compress in parallel; they are written in order
+        with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+            for i, compressed in enumerate(pool.map(encode, range(n_rows * n_cols))):
+                index[i] = f.tell(), len(compressed)
+                f.write(compressed)
+        f.seek(index_offset)
+        f.write(index.tobytes())
+
+class TiledMap:
+    def __init__(self, file_path, max_tiles=512):
+        self.path = file_path
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()  # (row, col) -> array, least recently used first
+        self._lock = threading.Lock()
+        with open(file_path, 'rb') as f:
+            if f.read(4) != MAGIC:
+                raise ValueError(f"{file_path} is not a tiled map")
+            header_length, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_length))
+            self.shape = tuple(header['shape'])
+            self.dtype = np.dtype(header['dtype'])
+            self.tile_size = header['tile_size']
+            self.codec = header['codec']
+            self.shuffle = header['shuffle']
+            self.n_tiles = (-(-self.shape[0] // self.tile_size), -(-self.shape[1] // self.tile_size))
+            self.index = np.frombuffer(f.read(self.n_tiles[0] * self.n_tiles[1] * 16), dtype=np.int64).reshape(-1, 2)
+
+    def tile_shape(self, row, col):
+        return (min(self.tile_size, self.shape[0] - row * self.tile_size),
+                min(self.tile_size, self.shape[1] - col * self.tile_size))
+
+    def _read_tile(self, row, col):
+        offset, length = self.index[row * self.n_tiles[1] + col]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = CODECS[self.codec][1](f.read(length))
+        shape = self.tile_shape(row, col)
+        if self.shuffle:
+            return unshuffle_bytes(data, self.dtype, shape)
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def tile(self, row, col, cache=True):
+        key = (row, col)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        tile = self._read_tile(row, col)
+        if not cache:
+            return tile
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def read(self, row_start=0, row_stop=None, col_start=0, col_stop=None, n_threads=None, cache=None):
+        # [row_start:row_stop, col_start:col_stop] in file orientation, decompressing only the tiles it covers.
+        # cache: keep the tiles for later reads; by default only for regions smaller than the whole map,
+        # so a full load does not leave a second copy of the map in the tile cache
+        row_stop = self.shape[0] if row_stop is None else min(row_stop, self.shape[0])
+        col_stop = self.shape[1] if col_stop is None else min(col_stop, self.shape[1])
+        row_start, col_start = max(0, row_start), max(0, col_start)
+        out = np.empty((max(0, row_stop - row_start), max(0, col_stop - col_start)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        if cache is None:
+            cache = out.shape != self.shape
+        size = self.tile_size
+        keys = [(row, col) for row in range(row_start // size, (row_stop - 1) // size + 1)
+                for col in range(col_start // size, (col_stop - 1) // size + 1)]
+
+        def copy(key):
+            row, col = key
+            tile = self.tile(row, col, cache)
+            r1, r2 = max(row_start, row * size), min(row_stop, (row + 1) * size)
+            c1, c2 = max(col_start, col * size), min(col_stop, (col + 1) * size)
+            out[r1 - row_start:r2 - row_start, c1 - col_start:c2 - col_start] = \
+                tile[r1 - row * size:r2 - row * size, c1 - col * size:c2 - col * size]
+
+        if len(keys) == 1:
+            copy(keys[0])
+        else:
+            with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+                list(pool.map(copy, keys))
+        return out
+
+    def read_region(self, region):
+        # region (x1, y1, x2, y2) in load_data orientation (rows = y), as MapSelector returns it
+        x1, y1, x2, y2 = region
+        return self.read(x1, x2, y1, y2).T
+
+    def preview(self, max_size=1024):
+        # Block-mean overview in file orientation with the longer side at most max_size (the factor is a
+        # power of two up to tile_size), built one band of tiles at a time without filling the cache
+        factor = 1
+        while max(self.shape) > max_size * factor and factor < self.tile_size:
+            factor *= 2
+        bands = []
+        for row in range(0, self.shape[0], self.tile_size):
+            band = self.read(row, row + self.tile_size, cache=False)
+            height, width = (band.shape[0] // factor) * factor, (band.shape[1] // factor) * factor
+            bands.append(band[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3)))
+        return np.concatenate(bands), factor
+
+class MapView:
+    # A tiled map in load_data orientation (rows = y) that reads lazily: data[y1:y2, x1:x2] decompresses
+    # only the tiles of that region, so the detectors and MapSelector can work on a selected region
+    # without loading the whole map. np.asarray(view) reads everything.
+    def __init__(self, tiled):
+        self.tiled = tiled
+        self.shape = tiled.shape[::-1]
+        self.dtype = tiled.dtype
+        self.ndim = 2
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if not (isinstance(rows, slice) and isinstance(cols, slice)) or rows.step not in (None, 1) or cols.step not in (None, 1):
+            raise TypeError("MapView only supports data[y1:y2, x1:x2]")
+        y1, y2, _ = rows.indices(self.shape[0])
+        x1, x2, _ = cols.indices(self.shape[1])
+        return self.tiled.read_region((x1, y1, x2, y2))
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.tiled.read().T
+        return data if dtype is None else data.astype(dtype)
+
+    def preview(self, max_size=1024):
+        preview, factor = self.tiled.preview(max_size)
+        return preview.T, factor
+
+# Tools share one TiledMap (and its tile cache) per file while any of them holds it
+_open_maps = weakref.WeakValueDictionary()
+
+def open_tiled(file_path):
+    file_path = os.path.abspath(file_path)
+    tiled = _open_maps.get(file_path)
+    if tiled is None or os.path.getmtime(file_path) != tiled.mtime:
+        tiled = TiledMap(file_path)
+        tiled.mtime = os.path.getmtime(file_path)
+        _open_maps[file_path] = tiled
+    return tiled
+
+def load_map(file_path, mmap_mode=None):
+    # Map in file orientation from a .npy or .tmap file; loaders transpose it like np.load(...).T
+    if is_tiled(file_path):
+        return open_tiled(file_path).read()
+    return np.load(file_path, mmap_mode=mmap_mode)
+
+def open_map_view(file_path):
+    # Map in load_data orientation for tools that may only need a region: a lazy MapView of a .tmap
+    # file, the loaded array otherwise
+    if is_tiled(file_path):
+        return MapView(open_tiled(file_path))
+    return load_map(file_path).T
+
+def main():
+    if len(sys.argv) < 3:
+        print('Usage: python TiledMap.py <map.npy> <map.tmap> [tile_size] [zlib | lzma] [level]')
+        print('       python TiledMap.py <map.tmap> <map.npy>')
+        return
+    input_file_path, output_file_path = sys.argv[1:3]
+    if is_tiled(output_file_path):
+        tile_size = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+        codec = sys.argv[4] if len(sys.argv) > 4 else 'zlib'
+        level = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        save_tiled(output_file_path, np.load(input_file_path, mmap_mode='r'), tile_size, codec, level)
+    else:
+        np.save(output_file_path, load_map(input_file_path))
+    print(f"Saved {output_file_path}: {os.path.getsize(input_file_path) / 2**20:.1f} MB -> "
+          f"{os.path.getsize(output_file_path) / 2**20:.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import threading
+import tkinter as tk
+from tkinter import ttk, messagebox
+from concurrent.futures import ThreadPoolExecutor
+
+# Heavy work (loading, detection, assignment, saving) runs on a worker thread; results come back to
+# the Tk main thread through root.after polling, so the window keeps redrawing while it waits.
+
+class Cancelled(Exception):
+    pass
+
+class Task:
+    def __init__(self, key, label, future=None):
+        self.key = key
+        self.label = label
+        self.future = future
+        self.fraction = None
+        self.cancel_event = threading.Event()
+
+    def progress(self, fraction):
+        # Called from the worker; also the cooperative cancellation point
+        self.fraction = fraction
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+class BackgroundRunner:
+    def __init__(self, master, max_workers=2, poll_ms=50):
+        self.master = master
+        self.poll_ms = poll_ms
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.tasks = {}  # key -> (task, on_done, on_error); only the newest task per key is kept
+        self.polling = False
+
+        self.frame = ttk.Frame(master)
+        self.frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.status_label = ttk.Label(self.frame, text="")
+        self.status_label.pack(side=tk.LEFT, padx=5)
+        self.progress_bar = ttk.Progressbar(self.frame, length=200, maximum=1.0)
+        self.progress_bar.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(self.frame, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
+    def submit(self, key, func, *args, on_done=None, on_error=None, label='', with_progress=False):
+        # A new request under the same key supersedes the one in flight; its result is dropped
+        previous = self.tasks.get(key)
+        if previous is not None:
+            previous[0].cancel_event.set()
+        task = Task(key, label)
+        kwargs = {'progress': task.progress} if with_progress else {}
+        task.future = self.pool.submit(func, *args, **kwargs)
+        self.tasks[key] = (task, on_done, on_error)
+        if not self.polling:
+            self.polling = True
+            self.master.after(self.poll_ms, self.poll)
+        self.update_status()
+        return task
+
+    def cancel(self):
+        for task, _, _ in self.tasks.values():
+            task.cancel_event.set()
+        self.tasks.clear()
+        self.update_status()
+
+    def busy(self):
+        return bool(self.tasks)
+
+    def poll(self):
+        # A callback that raises is reported and does not stop the loop: polling is always
+        # rescheduled (or cleared) afterwards, so later tasks still get their results
+        try:
+            for key, (task, on_done, on_error) in list(self.tasks.items()):
+                if not task.future.done():
+                    continue
+                del self.tasks[key]
+                try:
+                    self.deliver(task, on_done, on_error)
+                except Exception as e:
+                    messagebox.showerror("Error", f"{task.label or key}: handling the result failed: {str(e)}")
+        finally:
+            self.polling = bool(self.tasks)
+            if self.polling:
+                self.master.after(self.poll_ms, self.poll)
+            self.update_status()
+
+    def deliver(self, task, on_done, on_error):
+        try:
+            result = task.future.result()
+        except Cancelled:
+            return
+        except Exception as e:
+            if on_error is not None:
+                on_error(e)
+            else:
+                messagebox.showerror("Error", f"{task.label or task.key} failed: {str(e)}")
+            return
+        if on_done is not None:
+            on_done(result)
+
+    def update_status(self):
+        if not self.tasks:
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode='determinate', value=0)
+            self.status_label['text'] = ""
+            self.cancel_button['state'] = tk.DISABLED
+            return
+        task = next(reversed(self.tasks.values()))[0]
+        self.status_label['text'] = f"{task.label or task.key}..."
+        self.cancel_button['state'] = tk.NORMAL
+        if task.fraction is None:
+            if str(self.progress_bar['mode']) != 'indeterminate':
+                self.progress_bar.configure(mode='indeterminate')
+                self.progress_bar.start(10)
+        else:
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode='determinate', value=task.fraction)
+
+    def shutdown(self):
+        self.cancel()
+        self.pool.shutdown(wait=False)
+
+def run_with_progress(title, func, *args, with_progress=False):
+    # Blocking helper for the script-style tools: shows a small progress window while func runs.
+    # Returns func's result, or None if the user cancelled or closed the window.
+    root = tk.Tk()
+    root.title(title)
+    root.geometry("400x60")
+    runner = BackgroundRunner(root)
+    result = {}
+
+    def done(value):
+        result['value'] = value
+        root.quit()
+
+    def failed(error):
+        messagebox.showerror("Error", f"{title} failed: {str(error)}")
+        root.quit()
+
+    def cancel():
+        runner.cancel()
+        root.quit()
+
+    runner.cancel_button['command'] = cancel
+    root.protocol("WM_DELETE_WINDOW", cancel)
+    runner.submit(title, func, *args, on_done=done, on_error=failed, label=title, with_progress=with_progress)
+    root.mainloop()
+    runner.shutdown()
+    root.destroy()
+    return result.get('value')
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import tracemalloc
+import subprocess
+import numpy as np
+
+# Benchmarks for the calibration pipeline. Run from the repository root:
+#     python benchmark.py            list the benchmarks
+#     python benchmark.py <name>     run one of them
+#
+# import: cold-start import time of the headless core in a fresh interpreter, and whether any
+#     GUI/plotting module was pulled in. Median of 5 runs, Python 3.11, Linux, one core. 'before' is
+#     the same measurement on the tree before the imports were made lazy; 'now' is this benchmark's
+#     output (PeakDetector and PeakIDAssigner have since gained scipy.spatial and TiledMap imports):
+#         module          before                     now
+#         utils           0.685 s (matplotlib)       0.149 s
+#         PeakDetector    1.013 s (mpl, tk, skimage) 0.556 s
+#         PeakIDAssigner  0.882 s (mpl, tk, pandas)  0.448 s
+#     No headless module loads matplotlib, tkinter, pandas or skimage on import any more.
+
+# precision: detect_peaks on a synthetic 4000x4000 Poisson flood map stored as float64 (what
+#     dat2npy.py wrote before) versus uint16 counts smoothed in float32, with a check that both paths
+#     return the same peaks. Peak memory is what detection allocates on top of the input map.
+#     Median of 3 runs:
+#         path              map size   time     peak memory   peaks
+#         float64           122 MB     1.52 s   275 MB        2025
+#         uint16 / float32   31 MB     1.45 s   153 MB        2025 (identical)
+#
+# dog: the single-sigma 'gaussian' engine versus the 'dog' scale-space engine on 2000x2000 maps whose
+#     crystal sigma grows toward the edge (graded_map, growth 0 / 1 / 2.5, i.e. uniform / up to 3x /
+#     6x wider and correspondingly dimmer corner crystals). A crystal is found if a peak lies within
+#     pitch / 4 of it; a peak is false if no crystal does. Output of 'python benchmark.py dog', one core:
+#         engine      sigma  growth  time [s]   found  missed  false
+#         gaussian     1.00     0.0      0.35    2025       0      0
+#         gaussian     2.66     0.0      0.36    2025       0      0
+#         gaussian     5.32     0.0      0.40    2025       0      0
+#         dog          1.00     0.0      2.27    2025       0      0
+#         dog          2.66     0.0      2.07    2025       0      0
+#         gaussian     1.00     1.0      0.26    2025       0      0
+#         gaussian     2.66     1.0      0.31    2025       0      0
+#         gaussian     5.32     1.0      0.38    2025       0      0
+#         dog          1.00     1.0      1.88    2010      15     13   (scales too small for the corners)
+#         dog          2.66     1.0      2.00    2025       0      0
+#         gaussian     1.00     2.5      0.32    1771     254    158
+#         gaussian     2.66     2.5      0.35    1816     209     84
+#         gaussian     5.32     2.5      0.37    1798     227     14
+#         dog          1.00     2.5      2.29    1551     474    489
+#         dog          2.66     2.5      2.44    1740     285      9
+#     The DoG engine is about 6x slower and gives the fewest false peaks where crystals are wide, but
+#     at growth 2.5 the corner crystals overlap their neighbours and no engine resolves all of them.
+#     Its sigma should be about the narrowest crystal sigma: a much smaller one spends the lowest
+#     scales on Poisson noise (false peaks at sigma 1) and does not reach the widest crystals.
+#
+# coarse: detect_peaks on the 4000x4000 synthetic map of 'precision' (uint16), full resolution versus
+#     the coarse-to-fine engine at several downsampling factors. Median of 3 runs:
+#         engine      time     peak memory   peaks
+#         gaussian    1.59 s   153 MB        2025
+#         coarse x2   0.88 s    38 MB        2025 (identical)
+#         coarse x4   0.40 s    18 MB        2025 (identical)
+#         coarse x8   0.38 s    17 MB        2025 (identical)
+#     Peaks are identical wherever the smoothed crystals have one clear maximum. On graded_map with
+#     growth 2.5 and sigma 1, where wide crystals break up into noise maxima, 82 % of the peaks coincide.
+
+HEADLESS_MODULES = ['utils', 'PeakDetector', 'PeakIDAssigner', 'CrystalMetrics', 'EventMapper',
+                    'CalibrationDiff', 'CalibrationProject', 'dat2npy', 'MapSum', 'Distortion',
+                    'EnergyCalibration', 'TiledMap', 'Bootstrap', 'TileServer']
+GUI_MODULES = ['matplotlib', 'tkinter', 'pandas', 'skimage']
+
+def bench_import(repeat=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'module':<20}{'median [s]':>12}  GUI modules loaded")
+    for module in HEADLESS_MODULES:
+        code = (f"import time, sys; t = time.perf_counter(); import {module}; t = time.perf_counter() - t; "
+                f"print(t, ','.join(m for m in {GUI_MODULES!r} if m in sys.modules))")
+        times, loaded = [], ''
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=here, check=True)
+            elapsed, _, loaded = out.stdout.strip().partition(' ')
+            times.append(float(elapsed))
+        print(f"{module:<20}{np.median(times):>12.3f}  {loaded or '-'}")
+
+def synthetic_map(size=4000, n_pix=45, sigma=None, counts=200, background=5, seed=0):
+    # Poisson flood map with an n_pix x n_pix lattice of Gaussian crystal responses, in file orientation
+    from scipy.ndimage import gaussian_filter
+    pitch = size / (n_pix + 2)
+    sigma = sigma or pitch / 8
+    centres = np.round((np.arange(n_pix) + 1.5) * pitch).astype(int)
+    image = np.zeros((size, size))
+    image[np.ix_(centres, centres)] = counts * 2 * np.pi * sigma ** 2
+    image = gaussian_filter(image, sigma) + background
+    return np.random.default_rng(seed).poisson(image).astype(np.uint16)
+
+def graded_map(size=2000, n_pix=45, growth=1.0, counts=200, background=5, seed=0):
+    # Like synthetic_map, but the crystal sigma grows from pitch / 8 at the centre to
+    # (1 + growth * r^2) times that at normalized radius r, with the counts of every crystal conserved
+    # (wide edge crystals are also dim). Returns the map and the true peak positions in (row, col).
+    pitch = size / (n_pix + 2)
+    centres = (np.arange(n_pix) + 1.5) * pitch
+    rows, cols = [c.ravel() for c in np.meshgrid(centres, centres, indexing='ij')]
+    sigma0 = pitch / 8
+    sigmas = sigma0 * (1 + growth * ((rows - size / 2) ** 2 + (cols - size / 2) ** 2) / (size / 2) ** 2)
+    image = np.full((size, size), float(background))
+    for row, col, sigma in zip(rows, cols, sigmas):
+        reach = int(4 * sigma)
+        r0, r1 = max(int(row) - reach, 0), min(int(row) + reach + 1, size)
+        c0, c1 = max(int(col) - reach, 0), min(int(col) + reach + 1, size)
+        r, c = np.ogrid[r0:r1, c0:c1]
+        image[r0:r1, c0:c1] += counts * (sigma0 / sigma) ** 2 * np.exp(-((r - row) ** 2 + (c - col) ** 2) / (2 * sigma ** 2))
+    return np.random.default_rng(seed).poisson(image).astype(np.uint16), np.column_stack([rows, cols])
+
+def measure(func, *args, repeat=3, **kwargs):
+    # Median wall time and peak traced memory (MB) of func(*args, **kwargs)
+    times, peaks, result = [], [], None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1] / 2**20)
+        tracemalloc.stop()
+    return result, np.median(times), np.median(peaks)
+
+def bench_precision(size=4000):
+    from PeakDetector import detect_peaks
+    counts = synthetic_map(size).T
+    sigma = size / 47 / 8
+    min_distance = int(size / 47 / 2)
+    print(f"{'path':<18}{'map [MB]':>10}{'time [s]':>10}{'peak [MB]':>11}{'peaks':>8}")
+    results = {}
+    for label, data in [('float64', counts.astype(np.float64)), ('uint16 / float32', counts)]:
+        peaks, elapsed, memory = measure(detect_peaks, data, sigma=sigma, min_distance=min_distance)
+        results[label] = peaks
+        print(f"{label:<18}{data.nbytes / 2**20:>10.0f}{elapsed:>10.2f}{memory:>11.0f}{len(peaks):>8}")
+    same = {tuple(p) for p in results['float64']} == {tuple(p) for p in results['uint16 / float32']}
+    print(f"Identical peaks: {same}")
+
+def bench_dog(size=2000):
+    from scipy.spatial import cKDTree
+    from PeakDetector import detect_peaks
+    pitch = size / 47
+    min_distance = int(pitch / 2)
+    print(f"{'engine':<10}{'sigma':>7}{'growth':>8}{'time [s]':>10}{'found':>8}{'missed':>8}{'false':>7}")
+    for growth in [0.0, 1.0, 2.5]:
+        data, truth = graded_map(size, growth=growth)
+        for engine, sigma in [('gaussian', 1), ('gaussian', pitch / 16), ('gaussian', pitch / 8), ('dog', 1), ('dog', pitch / 16)]:
+            peaks, elapsed, _ = measure(detect_peaks, data, sigma=sigma, min_distance=min_distance, engine=engine, repeat=1)
+            distance, _ = cKDTree(peaks).query(truth) if len(peaks) else (np.full(len(truth), np.inf), None)
+            found = int((distance < pitch / 4).sum())
+            matched = cKDTree(truth).query(peaks)[0] < pitch / 4 if len(peaks) else np.zeros(0, dtype=bool)
+            print(f"{engine:<10}{sigma:>7.2f}{growth:>8.1f}{elapsed:>10.2f}{found:>8}{len(truth) - found:>8}{int((~matched).sum()):>7}")
+
+def bench_coarse(size=4000):
+    from PeakDetector import detect_peaks
+    counts = synthetic_map(size).T
+    sigma = size / 47 / 8
+    min_distance = int(size / 47 / 2)
+    print(f"{'engine':<14}{'time [s]':>10}{'peak [MB]':>11}{'peaks':>8}  same as gaussian")
+    reference = None
+    for label, options in [('gaussian', {}), ('coarse x2', {'engine': 'coarse', 'coarse_factor': 2}),
+                           ('coarse x4', {'engine': 'coarse', 'coarse_factor': 4}),
+                           ('coarse x8', {'engine': 'coarse', 'coarse_factor': 8})]:
+        peaks, elapsed, memory = measure(detect_peaks, counts, sigma=sigma, min_distance=min_distance, **options)
+        reference = {tuple(p) for p in peaks} if reference is None else reference
+        print(f"{label:<14}{elapsed:>10.2f}{memory:>11.0f}{len(peaks):>8}  {reference == {tuple(p) for p in peaks}}")
+
+def bench_gui():
+    # Editor redraw latency on the Agg backend; see GUIBenchmark.py for sizes and repeats
+    from GUIBenchmark import run
+    run()
+
+BENCHMARKS = {
+    'import': bench_import,
+    'precision': bench_precision,
+    'dog': bench_dog,
+    'coarse': bench_coarse,
+    'gui': bench_gui,
+}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('Usage: python benchmark.py <' + ' | '.join(BENCHMARKS) + '>')
+        return
+    BENCHMARKS[sys.argv[1]]()
+
+if __name__ == "__main__":
+    main()
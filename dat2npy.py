@@ -1,29 +1,92 @@
 import os
 import sys
-import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 
 from utils import *
+from TiledMap import save_tiled
 
-argvs = sys.argv
-file_path = argvs[1]
-file_name = argvs[2]
+# .dat dumps come in two layouts: one comma-separated map row per line (4000x4000 detector dumps) and
+# one value per line (the 1000x1000 maps GUI.py reads). Both are read as a flat stream of numbers;
+# maps are square, so the shape follows from the number of values unless it is given.
 
-if __name__ == '__main__':
-    f = open(file_name,'r')
-    data=[]
-    for line in f:
-        line = line[:-1].split(',')
-        data.append(line)
-    f.close()
-    data=np.array(data, dtype=float)
-    data=data.reshape([4000,4000])#.T
+def iter_dat_chunks(file_name, chunk_size=1 << 22):
+    # Streams a .dat dump as (offset, flat float64 values) chunks, in file order, so a map never has to
+    # be held as text or as one list in memory. Values may be separated by commas and/or whitespace.
+    offset, tail = 0, b''
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(chunk_size * 4)  # a few bytes of text per value
+            text = tail + block
+            if block:
+                # Keep a number cut at the block end for the next block
+                cut = max(text.rfind(separator) for separator in (b',', b'\n', b' ', b'\t')) + 1
+                text, tail = text[:cut], text[cut:]
+            text = text.replace(b',', b' ').strip()
+            if text:
+                values = np.fromstring(text.decode(), dtype=np.float64, sep=' ')
+                yield offset, values
+                offset += len(values)
+            if not block:
+                return
+
+def count_dat_values(file_name, block_size=1 << 24):
+    # Number of values in a .dat dump without parsing them: count the starts of non-separator runs
+    separators = np.zeros(256, dtype=bool)
+    separators[list(b', \t\r\n')] = True
+    count, previous = 0, True
+    with open(file_name, 'rb') as f:
+        while block := f.read(block_size):
+            is_separator = separators[np.frombuffer(block, dtype=np.uint8)]
+            starts = ~is_separator & np.concatenate([[previous], is_separator[:-1]])
+            count += int(starts.sum())
+            previous = bool(is_separator[-1])
+    return count
+
+def dat_shape(file_name):
+    count = count_dat_values(file_name)
+    side = int(np.sqrt(count))
+    if side * side != count:
+        raise ValueError(f'{file_name} has {count} values, which is not a square map; give read_dat its shape')
+    return side, side
+
+def read_dat(file_name, shape=None, dtype=np.float64):
+    # shape: (rows, cols) of the map; inferred from the number of values when None
+    shape = shape or dat_shape(file_name)
+    data = np.empty(int(np.prod(shape)), dtype=dtype)
+    count = 0
+    for offset, values in iter_dat_chunks(file_name):
+        if offset + len(values) > len(data):
+            raise ValueError(f'{file_name} has more than {len(data)} values for a {shape} map')
+        data[offset:offset + len(values)] = values
+        count = offset + len(values)
+    if count != len(data):
+        raise ValueError(f'{file_name} has {count} values, expected {len(data)} for a {shape} map')
+    return data.reshape(shape)
+
+def main():
+    argvs = sys.argv
+    file_path = argvs[1]
+    file_name = argvs[2]
+    # Optional storage precision: float64 (default), float32 or uint16 for integer counts
+    dtype = np.dtype(argvs[3]) if len(argvs) > 3 else np.float64
+    # Optional storage format: npy (default) or tiled (compressed tiles, see TiledMap.py)
+    tiled = len(argvs) > 4 and argvs[4] == 'tiled'
+
+    data=read_dat(file_name)#.T
+    if np.issubdtype(dtype, np.integer) and (data.min() < np.iinfo(dtype).min or data.max() > np.iinfo(dtype).max):
+        raise ValueError(f'Map values {data.min()}..{data.max()} do not fit in {dtype}')
+    data=data.astype(dtype)
     file_name=file_path+'/map'
     Image(data,file_name)
-    np.save(file_name, data)
+    if tiled:
+        save_tiled(file_name + '.tmap', data)
+    else:
+        np.save(file_name, data)
 
     #data=cv2.GaussianBlur(data,(11,11),3)
     #file_name='./output/blur_map'
     #Image(data,file_name)
     #np.save(file_name, data)
+
+if __name__ == '__main__':
+    main()
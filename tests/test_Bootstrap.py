@@ -0,0 +1,23 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PeakIDAssigner import N_pix
+from Bootstrap import bootstrap_positions
+from benchmark import synthetic_map
+
+def lattice_ids(size):
+    # IDs [id_y][id_x] of the synthetic_map lattice in normalized coordinates
+    centres = np.round((np.arange(N_pix) + 1.5) * size / (N_pix + 2))
+    grid_x, grid_y = np.meshgrid(centres, centres[::-1])
+    return np.stack([2 * grid_x / size - 1, 2 * grid_y / size - 1], axis=2)
+
+@pytest.mark.parametrize('refine', [False, True])
+def test_std_is_positive_on_noisy_map(refine):
+    size = 500
+    result = bootstrap_positions(synthetic_map(size).T, lattice_ids(size), n_replicas=8, workers=1, refine=refine)
+    assert np.isfinite(result['std_x']).all() and np.isfinite(result['std_y']).all()
+    assert (result['std_x'] > 0).all() and (result['std_y'] > 0).all()
+    assert (result['n_replicas'] == 8).all()
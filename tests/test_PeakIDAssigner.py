@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PeakIDAssigner import N_pix, ASSIGNERS
+
+def distorted_lattice(shear, wavelength=0.8, noise=0.001, hole=3, seed=1):
+    # Ground-truth IDs [id_y][id_x] of a lattice bent by a sinusoidal displacement with a peak local
+    # shear of `shear`, plus position noise and a hole x hole gap in the middle (nan)
+    rng = np.random.default_rng(seed)
+    index = np.arange(N_pix)
+    id_x, id_y = np.meshgrid(index, index)
+    pitch = 1.8 / N_pix
+    x, y = (id_x - N_pix // 2) * pitch, -(id_y - N_pix // 2) * pitch
+    k = 2 * np.pi / wavelength
+    truth = np.stack([x + shear / k * np.sin(k * y), y + shear / k * np.sin(k * x)], axis=2)
+    truth += rng.normal(0, noise, truth.shape)
+    half = hole // 2
+    truth[N_pix // 2 - half:N_pix // 2 + half + 1, N_pix // 2 - half:N_pix // 2 + half + 1] = np.nan
+    return truth
+
+def score(peak_ids, truth):
+    # (correct, wrong) assigned IDs
+    assigned = ~np.isnan(peak_ids[:, :, 0])
+    correct = np.isclose(peak_ids, truth).all(axis=2)
+    return int(correct.sum()), int((assigned & ~correct).sum())
+
+@pytest.mark.parametrize('name', ['tuned', 'graph'])
+@pytest.mark.parametrize('shear', [0.0, 0.06, 0.1])
+def test_distorted_lattice_ids(name, shear):
+    truth = distorted_lattice(shear)
+    peaks = truth[~np.isnan(truth[:, :, 0])]
+    seed_id = [N_pix // 2 + 2, N_pix // 2]  # just right of the hole
+    peak_ids = ASSIGNERS[name](peaks, truth[seed_id[1], seed_id[0]], seed_id)
+    correct, wrong = score(peak_ids, truth)
+    assert wrong == 0
+    assert correct == len(peaks)
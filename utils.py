@@ -1,6 +1,9 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import csv
+import os
+import zlib
+import struct
+from concurrent.futures import ProcessPoolExecutor
 
 pixel_size_=5
 repeat_=50*50
@@ -23,6 +26,7 @@ def Fv():
     return flag_value_
 
 def Image(pic,name):
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(10, 10), dpi=100)
     ax1 = fig.add_subplot(1, 1, 1)
     ax1.set(xlabel='X position', xticks=ticks, xticklabels=labels)
@@ -33,16 +37,96 @@ def Image(pic,name):
     return 0
 
 
-def Visualize(input_name, posi_list, output_name, val):
+# matplotlib's jet segment data, so Png output matches Image colours without building a figure
+_jet_data = {'red': ([0, 0.35, 0.66, 0.89, 1], [0, 0, 1, 1, 0.5]),
+             'green': ([0, 0.125, 0.375, 0.64, 0.91, 1], [0, 0, 1, 1, 0, 0]),
+             'blue': ([0, 0.11, 0.34, 0.65, 1], [0.5, 1, 1, 0, 0])}
+_luts = {}
+
+def Colormap(cmap='jet'):
+    if cmap not in _luts:
+        x = np.linspace(0, 1, 256)
+        if cmap == 'jet':
+            rgb = np.stack([np.interp(x, *_jet_data[c]) for c in ['red', 'green', 'blue']], axis=1)
+        else:
+            from matplotlib import colormaps
+            rgb = colormaps[cmap](x)[:, :3]
+        _luts[cmap] = np.round(rgb * 255).astype(np.uint8)
+    return _luts[cmap]
+
+def Shrink(pic, size):
+    # Block-mean downsample so that the longer side is at most size pixels
+    factor = -(-max(pic.shape) // size)
+    if factor <= 1:
+        return np.asarray(pic)
+    height, width = (pic.shape[0] // factor) * factor, (pic.shape[1] // factor) * factor
+    return np.asarray(pic[:height, :width]).reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+
+def PngBytes(rgb, level=1):
+    height, width, _ = rgb.shape
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)  # filter byte 0 at the start of each row
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), level)) + chunk(b'IEND', b''))
+
+def WritePng(rgb, file_name, level=1):
+    with open(file_name, 'wb') as f:
+        f.write(PngBytes(rgb, level))
+
+def ColorIndex(pic, vmin, vmax):
+    # Colormap index 0..255 of every pixel; in float64 so unsigned maps do not wrap below vmin, NaN -> 0
+    pic = np.asarray(pic, dtype=np.float64)
+    scale = 256 / (vmax - vmin) if vmax > vmin else 0
+    index = np.clip((pic - vmin) * scale, 0, 255)
+    index[np.isnan(index)] = 0
+    return index.astype(np.uint8)
+
+def Png(pic, name, cmap='jet', vmin=None, vmax=None, size=None):
+    # Same orientation and colour scaling as Image (pic.T, min..max), without axes
+    if size is not None:
+        pic = Shrink(pic, size)
+    pic = np.asarray(pic).T
+    vmin = np.nanmin(pic) if vmin is None else vmin
+    vmax = np.nanmax(pic) if vmax is None else vmax
+    WritePng(Colormap(cmap)[ColorIndex(pic, vmin, vmax)], name + '.png')
+    return 0
+
+def Stamp(pic, posi_list, val):
+    # Markers of side 2*pixel_size_ at every (Xp, Yp) = posi[2:4], written in one fancy-indexing pass
+    posi = np.array([p[2:4] for p in posi_list], dtype=int).reshape(-1, 2)
+    posi = posi[(posi[:, 0] != 0) & (posi[:, 1] != 0)]
+    offsets = np.arange(-pixel_size_, pixel_size_)
+    rows = np.broadcast_to(posi[:, 0, None, None] + offsets[None, :, None], (len(posi), 2 * pixel_size_, 2 * pixel_size_))
+    cols = np.broadcast_to(posi[:, 1, None, None] + offsets[None, None, :], rows.shape)
+    inside = (rows >= 0) & (rows < pic.shape[0]) & (cols >= 0) & (cols < pic.shape[1])
+    pic[rows[inside], cols[inside]] = val
+    return pic
+
+def Visualize(input_name, posi_list, output_name, val, fast=False):
     pic=np.load(input_name)
-    for posi in posi_list:
-        n=posi[2:]
-        if(n[0]!=0 and n[1]!=0):
-            pic[n[0]-pixel_size_:n[0]+pixel_size_,n[1]-pixel_size_:n[1]+pixel_size_]=np.ones([pixel_size_*2,pixel_size_*2])*val
-    Image(pic,output_name)
+    Stamp(pic, posi_list, val)
+    if fast:
+        Png(pic,output_name)
+    else:
+        Image(pic,output_name)
     np.save(output_name,pic)
     return 0
 
+def _thumbnail(args):
+    input_name, output_name, size, cmap = args
+    Png(np.load(input_name, mmap_mode='r'), output_name, cmap=cmap, size=size)
+    return output_name
+
+def Thumbnails(input_dir, output_dir, size=256, cmap='jet', workers=None):
+    # PNG thumbnail of every .npy map in input_dir, rendered in parallel processes
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(os.path.join(input_dir, name), os.path.join(output_dir, os.path.splitext(name)[0]), size, cmap)
+            for name in sorted(os.listdir(input_dir)) if name.endswith('.npy')]
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(_thumbnail, jobs))
+
 def Nearest(ID, posi, rem,num):
     near=[]
     for i in range(num):